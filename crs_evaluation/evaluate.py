@@ -0,0 +1,270 @@
+"""
+Evaluate the search engine against bills cited in CRS reports, as crs_evaluation.ipynb does, and report ranking
+quality alongside search latency. Queries run across a pool of processes, and each query's ranking is cached per
+engine configuration and database version, so re-running after an unrelated change costs nothing.
+
+    python evaluate.py --db ../django-backend/congress-data_v2.4.db --workers 4 --output report.json
+
+Run from the crs_evaluation directory after get_crs_reports.ipynb and crs_transform.ipynb. Rankings from
+Congress.gov in congress_gov_searches/ are scored as a baseline when they are present.
+"""
+from typing import Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'django-backend'))
+
+from search_engine import SearchEngine  # noqa: E402
+from encoders import DEFAULT_ONNX_DIR  # noqa: E402
+
+
+# These queries are skipped because of a parameterization bug in the search engine.
+SKIPPED_QUERIES = ['arpa-h', 'r&d funding 2022']
+
+DEFAULT_CACHE_DIR = './evaluation_runs'
+
+# Search engine of each worker process.
+_engine = None
+
+
+def primary_key(bill_number, congress) -> str:
+    """
+    Key that identifies an HR bill across the engine's results, Congress.gov's results and the CRS citations.
+    """
+    return f'hr_{bill_number}_{congress}'
+
+
+def load_relevant(matches_csv: str, reports_csv: str, queries_json: str) -> Dict[str, set]:
+    """
+    Map each query to the primary keys of the bills cited by the CRS reports it was written for.
+    """
+    optimal = pd.read_csv(matches_csv)
+    optimal['match'] = optimal['match'].apply(lambda x: x.replace('\n', ''))
+
+    report_names = pd.read_csv(reports_csv)
+    optimal['ProductNumber'] = optimal.path.apply(lambda x: x.split('.')[0])
+    optimal = optimal.merge(report_names[['ProductNumber', 'Title']], on='ProductNumber', how='inner')
+    optimal['primary_key'] = [
+        primary_key(match.split(' ')[-1], congress) for match, congress in zip(optimal['match'], optimal.congress_match)
+    ]
+
+    with open(queries_json) as f:
+        queries = json.load(f)
+    manual = pd.DataFrame([(title, query) for title, values in queries.items() for query in values], columns=['Title', 'Query'])
+    optimal = optimal.merge(manual, on='Title', how='inner')
+
+    return {
+        query: set(group.primary_key)
+        for query, group in optimal.groupby('Query')
+        if query not in SKIPPED_QUERIES
+    }
+
+
+def load_congress_gov(searches_dir: str, queries: List[str], depth: int) -> Dict[str, List[str]]:
+    """
+    Congress.gov's ranking for each query that has a downloaded search.
+    """
+    rankings = {}
+    for query in queries:
+        path = os.path.join(searches_dir, f'{query}.csv')
+        if not os.path.exists(path):
+            continue
+        df = pd.read_csv(path, skiprows=2)[:depth]
+        rankings[query] = [
+            primary_key(number.lower().split(' ')[1], congress.split(' ')[0])
+            for number, congress in zip(df['Legislation Number'], df['Congress'])
+        ]
+    return rankings
+
+
+def engine_cache_key(config: Dict) -> str:
+    """
+    Identify an engine configuration, including the search engine's source, so that ranking changes invalidate
+    the cache.
+    """
+    with open(sys.modules[SearchEngine.__module__].__file__, 'rb') as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()
+    key = json.dumps({**config, 'database_version': SearchEngine.DATABASE_VERSION, 'source': source_hash}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _init_worker(db_path: str, encoder_backend: str, onnx_dir: str) -> None:
+    global _engine
+    SearchEngine.DATABASE_PATH = db_path
+    _engine = SearchEngine(encoder_backend=encoder_backend, onnx_dir=onnx_dir)
+
+
+def _run_query(query: str, number_to_return: int) -> Tuple[str, List[str], float]:
+    """
+    Rank bills for one query in a worker process. Returns the query, the ranked primary keys and the latency.
+    """
+    start = time.perf_counter()
+    results = _engine.retrieve_summary({'query': query, 'number_to_return': number_to_return})
+    latency_ms = (time.perf_counter() - start) * 1000
+    return query, [primary_key(r.bill_number, f"{r.congress}th") for r in results], latency_ms
+
+
+def run_queries(queries: List[str], config: Dict, workers: int, cache_path: str) -> Dict[str, Dict]:
+    """
+    Rankings and latencies for every query, from the cache where possible and from the process pool otherwise.
+    """
+    runs = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            runs = json.load(f)
+
+    missing = [query for query in queries if query not in runs]
+    if missing:
+        print(f'Running {len(missing)} queries on {workers} workers ({len(queries) - len(missing)} cached)')
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(config['db'], config['encoder'], config['onnx_dir'])
+        ) as pool:
+            futures = [pool.submit(_run_query, query, config['number_to_return']) for query in missing]
+            for future in futures:
+                query, keys, latency_ms = future.result()
+                runs[query] = {'ranking': keys, 'latency_ms': latency_ms}
+
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'w') as f:
+                json.dump(runs, f)
+
+    return {query: runs[query] for query in queries}
+
+
+def relevance_matrix(rankings: List[List[str]], relevant: List[set], depth: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Boolean (queries, depth) matrices: whether each ranked result is relevant, and whether it is a relevant bill
+    appearing for the first time. Rankings can list a bill more than once, once per version of its text.
+    """
+    hits = np.zeros((len(rankings), depth), dtype=bool)
+    first_hits = np.zeros((len(rankings), depth), dtype=bool)
+    for i, (ranking, relevant_keys) in enumerate(zip(rankings, relevant)):
+        ranking = np.array(ranking[:depth], dtype=object)
+        if len(ranking) == 0:
+            continue
+        is_relevant = np.isin(ranking, list(relevant_keys))
+        _, first = np.unique(ranking, return_index=True)
+        is_first = np.zeros(len(ranking), dtype=bool)
+        is_first[first] = True
+        hits[i, :len(ranking)] = is_relevant
+        first_hits[i, :len(ranking)] = is_relevant & is_first
+    return hits, first_hits
+
+
+def score(rankings: List[List[str]], relevant: List[set], ks: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Per-query MRR, average precision, and precision and recall at each k, computed as in crs_evaluation.ipynb.
+    """
+    depth = max([len(r) for r in rankings] + ks)
+    hits, first_hits = relevance_matrix(rankings, relevant, depth)
+    relevant_counts = np.array([len(r) for r in relevant], dtype=float)
+    ranks = np.arange(1, depth + 1)
+
+    any_hit = hits.any(axis=1)
+    mrr = np.where(any_hit, 1 / (hits.argmax(axis=1) + 1), 0.0)
+
+    # Precision at the rank of every relevant result, with a zero for every relevant bill that was not retrieved
+    precision_at_hits = (np.cumsum(hits, axis=1) / ranks * hits).sum(axis=1)
+    unretrieved = relevant_counts - first_hits.sum(axis=1)
+    denominator = hits.sum(axis=1) + unretrieved
+    average_precision = np.divide(precision_at_hits, denominator, out=np.zeros_like(precision_at_hits), where=denominator > 0)
+
+    metrics = {'mrr': mrr, 'map': average_precision}
+    found = np.cumsum(first_hits, axis=1)
+    for k in ks:
+        metrics[f'p@{k}'] = found[:, k - 1] / k
+        metrics[f'r@{k}'] = np.divide(found[:, k - 1], relevant_counts, out=np.zeros(len(relevant)), where=relevant_counts > 0)
+    return metrics
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, float]:
+    latencies = np.array(latencies_ms)
+    return {
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'max_ms': float(latencies.max())
+    }
+
+
+def report_system(rankings: Dict[str, List[str]], relevant: Dict[str, set], ks: List[int]) -> Dict:
+    queries = sorted(rankings)
+    metrics = score([rankings[q] for q in queries], [relevant[q] for q in queries], ks)
+    return {
+        'queries': len(queries),
+        'mean': {metric: float(values.mean()) for metric, values in metrics.items()},
+        'per_query': {q: {metric: float(values[i]) for metric, values in metrics.items()} for i, q in enumerate(queries)}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=SearchEngine.DATABASE_PATH)
+    parser.add_argument('--encoder', default='torch', choices=['torch', 'onnx', 'hashing'])
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--number-to-return', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--k', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--matches', default='./crs_matches_with_congresses_12-7-23.csv')
+    parser.add_argument('--reports', default='./SearchResults.csv')
+    parser.add_argument('--queries', default='./crs_queries.json')
+    parser.add_argument('--congress-gov-searches', default='./congress_gov_searches')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--output', default=None, help='Write the report to this JSON file.')
+    args = parser.parse_args()
+
+    relevant = load_relevant(args.matches, args.reports, args.queries)
+    queries = sorted(relevant)
+
+    config = {
+        'db': os.path.abspath(args.db),
+        'encoder': args.encoder,
+        'onnx_dir': os.path.abspath(args.onnx_dir),
+        'number_to_return': args.number_to_return
+    }
+    cache_path = None if args.no_cache else os.path.join(args.cache_dir, f'{engine_cache_key(config)}.json')
+
+    start = time.perf_counter()
+    runs = run_queries(queries, config, args.workers, cache_path)
+    wall_seconds = time.perf_counter() - start
+
+    report = {
+        'config': config,
+        'cache': cache_path,
+        'wall_seconds': wall_seconds,
+        'latency': latency_summary([run['latency_ms'] for run in runs.values()]),
+        'systems': {
+            'congressgpt': report_system({q: run['ranking'] for q, run in runs.items()}, relevant, args.k)
+        }
+    }
+
+    congress_gov = load_congress_gov(args.congress_gov_searches, queries, args.number_to_return)
+    if congress_gov:
+        report['systems']['congress.gov'] = report_system(congress_gov, relevant, args.k)
+
+    metrics = list(report['systems']['congressgpt']['mean'])
+    print(f'{"system":14s}' + ''.join(f'{m:>10s}' for m in metrics))
+    for name, system in report['systems'].items():
+        print(f'{name:14s}' + ''.join(f'{system["mean"][m]:10.4f}' for m in metrics))
+    latency = report['latency']
+    print(f'\nCongressGPT latency over {len(runs)} queries: mean {latency["mean_ms"]:.0f} ms, '
+          f'p50 {latency["p50_ms"]:.0f} ms, p95 {latency["p95_ms"]:.0f} ms, max {latency["max_ms"]:.0f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
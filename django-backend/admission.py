@@ -0,0 +1,318 @@
+from typing import Any, Callable, Dict
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+
+
+class OverloadedError(Exception):
+    """
+    Raised when work is turned away because the server is overloaded. Views answer it with a 503.
+    """
+    def __init__(self, resource: str, reason: str) -> None:
+        super().__init__(f'{resource} overloaded: {reason}')
+        self.resource = resource
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ['event', 'granted']
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.granted = False
+
+
+class _Ticket:
+    __slots__ = ['deadline', 'optional', 'left_queue']
+
+    def __init__(self, deadline: float, optional: bool) -> None:
+        self.deadline = deadline
+        self.optional = optional
+        self.left_queue = False
+
+
+class ResourceLimiter:
+    """
+    Bounds the number of threads using a resource at once. Threads that find every slot taken wait in a FIFO queue,
+    so they are let in in the order they arrived, and a freed slot is handed straight to the thread at the head.
+    A thread that would make the queue longer than max_queue is turned away at once, and one that waits longer
+    than its timeout gives up; both raise OverloadedError.
+    """
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, timeout: float) -> None:
+        self.__name = name
+        self.__max_concurrent = max_concurrent
+        self.__max_queue = max_queue
+        self.__timeout = timeout
+        self.__available = max_concurrent
+        self.__waiters = deque()
+        self.__lock = threading.Lock()
+
+        self.__admitted = 0
+        self.__queued = 0
+        self.__shed_queue_full = 0
+        self.__shed_timeout = 0
+        self.__wait_seconds = 0.0
+
+
+    def acquire(self, timeout: float = None) -> None:
+        """
+        Take a slot, waiting at most the limiter's timeout for one to free up, or timeout seconds if that is less.
+        """
+        with self.__lock:
+            if self.__available > 0 and not self.__waiters:
+                self.__available -= 1
+                self.__admitted += 1
+                return
+            if len(self.__waiters) >= self.__max_queue:
+                self.__shed_queue_full += 1
+                raise OverloadedError(self.__name, 'queue full')
+            waiter = _Waiter()
+            self.__waiters.append(waiter)
+            self.__queued += 1
+
+        start = time.monotonic()
+        waiter.event.wait(self.__timeout if timeout is None else max(0.0, min(self.__timeout, timeout)))
+
+        with self.__lock:
+            self.__wait_seconds += time.monotonic() - start
+            # The slot may have been handed over just as the wait timed out
+            if waiter.granted:
+                self.__admitted += 1
+                return
+            self.__waiters.remove(waiter)
+            self.__shed_timeout += 1
+        raise OverloadedError(self.__name, 'timed out in queue')
+
+
+    def release(self) -> None:
+        with self.__lock:
+            if self.__waiters:
+                waiter = self.__waiters.popleft()
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self.__available += 1
+
+
+    @contextmanager
+    def slot(self, timeout: float = None):
+        """
+        Hold a slot for the duration of a with block.
+        """
+        self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    def queue_depth(self) -> int:
+        with self.__lock:
+            return len(self.__waiters)
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {
+                'max_concurrent': self.__max_concurrent,
+                'in_use': self.__max_concurrent - self.__available,
+                'queue_depth': len(self.__waiters),
+                'admitted': self.__admitted,
+                'queued': self.__queued,
+                'shed_queue_full': self.__shed_queue_full,
+                'shed_timeout': self.__shed_timeout,
+                'mean_wait_ms': self.__wait_seconds * 1000 / self.__queued if self.__queued else 0
+            }
+
+
+class Admission:
+    """
+    Admission control for search work. Searches wait for the search executor in a FIFO queue of bounded length:
+    a search that arrives when the queue is full is turned away at once, and one that waited past its deadline
+    is dropped when its turn comes, since its client has likely given up. Inside the search engine, the encoders
+    and SQLite each have a ResourceLimiter. Once more than degrade_queue_depth searches are waiting, searches
+    run in a degraded mode that skips BERT scoring, so that the queue drains faster, and optional searches,
+    such as speculative ones, are dropped when their turn comes.
+    """
+    def __init__(
+        self,
+        max_queued_searches: int = 64,
+        queue_timeout: float = 10,
+        degrade_queue_depth: int = 16,
+        encoder_concurrency: int = 32,
+        sqlite_concurrency: int = 8
+    ) -> None:
+        self.__max_queued_searches = max_queued_searches
+        self.__queue_timeout = queue_timeout
+        self.__degrade_queue_depth = degrade_queue_depth
+        self.encoder = ResourceLimiter('encoder', encoder_concurrency, max_queued_searches, queue_timeout)
+        self.sqlite = ResourceLimiter('sqlite', sqlite_concurrency, max_queued_searches, queue_timeout)
+
+        self.__lock = threading.Lock()
+        self.__queued_searches = 0
+        self.__running_searches = 0
+        self.__admitted = 0
+        self.__shed_queue_full = 0
+        self.__shed_deadline = 0
+        self.__shed_optional = 0
+        self.__abandoned = 0
+        self.__degraded = 0
+
+
+    def enqueue(self, optional: bool = False) -> _Ticket:
+        """
+        Admit a search into the queue, or raise OverloadedError if the queue is full. Returns the search's
+        ticket, to be passed to run, or to abandon if the search will never be run. An optional search is
+        dropped instead of run if the queue is long when its turn comes.
+        """
+        with self.__lock:
+            if self.__queued_searches >= self.__max_queued_searches:
+                self.__shed_queue_full += 1
+                raise OverloadedError('search', 'queue full')
+            self.__queued_searches += 1
+            self.__admitted += 1
+        return _Ticket(time.monotonic() + self.__queue_timeout, optional)
+
+
+    def run(self, ticket: _Ticket, function: Callable, *args) -> Any:
+        """
+        Run an admitted search once it reaches the front of the queue, unless its deadline has passed or it was
+        abandoned while it waited.
+        """
+        with self.__lock:
+            if ticket.left_queue:
+                raise OverloadedError('search', 'abandoned in queue')
+            ticket.left_queue = True
+            self.__queued_searches -= 1
+            if time.monotonic() > ticket.deadline:
+                self.__shed_deadline += 1
+                raise OverloadedError('search', 'deadline passed in queue')
+            if ticket.optional and self.__queued_searches >= self.__degrade_queue_depth:
+                self.__shed_optional += 1
+                raise OverloadedError('search', 'optional search dropped while degraded')
+            self.__running_searches += 1
+        try:
+            return function(*args)
+        finally:
+            with self.__lock:
+                self.__running_searches -= 1
+
+
+    def abandon(self, ticket: _Ticket) -> None:
+        """
+        Take a search out of the queue without running it. Does nothing if it already left the queue, so it is
+        safe to call once the search is done either way.
+        """
+        with self.__lock:
+            if not ticket.left_queue:
+                ticket.left_queue = True
+                self.__queued_searches -= 1
+                self.__abandoned += 1
+
+
+    def submit(self, executor: Executor, function: Callable, *args, optional: bool = False) -> Future:
+        """
+        Admit a search and submit it to executor, which should be the one whose queue this admits to. If the
+        returned future is cancelled before a worker picks the search up, the search leaves the queue then.
+        """
+        ticket = self.enqueue(optional)
+        try:
+            future = executor.submit(self.run, ticket, function, *args)
+        except BaseException:
+            self.abandon(ticket)
+            raise
+        future.add_done_callback(lambda _: self.abandon(ticket))
+        return future
+
+
+    def should_degrade(self) -> bool:
+        """
+        Whether a search should skip BERT scoring because the queue is long. Counts the searches degraded.
+        """
+        with self.__lock:
+            degrade = self.__queued_searches >= self.__degrade_queue_depth
+            if degrade:
+                self.__degraded += 1
+            return degrade
+
+
+    def overloaded(self) -> bool:
+        """
+        Whether optional work, such as speculative searches, should be skipped.
+        """
+        with self.__lock:
+            return self.__queued_searches >= self.__degrade_queue_depth
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self.__lock:
+            searches = {
+                'queue_depth': self.__queued_searches,
+                'running': self.__running_searches,
+                'admitted': self.__admitted,
+                'shed_queue_full': self.__shed_queue_full,
+                'shed_deadline': self.__shed_deadline,
+                'shed_optional': self.__shed_optional,
+                'abandoned': self.__abandoned,
+                'degraded': self.__degraded
+            }
+        return {'searches': searches, 'encoder': self.encoder.stats(), 'sqlite': self.sqlite.stats()}
+
+
+class SearchExecutor(ThreadPoolExecutor):
+    """
+    The thread pool that runs searches, counting the work waiting for a worker and the work running, so that the
+    metrics endpoint can report them without Admission. Work cancelled before it starts leaves the count when it
+    is cancelled.
+    """
+    def __init__(self, max_workers: int, thread_name_prefix: str = '') -> None:
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.__max_workers = max_workers
+        self.__lock = threading.Lock()
+        self.__queued = 0
+        self.__running = 0
+        self.__completed = 0
+
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        with self.__lock:
+            self.__queued += 1
+        try:
+            future = super().submit(self.__run, function, *args, **kwargs)
+        except BaseException:
+            with self.__lock:
+                self.__queued -= 1
+            raise
+        future.add_done_callback(self.__cancelled)
+        return future
+
+
+    def __run(self, function: Callable, *args, **kwargs):
+        with self.__lock:
+            self.__queued -= 1
+            self.__running += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.__lock:
+                self.__running -= 1
+                self.__completed += 1
+
+
+    def __cancelled(self, future: Future) -> None:
+        # A cancelled future never reaches __run
+        if future.cancelled():
+            with self.__lock:
+                self.__queued -= 1
+
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                'workers': self.__max_workers,
+                'queue_depth': self.__queued,
+                'running': self.__running,
+                'completed': self.__completed
+            }
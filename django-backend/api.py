@@ -1,12 +1,17 @@
 # myapp/views/api.py
-import requests
-from requests import JSONDecodeError
+from json import JSONDecodeError
 import os
+import asyncio
 from decouple import config
 from django.apps import apps
-from congress_gpt import prompt, search_prompt
+from congress_gpt import agent_turn, prompt, search_prompt, search_results_for_display
+from clients import get_http_client
+from deadlines import SUPABASE_BUDGET
+import deadlines
 from supabase import create_client
 import json
+from dataclasses import InitVar, dataclass, field
+from typing import Any, Optional, Tuple
 
 key: str = config("VITE_SUPABASE_KEY")
 url = config("VITE_SUPABASE_URL")
@@ -23,31 +28,23 @@ titles_url = f"{url}/rest/v1/chats"
 history_url = f"{url}/rest/v1/messages"
 
 
+@dataclass(slots=True)
 class ApiResponse:
-    def __init__(
-        self, 
-        chat_id=None, 
-        title=None, 
-        pos=None, 
-        search_response=None, 
-        content=None, 
-        role=None, 
-        createdAt=None, 
-        rating=None, 
-        error=None,
-        search_request=None
-    ):
-        self.success = True
-        self.chat_id = chat_id
-        self.title = title
-        self.pos = pos
-        self.search_response = search_response
-        self.search_request = search_request
-        self.content = content
-        self.role = role
-        self.createdAt = createdAt
-        self.rating = rating
-
+    chat_id: Any = None
+    title: Optional[str] = None
+    pos: Optional[int] = None
+    search_response: Optional[bool] = None
+    content: Optional[str] = None
+    role: Optional[str] = None
+    createdAt: Optional[str] = None
+    rating: Any = None
+    error: InitVar[Optional[Tuple[int, str]]] = None
+    search_request: Optional[bool] = None
+    success: bool = field(default=True, init=False)
+    status: Optional[int] = field(default=None, init=False)
+    reason: Optional[str] = field(default=None, init=False)
+
+    def __post_init__(self, error):
         if error is not None:
             self._error(error[0], error[1])
 
@@ -111,7 +108,7 @@ def parse_pos(num: str = None):
     return pos
 
 
-def talk(chat_prompt: str, token: str, created_at: str, chat_id: str = None, pos: str = None, language_model: str = None):
+async def talk(chat_prompt: str, token: str, created_at: str, chat_id: str = None, pos: str = None, language_model: str = None):
     """
     This function sends a chat request to the server.
     It always returns an ApiResponse, regardless of error.
@@ -129,7 +126,7 @@ def talk(chat_prompt: str, token: str, created_at: str, chat_id: str = None, pos
     if chat_id is not None and chat_id != 'None':
         data['chat_id'] = parse_chat_id(chat_id)
 
-    response = prompt(data, token)
+    response = await prompt(data, token)
     response = response.content
     response = json.loads(response.decode('utf-8'))
 
@@ -150,7 +147,7 @@ def talk(chat_prompt: str, token: str, created_at: str, chat_id: str = None, pos
 
 
 
-def search(token: str, chat_id: str, language_model: str):
+async def search(token: str, chat_id: str, language_model: str):
     """
     This function sends a search request to the server.
     It should be called whenever the result from the server
@@ -162,7 +159,7 @@ def search(token: str, chat_id: str, language_model: str):
         'language_model': language_model
     }
 
-    response = search_prompt(data, token, chat_id, language_model)
+    response = await search_prompt(data, token, chat_id, language_model)
 
     return [
         ApiResponse(
@@ -176,7 +173,35 @@ def search(token: str, chat_id: str, language_model: str):
 
 
 
-def titles(token: str):
+async def agent(chat_prompt: str, token: str, created_at: str, chat_id: str = None, pos: str = None, language_model: str = None):
+    """
+    This function runs a whole chat turn, searches included, on the server.
+    It yields (event, ApiResponse) pairs as the turn progresses.
+    If chat_id is None, this function starts a new chat.
+    """
+    data = {
+        'prompt': chat_prompt,
+        'created_at': created_at,
+        'order_in_chat': parse_pos(pos),
+        'language_model': language_model
+    }
+
+    if chat_id is not None and chat_id != 'None':
+        data['chat_id'] = parse_chat_id(chat_id)
+
+    async for event, message in agent_turn(data, token):
+        yield event, ApiResponse(
+            chat_id=message['chats_id'],
+            pos=message['order_in_chat'],
+            content=message.get('content'),
+            role=message.get('role'),
+            search_request=message.get('search_request'),
+            search_response=message.get('search_response')
+        )
+
+
+
+async def titles(token: str):
     """
     This function retrieves all titles for the current user
     It always returns a list, regardless of error.
@@ -191,7 +216,9 @@ def titles(token: str):
         'select': 'chat_title,id',
     }
 
-    response = requests.get(titles_url, headers=headers, params=params)
+    response = await get_http_client().get(
+        titles_url, headers=headers, params=params, timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+    )
     status = response.status_code
 
     if status != 200:
@@ -221,7 +248,7 @@ def titles(token: str):
     return sorted(response_list, key=lambda x: x.chat_id, reverse=True)
 
 
-def history(token: str, chat_id: str):
+async def history(token: str, chat_id: str):
     """
     This function retrieves all previous chats given an id
     It always returns a list, regardless of error.
@@ -242,7 +269,9 @@ def history(token: str, chat_id: str):
     except ValueError:
         return list()
 
-    response = requests.get(history_url, headers=headers, params=params)
+    response = await get_http_client().get(
+        history_url, headers=headers, params=params, timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+    )
     status = response.status_code
 
     if status != 200:
@@ -255,6 +284,12 @@ def history(token: str, chat_id: str):
         print('JSONDecodeError:', str(e))
         return list()
 
+    # Search results are stored as ids, so look them up for display
+    search_responses = [speech for speech in response if speech.get('search_response')]
+    contents = await asyncio.gather(*[search_results_for_display(speech['content']) for speech in search_responses])
+    for speech, content in zip(search_responses, contents):
+        speech['content'] = content
+
     try:
         response_list = [
             ApiResponse(
@@ -285,7 +320,7 @@ if __name__ == '__main__':
         'password': '',
     })
 
-    response = titles(data.session.access_token)
+    response = asyncio.run(titles(data.session.access_token))
 
     # response = talk('Give me 3 bills on climate change',
     #                 data.session.access_token,
@@ -0,0 +1,221 @@
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the background queue is full. Callers should do the work themselves instead.
+    """
+
+
+class BackgroundExecutor:
+    """
+    A bounded pool of worker threads for fire-and-forget work such as Supabase writes and chat titles.
+    Each worker owns an event loop, so jobs may be plain functions or coroutine functions.
+    Items submitted through coalesce() are buffered briefly and handed to their flush function as one batch,
+    so several message inserts become a single bulk POST.
+    """
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_queue_size: int = 1000,
+        retry_backoff: float = 0.5,
+        coalesce_window: float = 0.05,
+        max_batch_size: int = 100,
+        worker_cleanup: Optional[Callable] = None
+    ) -> None:
+        self.__queue = queue.Queue(maxsize=max_queue_size)
+        self.__retry_backoff = retry_backoff
+        self.__coalesce_window = coalesce_window
+        self.__max_batch_size = max_batch_size
+        self.__worker_cleanup = worker_cleanup
+
+        self.__lock = threading.Lock()
+        self.__batches_ready = threading.Condition(self.__lock)
+        self.__pending_batches: Dict[Hashable, Dict[str, Any]] = {}
+        self.__metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'retried': 0,
+            'failed': 0,
+            'rejected': 0,
+            'coalesced_batches': 0,
+            'coalesced_items': 0
+        }
+        self.__shutting_down = False
+
+        self.__workers = [
+            threading.Thread(target=self.__work, name=f'background-{i}', daemon=True)
+            for i in range(max_workers)
+        ]
+        self.__flusher = threading.Thread(target=self.__flush_batches, name='background-flusher', daemon=True)
+
+        for worker in self.__workers:
+            worker.start()
+        self.__flusher.start()
+
+        atexit.register(self.shutdown)
+
+
+    def submit(self, function: Callable, *args, retries: int = 0, block: bool = False, timeout: float = None) -> None:
+        """
+        Queue a function or coroutine function to run on a worker. Failed jobs are retried with exponential backoff.
+        Raises QueueFullError if the queue is full, or stays full for the timeout when block is True.
+        """
+        if self.__shutting_down:
+            raise QueueFullError('Background executor is shutting down.')
+        try:
+            self.__queue.put((function, args, retries), block=block, timeout=timeout)
+        except queue.Full:
+            self.__count('rejected')
+            raise QueueFullError(f'Background queue is full ({self.__queue.maxsize} jobs).')
+        self.__count('submitted')
+
+
+    def coalesce(self, key: Hashable, items: List, flush_function: Callable, retries: int = 0) -> None:
+        """
+        Buffer items under a key. Within the coalescing window, all items buffered under the same key are passed
+        to flush_function(*key, items) in a single job. Raises QueueFullError if the queue is full.
+        """
+        with self.__lock:
+            if self.__shutting_down or self.__queue.full():
+                self.__metrics['rejected'] += 1
+                raise QueueFullError(f'Background queue is full ({self.__queue.maxsize} jobs).')
+
+            batch = self.__pending_batches.get(key)
+            if batch is None:
+                batch = {'items': [], 'function': flush_function, 'retries': retries, 'created': time.monotonic()}
+                self.__pending_batches[key] = batch
+            batch['items'].extend(items)
+            batch['retries'] = max(batch['retries'], retries)
+            self.__batches_ready.notify()
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Queue depth and job counters.
+        """
+        with self.__lock:
+            stats = dict(self.__metrics)
+            stats['pending_coalesced_items'] = sum(len(b['items']) for b in self.__pending_batches.values())
+        stats['queue_depth'] = self.__queue.qsize()
+        stats['max_queue_size'] = self.__queue.maxsize
+        stats['workers'] = len(self.__workers)
+        return stats
+
+
+    def shutdown(self, timeout: float = 30) -> None:
+        """
+        Stop accepting work, flush buffered batches, and wait for queued jobs to finish.
+        """
+        with self.__lock:
+            if self.__shutting_down:
+                return
+            self.__shutting_down = True
+            self.__batches_ready.notify()
+
+        deadline = time.monotonic() + timeout
+        self.__flusher.join(timeout)
+
+        # One sentinel per worker, queued behind the remaining jobs
+        for _ in self.__workers:
+            self.__queue.put(None)
+        for worker in self.__workers:
+            worker.join(max(0, deadline - time.monotonic()))
+
+        if self.__queue.qsize():
+            logger.error('Background executor shut down with %d jobs still queued.', self.__queue.qsize())
+
+
+    def __count(self, metric: str, amount: int = 1) -> None:
+        """
+        Increment a metric counter.
+        """
+        with self.__lock:
+            self.__metrics[metric] += amount
+
+
+    def __flush_batches(self) -> None:
+        """
+        Flusher thread: move coalesced batches onto the queue once their window has passed.
+        """
+        while True:
+            with self.__lock:
+                while not self.__pending_batches and not self.__shutting_down:
+                    self.__batches_ready.wait()
+
+                if not self.__shutting_down:
+                    oldest = min(b['created'] for b in self.__pending_batches.values())
+                    wait = oldest + self.__coalesce_window - time.monotonic()
+                    if wait > 0:
+                        self.__batches_ready.wait(wait)
+                        continue
+
+                now = time.monotonic()
+                ready = {
+                    key: batch for key, batch in self.__pending_batches.items()
+                    if self.__shutting_down or now - batch['created'] >= self.__coalesce_window
+                }
+                for key in ready:
+                    del self.__pending_batches[key]
+                shutting_down = self.__shutting_down
+
+            for key, batch in ready.items():
+                key_args = key if isinstance(key, tuple) else (key,)
+                items = batch['items']
+                for i in range(0, len(items), self.__max_batch_size):
+                    chunk = items[i : i + self.__max_batch_size]
+                    # Blocking here pushes back on coalesce(), which rejects work while the queue is full
+                    self.__queue.put((batch['function'], key_args + (chunk,), batch['retries']))
+                    self.__count('submitted')
+                    self.__count('coalesced_batches')
+                    self.__count('coalesced_items', len(chunk))
+
+            if shutting_down:
+                return
+
+
+    def __work(self) -> None:
+        """
+        Worker thread: run queued jobs on this thread's event loop until a sentinel is received.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                job = self.__queue.get()
+                if job is None:
+                    break
+                self.__run(loop, *job)
+        finally:
+            if self.__worker_cleanup is not None:
+                loop.run_until_complete(self.__worker_cleanup())
+            loop.close()
+
+
+    def __run(self, loop: asyncio.AbstractEventLoop, function: Callable, args: tuple, retries: int) -> None:
+        """
+        Run one job, retrying with exponential backoff.
+        """
+        for attempt in range(retries + 1):
+            try:
+                result = function(*args)
+                if asyncio.iscoroutine(result):
+                    loop.run_until_complete(result)
+                self.__count('completed')
+                return
+            except Exception:
+                if attempt == retries:
+                    self.__count('failed')
+                    logger.exception('Background job %s failed after %d attempts.', function.__name__, attempt + 1)
+                    return
+                self.__count('retried')
+                time.sleep(self.__retry_backoff * 2 ** attempt)
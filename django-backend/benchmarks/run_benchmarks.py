@@ -0,0 +1,284 @@
+"""
+Benchmark the search engine against a synthetic congress-data database, so that performance regressions show up
+before deploy. The database is generated on the first run and reused afterwards.
+
+    python -m benchmarks.run_benchmarks --bills 10k --encoder hashing --output results.json
+    python -m benchmarks.run_benchmarks --bills 10k --encoder hashing --baseline results.json
+
+With --baseline, exits with status 1 if any benchmark's median got slower than the allowed regression.
+With --filter-index, the same queries are also run without filters, and the run exits with status 1 if a filtered
+search is slower than the unfiltered one by more than the allowed regression. Filters only narrow the search, so
+filtered searches should cost no more.
+"""
+from typing import Callable, Dict, List
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+import numpy as np
+import tracing
+from encoders import LEGAL_BERT_PATH, DEFAULT_ONNX_DIR, load_encoder
+from search_engine import SearchEngine
+from benchmarks import synthetic_db
+
+
+def summarize(latencies_ms: List[float]) -> Dict[str, float]:
+    """
+    Summary statistics of a list of latencies.
+    """
+    latencies = np.array(latencies_ms)
+    return {
+        'count': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'median_ms': float(np.median(latencies)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'min_ms': float(latencies.min()),
+        'max_ms': float(latencies.max())
+    }
+
+
+def measure(function: Callable, calls: List[tuple], warmup: int = 1) -> Dict[str, float]:
+    """
+    Time function once per argument tuple, after a few untimed warmup calls.
+    """
+    for args in calls[:warmup]:
+        function(*args)
+
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return summarize(latencies)
+
+
+def sample_queries(rng: np.random.Generator, count: int) -> List[str]:
+    """
+    Queries of one to three of the more common policy words.
+    """
+    words = synthetic_db.POLICY_WORDS
+    return [' '.join(rng.choice(words, size=int(rng.integers(1, 4)), replace=False)) for _ in range(count)]
+
+
+# A narrow filter: bipartisan House bills from one decade.
+NARROW_FILTER = {
+    'chamber': 'U.S. House of Representatives',
+    'require_bipartisan': True,
+    'date_range': {'start_year': 2001, 'start_month': 1, 'start_day': 1, 'end_year': 2010, 'end_month': 12, 'end_day': 31}
+}
+
+ONE_YEAR_FILTER = {
+    'date_range': {'start_year': 2005, 'start_month': 1, 'start_day': 1, 'end_year': 2005, 'end_month': 12, 'end_day': 31}
+}
+
+# Filtered searches that --filter-index compares with the same queries unfiltered
+FILTERED_BENCHMARKS = {
+    'retrieve_summary[top50,filtered]': NARROW_FILTER,
+    'retrieve_summary[top50,one year]': ONE_YEAR_FILTER
+}
+
+
+def bench_retrieve_summary(engine: SearchEngine, rng: np.random.Generator, queries: int, number_to_return: int, get_sponsors: bool = False, filters: Dict = None) -> Dict:
+    calls = [
+        ({'query': query, 'number_to_return': number_to_return, 'get_sponsors': get_sponsors, **(filters or {})},)
+        for query in sample_queries(rng, queries)
+    ]
+    result = measure(engine.retrieve_summary, calls)
+    result['queries_per_second'] = 1000 / result['mean_ms']
+    return result
+
+
+def bench_retrieve_summary_multi(engine: SearchEngine, rng: np.random.Generator, queries: int, number_to_return: int, variants: int) -> Dict:
+    calls = [
+        ({'query': '', 'number_to_return': number_to_return}, sample_queries(rng, variants))
+        for _ in range(queries)
+    ]
+    result = measure(engine.retrieve_summary_multi, calls)
+    result['queries_per_second'] = 1000 / result['mean_ms']
+    return result
+
+
+def bench_retrieve_full_text_chunks(engine: SearchEngine, conn: sqlite3.Connection, rng: np.random.Generator, queries: int) -> Dict:
+    ids = [row[0] for row in conn.execute("select id from full_texts where file_chamber = 'hr'")]
+    bill_ids = rng.choice(ids, size=queries)
+    calls = [
+        ({'query': query, 'number_to_return': 5}, int(bill_id))
+        for query, bill_id in zip(sample_queries(rng, queries), bill_ids)
+    ]
+    result = measure(engine.retrieve_full_text_chunks, calls)
+    result['queries_per_second'] = 1000 / result['mean_ms']
+    return result
+
+
+def bench_index_builds(conn: sqlite3.Connection, repeats: int) -> Dict[str, Dict]:
+    """
+    Time rebuilding the BM25 index and the B-tree indexes. Both leave the database as it was.
+    """
+    calls = [(conn,)] * repeats
+    return {
+        'build_bm25_index': measure(synthetic_db.build_bm25_index, calls, warmup=0),
+        'build_indexes': measure(synthetic_db.build_indexes, calls, warmup=0)
+    }
+
+
+def bench_precompute(conn: sqlite3.Connection, encoder, bills: int, batch_size: int) -> Dict:
+    """
+    Throughput of embedding and storing bill passages, as the precompute step does, into a scratch table.
+    """
+    conn.execute('drop table if exists bert_embeddings_benchmark')
+    conn.execute('create table bert_embeddings_benchmark as select * from bert_embeddings where 0')
+    ids = [row[0] for row in conn.execute('select id from full_texts order by id limit ?', (bills,))]
+
+    start = time.perf_counter()
+    passages = synthetic_db.write_embeddings(conn, encoder, ids, batch_size, table='bert_embeddings_benchmark')
+    seconds = time.perf_counter() - start
+
+    conn.execute('drop table bert_embeddings_benchmark')
+    conn.commit()
+    return {
+        'bills': len(ids),
+        'passages': passages,
+        'seconds': seconds,
+        'bills_per_second': len(ids) / seconds,
+        'passages_per_second': passages / seconds
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results: Dict, baseline: Dict, max_regression: float) -> bool:
+    """
+    Print the change in median latency against a baseline report. Returns False if anything regressed by more
+    than max_regression (0.2 is 20% slower).
+    """
+    ok = True
+    for name, result in results['benchmarks'].items():
+        previous = baseline['benchmarks'].get(name)
+        if previous is None or 'median_ms' not in result or 'median_ms' not in previous:
+            continue
+        change = result['median_ms'] / previous['median_ms'] - 1
+        regressed = change > max_regression
+        ok = ok and not regressed
+        print(f'{name:40s} {previous["median_ms"]:10.2f} ms -> {result["median_ms"]:10.2f} ms '
+              f'({change:+.1%}){"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def compare_filtered(benchmarks: Dict, max_regression: float) -> bool:
+    """
+    Print the median latency of each filtered search against the same queries without filters.
+    Returns False if any filtered search is slower by more than max_regression.
+    """
+    ok = True
+    unfiltered = benchmarks['retrieve_summary[top50,unfiltered]']['median_ms']
+    for name in FILTERED_BENCHMARKS:
+        filtered = benchmarks[name]['median_ms']
+        change = filtered / unfiltered - 1
+        regressed = change > max_regression
+        ok = ok and not regressed
+        print(f'{name + " vs. unfiltered":56s} {unfiltered:10.2f} ms -> {filtered:10.2f} ms '
+              f'({change:+.1%}){"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bills', type=synthetic_db.parse_scale, default='10k', help='Number of bills, such as 10k or 1m.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', default=None, help='Use this database instead of a generated one.')
+    parser.add_argument('--rebuild', action='store_true', help='Regenerate the synthetic database.')
+    parser.add_argument('--encoder', default='torch', choices=['torch', 'onnx', 'hashing'])
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--metadata-dir', default=None, help='Hydrate results from a metadata store in this directory.')
+    parser.add_argument('--filter-index', action='store_true', help='Filter with bitmaps. Needs --metadata-dir.')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--index-repeats', type=int, default=1)
+    parser.add_argument('--precompute-bills', type=int, default=200)
+    parser.add_argument('--precompute-batch-size', type=int, default=64)
+    parser.add_argument('--skip', nargs='*', default=[], choices=['summary', 'full_text', 'indexes', 'precompute'])
+    parser.add_argument('--output', default=None, help='Write the report to this JSON file.')
+    parser.add_argument('--baseline', default=None, help='Compare against this earlier report.')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    path = args.db or synthetic_db.default_path(args.bills, args.seed)
+    if args.db is None and (args.rebuild or not os.path.exists(path)):
+        print(f'Generating {args.bills} synthetic bills at {path}')
+        synthetic_db.generate(path, args.bills, args.seed, embeddings='hashing' if args.encoder == 'hashing' else 'random')
+
+    SearchEngine.DATABASE_PATH = path
+    engine = SearchEngine(encoder_backend=args.encoder, onnx_dir=args.onnx_dir, metadata_dir=args.metadata_dir, filter_index=args.filter_index)
+    conn = sqlite3.Connection(path)
+    rng = np.random.default_rng(args.seed)
+
+    benchmarks = {}
+    if 'summary' not in args.skip:
+        benchmarks['retrieve_summary[top5]'] = bench_retrieve_summary(engine, rng, args.queries, 5)
+        benchmarks['retrieve_summary[top50]'] = bench_retrieve_summary(engine, rng, args.queries, 50)
+        benchmarks['retrieve_summary[top50,sponsors]'] = bench_retrieve_summary(engine, rng, args.queries, 50, get_sponsors=True)
+        for name, filters in FILTERED_BENCHMARKS.items():
+            benchmarks[name] = bench_retrieve_summary(engine, np.random.default_rng(args.seed), args.queries, 50, filters=filters)
+        if args.filter_index:
+            benchmarks['retrieve_summary[top50,unfiltered]'] = bench_retrieve_summary(
+                engine, np.random.default_rng(args.seed), args.queries, 50
+            )
+        benchmarks['retrieve_summary_multi[top50,3 variants]'] = bench_retrieve_summary_multi(engine, rng, args.queries, 50, 3)
+    if 'full_text' not in args.skip:
+        benchmarks['retrieve_full_text_chunks'] = bench_retrieve_full_text_chunks(engine, conn, rng, args.queries)
+    if 'indexes' not in args.skip:
+        benchmarks.update(bench_index_builds(conn, args.index_repeats))
+    if 'precompute' not in args.skip:
+        encoder = load_encoder(LEGAL_BERT_PATH, args.encoder, args.onnx_dir)
+        benchmarks['precompute'] = bench_precompute(conn, encoder, args.precompute_bills, args.precompute_batch_size)
+
+    results = {
+        'meta': {
+            'database': path,
+            'bills': conn.execute('select count(*) from full_texts').fetchone()[0],
+            'encoder': args.encoder,
+            'metadata_store': args.metadata_dir is not None,
+            'filter_index': args.filter_index,
+            'queries': args.queries,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds')
+        },
+        'benchmarks': benchmarks,
+        'stages': tracing.metrics_snapshot()['stages']
+    }
+
+    for name, result in benchmarks.items():
+        if 'median_ms' in result:
+            print(f'{name:40s} median {result["median_ms"]:10.2f} ms  p95 {result["p95_ms"]:10.2f} ms')
+        else:
+            print(f'{name:40s} {result["bills_per_second"]:10.1f} bills/s  {result["passages_per_second"]:10.1f} passages/s')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    ok = True
+    if args.filter_index and 'summary' not in args.skip:
+        ok = compare_filtered(benchmarks, args.max_regression)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        ok = compare(results, baseline, args.max_regression) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+"""
+Generate a synthetic congress-data SQLite database with the same tables as the real one: full_texts,
+bill_summaries, sponsors, bert_embeddings and the congress_bm25 full text index. Bill text is drawn from a
+Zipf-distributed vocabulary, so BM25 posting lists have a realistic shape, and everything is seeded, so the same
+arguments always produce the same database.
+
+    python -m benchmarks.synthetic_db --bills 10k
+    python -m benchmarks.synthetic_db --bills 1m --embeddings random --out /data/congress-data_synthetic_1m.db
+
+At 1m bills the embeddings alone take about 10 GB (5 passages of 512 float32 values per bill).
+"""
+from typing import Dict, List
+import argparse
+import os
+import pickle
+import sqlite3
+import time
+import numpy as np
+from encoders import LEGAL_BERT_PATH, MODEL_DIMENSIONS
+
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# Bills are inserted in batches of this size.
+INSERT_BATCH_SIZE = 5000
+
+# Number of passages embedded per bill, as in search_engine_precompute/compute_embeddings.py.
+PASSAGES_PER_BILL = 5
+
+# Real words, so that stemming behaves as it does on real bills. They are the most frequent words of the
+# vocabulary, and the rest of the vocabulary is made up of synthetic terms.
+POLICY_WORDS = [
+    'act', 'amend', 'appropriations', 'agriculture', 'authority', 'bank', 'border', 'budget', 'business', 'care',
+    'child', 'china', 'citizens', 'climate', 'coast', 'commerce', 'communities', 'congress', 'conservation',
+    'consumer', 'credit', 'crime', 'cybersecurity', 'defense', 'development', 'disaster', 'drug', 'economic',
+    'education', 'election', 'emergency', 'employment', 'energy', 'environmental', 'export', 'families', 'farm',
+    'federal', 'finance', 'fiscal', 'food', 'foreign', 'forest', 'fuel', 'funding', 'grants', 'guard', 'health',
+    'highway', 'homeland', 'hospital', 'housing', 'immigration', 'income', 'indian', 'infrastructure', 'insurance',
+    'intelligence', 'internal', 'justice', 'labor', 'land', 'law', 'loan', 'medicaid', 'medicare', 'military',
+    'mining', 'national', 'native', 'natural', 'nuclear', 'oil', 'pension', 'pharmaceutical', 'pipeline', 'police',
+    'postal', 'prescription', 'pricing', 'program', 'property', 'protection', 'public', 'railroad', 'refugee',
+    'renewable', 'research', 'reserve', 'retirement', 'revenue', 'rural', 'safety', 'school', 'science', 'secretary',
+    'security', 'senior', 'service', 'small', 'social', 'space', 'states', 'student', 'tax', 'technology',
+    'telecommunications', 'trade', 'transportation', 'treasury', 'tribal', 'unemployment', 'veterans', 'wage',
+    'water', 'weapons', 'wildlife', 'women', 'workers', 'youth'
+]
+
+COMMITTEES = [
+    'Agriculture', 'Appropriations', 'Armed Services', 'Energy and Commerce', 'Financial Services', 'Foreign Affairs',
+    'Homeland Security', 'Judiciary', 'Natural Resources', 'Oversight and Accountability', 'Science, Space, and Technology',
+    'Transportation and Infrastructure', 'Veterans\' Affairs', 'Ways and Means', 'Education and the Workforce'
+]
+
+# (file_chamber, publisher, legis_type, share of bills). House bills dominate, as in the real data, which matters
+# because the BM25 stage only returns HR bills.
+BILL_TYPES = [
+    ('hr', 'U.S. House of Representatives', 'bill', 0.55),
+    ('s', 'U.S. Senate', 'bill', 0.30),
+    ('hres', 'U.S. House of Representatives', 'resolution', 0.06),
+    ('sres', 'U.S. Senate', 'resolution', 0.04),
+    ('hjres', 'U.S. House of Representatives', 'joint resolution', 0.02),
+    ('sjres', 'U.S. Senate', 'joint resolution', 0.01),
+    ('hconres', 'U.S. House of Representatives', 'concurrent resolution', 0.01),
+    ('sconres', 'U.S. Senate', 'concurrent resolution', 0.01)
+]
+
+STAGES = ['ih', 'is', 'rh', 'rs', 'eh', 'es', 'enr']
+PARTIES = ['D', 'R', 'I']
+FIRST_CONGRESS, LAST_CONGRESS = 93, 118
+
+SCHEMA = [
+    """
+    create table full_texts (
+        id integer primary key,
+        text text,
+        title text,
+        official_title text,
+        available_chunks integer,
+        multiple_parties integer,
+        generated_url text,
+        file_stage text,
+        file_number integer,
+        file_chamber text,
+        file_congress integer,
+        date text,
+        legis_type text,
+        committee_name text,
+        publisher text,
+        current_chamber text,
+        session integer,
+        summaries_match integer
+    )
+    """,
+    """
+    create table bill_summaries (
+        id integer primary key,
+        summary_text text
+    )
+    """,
+    """
+    create table sponsors (
+        loc_id text,
+        name text,
+        full_name text,
+        chamber text,
+        party text,
+        bill_sponsored integer
+    )
+    """,
+    """
+    create table bert_embeddings (
+        id integer primary key,
+        full_text_id integer,
+        embedding blob,
+        embedding_blob blob,
+        foreign key (full_text_id) references full_texts(id)
+    )
+    """
+]
+
+# Same passages as search_engine_precompute/compute_embeddings.py.
+PASSAGES_QUERY = """
+    select
+        id,
+        title || ' ' || substr(coalesce(text, ''), 1, 800) as passage1,
+        title || ' ' || substr(coalesce(text, ''), 600, 1400) as passage2,
+        title || ' ' || substr(coalesce(text, ''), 1200, 2000) as passage3,
+        title || ' ' || substr(coalesce(text, ''), 1800, 2600) as passage4,
+        title || ' ' || substr(coalesce(text, ''), 2400, 3200) as passage5
+    from full_texts
+"""
+
+
+def parse_scale(value: str) -> int:
+    """
+    Parse a bill count such as 10000, 10k or 1m.
+    """
+    value = value.strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    if multiplier != 1:
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def default_path(bills: int, seed: int) -> str:
+    """
+    Where a database of the given size is cached between benchmark runs.
+    """
+    return os.path.join(DEFAULT_DATA_DIR, f'congress-data_synthetic_{bills}_{seed}.db')
+
+
+def make_vocabulary(size: int) -> np.ndarray:
+    """
+    The policy words followed by synthetic terms, most frequent first.
+    """
+    synthetic = [f'term{i}' for i in range(max(0, size - len(POLICY_WORDS)))]
+    return np.array(POLICY_WORDS + synthetic, dtype=object)
+
+
+def zipf_probabilities(size: int, exponent: float = 1.1) -> np.ndarray:
+    """
+    Probability of drawing each word of the vocabulary.
+    """
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def make_legislators(rng: np.random.Generator, count: int = 2000) -> List[tuple]:
+    """
+    (loc_id, name, full_name, chamber, party) for a pool of legislators.
+    """
+    legislators = []
+    for i in range(count):
+        chamber = 'House' if rng.random() < 0.8 else 'Senate'
+        party = PARTIES[rng.choice(3, p=[0.49, 0.49, 0.02])]
+        name = f'Member{i}'
+        legislators.append((f'M{i:06d}', name, f'Rep. {name} [{party}]' if chamber == 'House' else f'Sen. {name} [{party}]', chamber, party))
+    return legislators
+
+
+def create_schema(conn: sqlite3.Connection) -> None:
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def build_bm25_index(conn: sqlite3.Connection) -> None:
+    """
+    (Re)build the congress_bm25 full text index from the bills and their summaries.
+    """
+    conn.execute('drop table if exists congress_bm25')
+    conn.execute("""
+        create virtual table congress_bm25 using fts5(
+            summary_text, title, text, ft_id UNINDEXED, tokenize='porter'
+        )
+    """)
+    conn.execute("""
+        insert into congress_bm25 (summary_text, title, text, ft_id)
+        select coalesce(bs.summary_text, ''), ft.title, ft.text, ft.id
+        from full_texts ft left join bill_summaries bs on ft.summaries_match = bs.id
+    """)
+    conn.commit()
+
+
+def build_indexes(conn: sqlite3.Connection) -> None:
+    """
+    (Re)build the B-tree indexes that the search engine relies on.
+    """
+    conn.execute('drop index if exists idx_bert_embeddings_full_text_id')
+    conn.execute('drop index if exists idx_full_texts_file_chamber')
+    conn.execute('drop index if exists idx_sponsors_bill_sponsored')
+    conn.execute('create index idx_bert_embeddings_full_text_id on bert_embeddings(full_text_id)')
+    conn.execute('create index idx_full_texts_file_chamber on full_texts(file_chamber)')
+    conn.execute('create index idx_sponsors_bill_sponsored on sponsors(bill_sponsored)')
+    conn.commit()
+
+
+def write_embeddings(conn: sqlite3.Connection, encoder, ids: List[int] = None, batch_size: int = 64, table: str = 'bert_embeddings') -> int:
+    """
+    Embed the passages of the given bills (or all bills) with the encoder and store them as pickled float32
+    arrays, as the precompute step does. Returns the number of passages written.
+    """
+    query = PASSAGES_QUERY
+    params = ()
+    if ids is not None:
+        query = query + f" where id in ({','.join('?' * len(ids))})"
+        params = tuple(ids)
+
+    written = 0
+    cur = conn.execute(query, params)
+    while True:
+        rows = cur.fetchmany(max(1, batch_size // PASSAGES_PER_BILL))
+        if not rows:
+            break
+        passages = [(row[0], passage) for row in rows for passage in row[1:]]
+        embeddings = encoder.encode([passage for _, passage in passages]).astype(np.float32)
+        conn.executemany(
+            f"insert into {table} (full_text_id, embedding, embedding_blob) values (?, '', ?)",
+            [(full_text_id, pickle.dumps(embedding)) for (full_text_id, _), embedding in zip(passages, embeddings)]
+        )
+        written += len(passages)
+    conn.commit()
+    return written
+
+
+def write_random_embeddings(conn: sqlite3.Connection, rng: np.random.Generator, bills: int, dimension: int) -> None:
+    """
+    Store random embeddings for every bill. Much faster than encoding, and fine when only timing matters.
+    """
+    for start in range(1, bills + 1, INSERT_BATCH_SIZE):
+        ids = np.arange(start, min(start + INSERT_BATCH_SIZE, bills + 1))
+        vectors = rng.standard_normal((len(ids) * PASSAGES_PER_BILL, dimension), dtype=np.float32)
+        full_text_ids = np.repeat(ids, PASSAGES_PER_BILL)
+        conn.executemany(
+            "insert into bert_embeddings (full_text_id, embedding, embedding_blob) values (?, '', ?)",
+            [(int(full_text_id), pickle.dumps(vector)) for full_text_id, vector in zip(full_text_ids, vectors)]
+        )
+        conn.commit()
+
+
+def write_bills(
+    conn: sqlite3.Connection,
+    rng: np.random.Generator,
+    bills: int,
+    vocabulary: np.ndarray,
+    words_per_bill: int,
+    summary_share: float
+) -> None:
+    """
+    Insert the bills, their summaries and their sponsors.
+    """
+    probabilities = zipf_probabilities(len(vocabulary))
+    legislators = make_legislators(rng)
+    type_shares = np.array([share for *_, share in BILL_TYPES])
+    type_shares = type_shares / type_shares.sum()
+    bill_numbers = {}
+
+    for start in range(1, bills + 1, INSERT_BATCH_SIZE):
+        ids = range(start, min(start + INSERT_BATCH_SIZE, bills + 1))
+        lengths = np.maximum(20, rng.poisson(words_per_bill, len(ids)))
+        words = vocabulary[rng.choice(len(vocabulary), size=int(lengths.sum()), p=probabilities)]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        full_texts, summaries, sponsors = [], [], []
+        for i, id in enumerate(ids):
+            text_words = words[offsets[i] : offsets[i + 1]]
+            text = ' '.join(text_words)
+            title = 'To ' + ' '.join(text_words[:8]) + ', and for other purposes.'
+
+            file_chamber, publisher, legis_type, _ = BILL_TYPES[rng.choice(len(BILL_TYPES), p=type_shares)]
+            congress = int(rng.integers(FIRST_CONGRESS, LAST_CONGRESS + 1))
+            session = int(rng.integers(1, 3))
+            year = 1789 + 2 * (congress - 1) + session - 1
+            date = f'{year}-{int(rng.integers(1, 13)):02d}-{int(rng.integers(1, 29)):02d}'
+            number = bill_numbers[(congress, file_chamber)] = bill_numbers.get((congress, file_chamber), 0) + 1
+
+            bill_sponsors = [legislators[j] for j in rng.choice(len(legislators), size=1 + rng.poisson(3), replace=False)]
+            multiple_parties = int(len({s[4] for s in bill_sponsors}) > 1)
+            sponsors.extend(s + (id,) for s in bill_sponsors)
+
+            summaries_match = None
+            if rng.random() < summary_share:
+                summaries_match = id
+                summaries.append((id, ' '.join(text_words[: min(60, len(text_words))])))
+
+            full_texts.append((
+                id, text, title, title.upper(), len(text_words) // 135 + 1, multiple_parties,
+                f'https://www.congress.gov/bill/{congress}th-congress/{file_chamber}/{number}',
+                STAGES[int(rng.integers(len(STAGES)))], number, file_chamber, congress, date, legis_type,
+                COMMITTEES[int(rng.integers(len(COMMITTEES)))], publisher, publisher, session, summaries_match
+            ))
+
+        conn.executemany(f"insert into full_texts values ({','.join('?' * 18)})", full_texts)
+        conn.executemany('insert into bill_summaries values (?, ?)', summaries)
+        conn.executemany('insert into sponsors values (?, ?, ?, ?, ?, ?)', sponsors)
+        conn.commit()
+
+
+def generate(
+    path: str,
+    bills: int,
+    seed: int = 0,
+    words_per_bill: int = 400,
+    vocabulary_size: int = 20000,
+    summary_share: float = 0.7,
+    embeddings: str = 'random',
+    embedding_dimension: int = MODEL_DIMENSIONS[LEGAL_BERT_PATH]
+) -> Dict[str, float]:
+    """
+    Write a synthetic database to path, replacing any existing file. Embeddings are 'random' vectors, or 'hashing'
+    to embed the passages with the HashingEncoder so that reranking orders results meaningfully.
+    Returns the seconds spent in each step.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.Connection(path)
+    conn.execute('pragma journal_mode = off')
+    conn.execute('pragma synchronous = off')
+    create_schema(conn)
+
+    timings = {}
+    start = time.perf_counter()
+    write_bills(conn, rng, bills, make_vocabulary(vocabulary_size), words_per_bill, summary_share)
+    timings['bills'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if embeddings == 'hashing':
+        from encoders import HashingEncoder
+        write_embeddings(conn, HashingEncoder(LEGAL_BERT_PATH, embedding_dimension))
+    elif embeddings == 'random':
+        write_random_embeddings(conn, rng, bills, embedding_dimension)
+    else:
+        raise ValueError(f'Unrecognized embeddings option: {embeddings}')
+    timings['embeddings'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_bm25_index(conn)
+    timings['bm25_index'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_indexes(conn)
+    timings['indexes'] = time.perf_counter() - start
+
+    conn.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bills', type=parse_scale, default='10k', help='Number of bills, such as 10k or 1m.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='Defaults to a file under benchmarks/data.')
+    parser.add_argument('--words-per-bill', type=int, default=400)
+    parser.add_argument('--vocabulary-size', type=int, default=20000)
+    parser.add_argument('--embeddings', default='random', choices=['random', 'hashing'])
+    args = parser.parse_args()
+
+    path = args.out or default_path(args.bills, args.seed)
+    timings = generate(
+        path, args.bills, args.seed, args.words_per_bill, args.vocabulary_size, embeddings=args.embeddings
+    )
+    print(f'Wrote {args.bills} bills to {path} ({os.path.getsize(path) / 1e6:.1f} MB)')
+    for step, seconds in timings.items():
+        print(f'  {step}: {seconds:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Split the congress-data database into shards by Congress, for sharded search. Each shard is a complete database
+with the bills of its Congresses, their summaries, sponsors and embeddings, and its own congress_bm25 index.
+
+    python build_shards.py --ranges 93-100 101-108 109-113 114-118 --out ./shards
+    python build_shards.py --congresses-per-shard 4 --out ./shards
+
+Set SEARCH_SHARD_MANIFEST to the manifest.json written in the output directory to have the web app search the
+shards. Metadata stores and compressed embeddings for the shards go in one subdirectory per shard name, under
+METADATA_STORE_DIR and COMPRESSED_EMBEDDINGS_DIR.
+"""
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os
+import sqlite3
+import time
+from search_engine import SearchEngine
+
+
+# Tables copied into every shard, with the column that ties each row to a bill in full_texts.
+TABLES = [
+    ('full_texts', 'id'),
+    ('bill_summaries', None),
+    ('sponsors', 'bill_sponsored'),
+    ('bert_embeddings', 'full_text_id')
+]
+
+
+def parse_ranges(values: List[str]) -> List[Tuple[int, int]]:
+    """
+    Congress ranges from arguments such as '93-100' or '118'.
+    """
+    ranges = []
+    for value in values:
+        first, _, last = value.partition('-')
+        ranges.append((int(first), int(last or first)))
+    return sorted(ranges)
+
+
+def congress_ranges(conn: sqlite3.Connection, per_shard: int) -> List[Tuple[int, int]]:
+    """
+    Consecutive ranges of per_shard Congresses covering every Congress in the database.
+    """
+    first, last = conn.execute('select min(file_congress), max(file_congress) from full_texts').fetchone()
+    return [(start, min(start + per_shard - 1, last)) for start in range(first, last + 1, per_shard)]
+
+
+def shard_name(first: int, last: int) -> str:
+    return f'congress_{first}' if first == last else f'congress_{first}-{last}'
+
+
+def build_shard(source: str, path: str, first: int, last: int) -> Dict:
+    """
+    Write the bills of Congresses first to last, and everything that refers to them, to a new database.
+    Returns the shard's manifest entry.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.Connection(path)
+    conn.execute('attach database ? as source', (source,))
+
+    schema = dict(conn.execute("select name, sql from source.sqlite_master where type = 'table'").fetchall())
+    for table, _ in TABLES:
+        conn.execute(schema[table])
+
+    conn.execute(
+        'insert into full_texts select * from source.full_texts where file_congress between ? and ?', (first, last)
+    )
+    conn.execute("""
+        insert into bill_summaries
+        select * from source.bill_summaries where id in (select summaries_match from full_texts)
+    """)
+    for table, column in TABLES[2:]:
+        conn.execute(f'insert into {table} select * from source.{table} where {column} in (select id from full_texts)')
+
+    # The full text index is created from its original statement and filled through the fts5 interface, so that
+    # the shard gets its own term statistics
+    conn.execute(schema['congress_bm25'])
+    conn.execute("""
+        insert into congress_bm25 (summary_text, title, text, ft_id)
+        select summary_text, title, text, ft_id from source.congress_bm25
+        where ft_id in (select id from full_texts)
+    """)
+
+    for sql, in conn.execute("select sql from source.sqlite_master where type = 'index' and sql is not null").fetchall():
+        conn.execute(sql)
+
+    bills, start_date, end_date = conn.execute(
+        'select count(*), min(substr(date, 1, 10)), max(substr(date, 1, 10)) from full_texts'
+    ).fetchone()
+    conn.commit()
+    conn.execute('detach database source')
+    conn.execute('vacuum')
+    conn.close()
+
+    return {
+        'name': shard_name(first, last),
+        'path': os.path.basename(path),
+        'first_congress': first,
+        'last_congress': last,
+        'start_date': start_date,
+        'end_date': end_date,
+        'bills': bills
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=SearchEngine.DATABASE_PATH)
+    parser.add_argument('--out', default='./shards', help='Directory to write the shards and manifest.json to.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--ranges', nargs='+', help='Congresses of each shard, such as 93-100.')
+    group.add_argument('--congresses-per-shard', type=int, help='Split every Congress in the database evenly.')
+    args = parser.parse_args()
+
+    conn = sqlite3.Connection(args.db)
+    ranges = parse_ranges(args.ranges) if args.ranges else congress_ranges(conn, args.congresses_per_shard)
+    total = conn.execute('select count(*) from full_texts').fetchone()[0]
+    conn.close()
+
+    os.makedirs(args.out, exist_ok=True)
+    shards = []
+    for first, last in ranges:
+        start = time.perf_counter()
+        path = os.path.join(args.out, f'congress-data_{SearchEngine.DATABASE_VERSION}_{shard_name(first, last)}.db')
+        shards.append(build_shard(args.db, path, first, last))
+        print(f'{shards[-1]["name"]}: {shards[-1]["bills"]} bills in {time.perf_counter() - start:.1f}s')
+
+    with open(os.path.join(args.out, 'manifest.json'), 'w') as f:
+        json.dump({'database_version': SearchEngine.DATABASE_VERSION, 'shards': shards}, f, indent=2)
+
+    missing = total - sum(shard['bills'] for shard in shards)
+    if missing > 0:
+        print(f'Warning: {missing} bills are outside every range and are not in any shard.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from typing import List
+import functools
+import re
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+from nltk.tokenize import word_tokenize
+
+
+# Title for chats whose first prompt has no keywords.
+DEFAULT_TITLE = 'New Chat'
+
+# Most keywords in a title, and most characters.
+MAX_TITLE_WORDS = 6
+MAX_TITLE_LENGTH = 60
+
+# Words that ask for something rather than say what it is about, on top of the English stopwords.
+REQUEST_WORDS = {
+    'give', 'show', 'find', 'tell', 'list', 'search', 'look', 'looking', 'want', 'need', 'please', 'know',
+    'like', 'help', 'get', 'us', 'anything', 'something', 'related', 'regarding', 'information', 'could', 'would',
+    'can', 'hi', 'hello', 'thanks'
+}
+
+# Words that say what kind of document is wanted rather than what it is about. They go at the end of titles.
+DOCUMENT_WORDS = {'bill', 'bills', 'legislation', 'laws', 'resolution', 'resolutions'}
+
+_stemmer = PorterStemmer()
+
+
+@functools.lru_cache(maxsize=1)
+def _stop_words() -> frozenset:
+    return frozenset(stopwords.words('english')) | REQUEST_WORDS
+
+
+def keywords(prompt: str) -> List[str]:
+    """
+    The words of a prompt that say what it is about, in order, with stopwords and request words removed and
+    only the first of several words with the same stem kept.
+    """
+    stop_words = _stop_words()
+    seen_stems = set()
+    words = []
+    for token in word_tokenize(prompt):
+        if not re.fullmatch(r"[\w][\w'\-.]*", token) or token.lower() in stop_words:
+            continue
+        stem = _stemmer.stem(token)
+        if stem in seen_stems:
+            continue
+        seen_stems.add(stem)
+        words.append(token)
+    return words
+
+
+def local_title(prompt: str) -> str:
+    """
+    A title made of the first keywords of a chat's first prompt, such as "Climate Change Bills" for "Give me bills
+    on climate change". Words written in capitals, like acronyms, are kept as they are.
+    """
+    words = keywords(prompt)
+    words = [w for w in words if w.lower() not in DOCUMENT_WORDS] + [w for w in words if w.lower() in DOCUMENT_WORDS]
+    words = [word if word.isupper() else word.capitalize() for word in words[:MAX_TITLE_WORDS]]
+    title = ' '.join(words)
+    if len(title) > MAX_TITLE_LENGTH:
+        title = title[:MAX_TITLE_LENGTH].rsplit(' ', 1)[0]
+    return title or DEFAULT_TITLE
@@ -0,0 +1,63 @@
+from typing import Dict
+import asyncio
+import weakref
+import httpx
+from openai import AsyncOpenAI
+from decouple import config
+
+
+# Timeout in seconds for requests to Supabase.
+SUPABASE_TIMEOUT = 30
+
+# Async clients are bound to the event loop that created them, so keep one per loop.
+_http_clients = weakref.WeakKeyDictionary()
+_openai_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the pooled async HTTP client for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=SUPABASE_TIMEOUT)
+        _http_clients[loop] = client
+    return client
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Get the async OpenAI client for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _openai_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=config("OPENAI_API_KEY"))
+        _openai_clients[loop] = client
+    return client
+
+
+async def close_clients() -> None:
+    """
+    Close the async clients owned by the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    http_client = _http_clients.pop(loop, None)
+    if http_client is not None:
+        await http_client.aclose()
+    openai_client = _openai_clients.pop(loop, None)
+    if openai_client is not None:
+        await openai_client.close()
+
+
+def supabase_headers(access_token: str) -> Dict[str, str]:
+    """
+    Headers for authenticating with the Supabase REST API on behalf of a user.
+    """
+    key: str = config("VITE_SUPABASE_KEY")
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+        "apikey": key
+    }
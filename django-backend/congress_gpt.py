@@ -1,14 +1,27 @@
 import numpy as np
-from typing import List, Dict, Optional, Dict, Any
+from typing import AsyncIterator, List, Dict, Optional, Dict, Any, Tuple
 import os
 import time
 import datetime
 import json
-from openai import OpenAI
+import asyncio
+import contextvars
+import logging
 import openai
-import requests
-import threading
 from search_engine import SearchEngine
+from background_tasks import QueueFullError
+from admission import OverloadedError
+from clients import get_http_client, get_openai_client, supabase_headers
+from context_builder import EARLIER_SEARCH_RESULTS_BUDGET, MAX_CONTEXT_MESSAGES, RECENT_SEARCH_RESULTS_BUDGET
+from tracing import span
+from deadlines import DeadlineExceeded, OPENAI_BUDGET, SEARCH_BUDGET, SUPABASE_BUDGET
+import deadlines
+from chat_titles import local_title
+from records import Message
+from search_results import (
+    compact_full_text_results, compact_summary_results, format_results_for_display,
+    hydrate_results, parse_compact_results, serialize_results_for_llm
+)
 from dotenv import load_dotenv
 from decouple import config
 from django.apps import apps
@@ -21,23 +34,90 @@ DEFAULT_LANGUAGE_MODEL = 'gpt-4-1106-preview'
 # Language model for generating titles.
 TITLE_LANGUAGE_MODEL = 'gpt-3.5-turbo-1106'
 
+# How new chats get their titles: 'local' builds one from the keywords of the first prompt when the chat is
+# created, and 'llm' asks TITLE_LANGUAGE_MODEL for one afterwards.
+CHAT_TITLE_MODE = config("CHAT_TITLE_MODE", default='local')
+if CHAT_TITLE_MODE not in ['local', 'llm']:
+    raise ValueError(f'Unrecognized CHAT_TITLE_MODE: {CHAT_TITLE_MODE}')
+
+# Number of times a failed background write to Supabase is retried.
+WRITE_RETRIES = 3
+
+# Rounds of searches the agent endpoint runs in one turn before GPT has to answer.
+AGENT_MAX_STEPS = 3
+
+# Most time in seconds spent embedding an opening prompt for the semantic response cache, before asking GPT
+# without the cache.
+LLM_CACHE_EMBED_BUDGET = 2
+
+# Parameters of the search functions that GPT can call.
+SUMMARY_PARAMS = [
+    'query'
+]
+
+FULL_TEXT_PARAMS = [
+    'query', 'full_text_id'
+]
+
+# Search functions that GPT can call.
+SEARCH_FUNCTIONS = [
+    {
+        "name": "search_summaries",
+        "description": "Search for U.S. Congress bills.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "A search query that fits the user's request."
+                }
+            },
+            "required": SUMMARY_PARAMS
+        }
+    },
+    {
+        "name": "search_full_texts",
+        "description": "Search for specific passages within one U.S. Congress bill.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "A search query that fits the user's request."
+                },
+                "full_text_id": {
+                    "type": "integer",
+                    "description": "The id that identifies the requested bill."
+                }
+            },
+            "required": FULL_TEXT_PARAMS
+        }
+    }
+]
+
+# The search functions as tools, which GPT can call several of at once.
+SEARCH_TOOLS = [{"type": "function", "function": function} for function in SEARCH_FUNCTIONS]
+
+# Instructions for GPT once it has search results.
+SUMMARIZE_RESULTS_PROMPT = {
+    "role": "system", 
+    "content": """
+        Summarize the search results for the user. If the search results are not relevant, tell the user. Suggest ways to improve the search query, and ask the user if they want you to do another search.
+    """
+}
+
 app_config = apps.get_app_config('congressgpt')
 
+logger = logging.getLogger(__name__)
+
 
-def get_first_user_message(chat_id, access_token):
+async def get_first_user_message(chat_id, access_token):
     """
     Gets the first message in a given chat.
     """
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
     messages_endpoint = f"{url}/rest/v1/messages"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key
-    }
-
     params = {
         "chats_id": f"eq.{chat_id}",
         "role": "eq.user", 
@@ -45,7 +125,10 @@ def get_first_user_message(chat_id, access_token):
         "limit": "1"  
     }
 
-    response = requests.get(messages_endpoint, headers=headers, params=params)
+    response = await get_http_client().get(
+        messages_endpoint, headers=supabase_headers(access_token), params=params,
+        timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+    )
 
     if response.status_code == 200:
         data = response.json()
@@ -56,31 +139,25 @@ def get_first_user_message(chat_id, access_token):
     else:
         return None
     
-def post_chat_title(title: str, access_token: str, chat_id: int) -> None:
+async def post_chat_title(title: str, access_token: str, chat_id: int) -> None:
     """
     POST chat title to Supabase.
     """
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key  
-    }
-
     payload = {
         'chat_title': title
     }
 
-    response = requests.patch(
+    response = await get_http_client().patch(
         f"{url}/rest/v1/chats?id=eq.{chat_id}",
-        headers=headers,
-        json=payload
+        headers=supabase_headers(access_token),
+        json=payload,
+        timeout=deadlines.timeout('chat.supabase_write', SUPABASE_BUDGET)
     )
 
 
-def generate_chat_title(message, access_token, chat_id):
+async def generate_chat_title(message, access_token, chat_id):
     """
     Create a title for a new chat using GPT.
     """
@@ -91,107 +168,78 @@ def generate_chat_title(message, access_token, chat_id):
     ]
 
     # Chat completion
-    openai_client = app_config.openai_client
-    response = openai_client.chat.completions.create(
+    openai_client = get_openai_client()
+    response = await openai_client.chat.completions.create(
         model=TITLE_LANGUAGE_MODEL,  # Replace with your chosen model
         messages=messages,
-        max_tokens=100  # Adjust as needed
+        max_tokens=100,  # Adjust as needed
+        timeout=deadlines.timeout('chat.title', OPENAI_BUDGET)
     )
 
     # Extracting the title from the response
     title = response.choices[0].message.content.strip()
 
     # Add the new chat title to the database
-    post_chat_title(title, access_token, chat_id)
+    await post_chat_title(title, access_token, chat_id)
 
-def get_title_for_chats(chats_id, access_token):
+async def get_title_for_chats(chats_id, access_token):
     """
     Gets title for a chat.
     """
-    chat_titles = []
-
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
+    headers = supabase_headers(access_token)
+    http_client = get_http_client()
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key
-    }
-
-    for chat_id in chats_id:
+    async def get_title(chat_id):
         params = {
             "select": "chat_title",
             "id": f"eq.{chat_id}"  
         }
 
-        response = requests.get(f"{url}/rest/v1/chats", headers=headers, params=params)
+        response = await http_client.get(
+            f"{url}/rest/v1/chats", headers=headers, params=params,
+            timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+        )
 
         if response.status_code == 200:
             chat_data = response.json()
             if chat_data:
                 chat_title = chat_data[0].get('chat_title')
-                chat_titles.append({"chat_id": chat_id, "title": chat_title})
-            else:
-                chat_titles.append({"chat_id": chat_id, "title": None})
-        else:
-            chat_titles.append({"chat_id": chat_id, "title": None})
+                return {"chat_id": chat_id, "title": chat_title}
+        return {"chat_id": chat_id, "title": None}
 
-    return chat_titles
+    # Fetch all titles concurrently rather than one round trip at a time
+    return list(await asyncio.gather(*[get_title(chat_id) for chat_id in chats_id]))
 
 
-def post_new_message(access_token, language_model, messages: List[Dict]):
+async def post_new_message(access_token, language_model, messages: List[Message]):
     """
     Posts a list of messages to Supabase. 
-        messages = [{
-            "content": content,
-            "order_in_chat": order_in_chat, 
-            "role": role,
-            "chats_id": chat_id,
-            "search_request": search_request,
-            "search_response": search_response,
-            "created_at": created_at,
-            "search_full_text_id": search_full_text_id,
-            "function_invoked": function_invoked
-        }]
-    """
-    key: str = config("VITE_SUPABASE_KEY")
+    """
     url = config("VITE_SUPABASE_URL")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key  
-    }
-
-    for i in range(len(messages)):
-        messages[i]['language_model'] = language_model
-        if messages[i]['search_full_text_id'] is not None:
-            messages[i]['search_full_text_id'] = int(messages[i]['search_full_text_id'])
+    rows = [message.to_row(language_model) for message in messages]
 
-    response = requests.post(
-        f"{url}/rest/v1/messages",
-        headers=headers,
-        data=json.dumps(messages)  
-    )
+    with span('chat.supabase_write'):
+        response = await get_http_client().post(
+            f"{url}/rest/v1/messages",
+            headers=supabase_headers(access_token),
+            content=json.dumps(rows),
+            timeout=deadlines.timeout('chat.supabase_write', SUPABASE_BUDGET)
+        )
 
     # Check if the request was successful
     if response.status_code != 201:
         raise Exception("Failed to post chat message with status code:", response.status_code, response.text)
         
 
-def get_prior_chat_messages(access_token, chat_id) -> List[Dict]:
+async def get_prior_chat_messages(access_token, chat_id) -> List[Dict]:
     """
     Get all previous messages in the specified chat.
     """
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key
-    }
+    headers = supabase_headers(access_token)
     params = {
         "chats_id": f"eq.{chat_id}",
         "select": "role,content,search_request,created_at,search_response,order_in_chat,function_invoked,search_full_text_id"
@@ -202,11 +250,13 @@ def get_prior_chat_messages(access_token, chat_id) -> List[Dict]:
     status_code = 200
     response_chat_size = 0
     while (retries_left and status_code == 200 and response_chat_size == 0):
-        response = requests.get(
-            f"{url}/rest/v1/messages",
-            headers=headers,
-            params=params
-        )
+        with span('chat.supabase_fetch'):
+            response = await get_http_client().get(
+                f"{url}/rest/v1/messages",
+                headers=headers,
+                params=params,
+                timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+            )
         retries_left -= 1
         status_code = response.status_code
         response_chat_size = len(response.json())
@@ -219,80 +269,231 @@ def get_prior_chat_messages(access_token, chat_id) -> List[Dict]:
         return []
 
 
-def ask_gpt(chat: List[Dict], language_model: str, system_prompts=[]) -> Dict: 
+async def queue_new_messages(access_token, language_model, messages: List[Message]) -> None:
     """
-    Generate GPT's next message in an ongoing chat.
+    Queue messages for a bulk write to Supabase in the background. If the background queue is full, the messages
+    are written before returning instead.
+    """
+    try:
+        app_config.background_executor.coalesce(
+            (access_token, language_model), messages, post_new_message, retries=WRITE_RETRIES
+        )
+    except QueueFullError:
+        await post_new_message(access_token, language_model, messages)
+
+
+async def run_search(function, *args):
+    """
+    Run search engine work on the search executor, since it is CPU-bound and would block the event loop.
+    The work runs in a copy of the current context, so that its stage timings are attributed to this request.
+    With admission control, raises OverloadedError instead of queueing when the search queue is full, and the
+    work is dropped if it waits in the queue past its deadline. Work given up on while still queued leaves the
+    queue at once.
+    The work gets SEARCH_BUDGET seconds within the request's deadline. If that passes, or the request is
+    abandoned, this raises at once, and the work stops at its next cancellation check.
+    """
+    with deadlines.stage(SEARCH_BUDGET) as deadline:
+        context = contextvars.copy_context()
+        function, args = context.run, (deadlines.call, 'search.queue', function, *args)
+        if app_config.admission is not None:
+            future = app_config.admission.submit(app_config.search_executor, function, *args)
+        else:
+            future = app_config.search_executor.submit(function, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline.remaining()))
+        except asyncio.TimeoutError:
+            deadline.cancel()
+            raise DeadlineExceeded('search')
+        except asyncio.CancelledError:
+            deadline.cancel()
+            raise
+
+
+def search_params(data: Dict, query: str) -> Dict[str, Any]:
+    """
+    Search engine params for a search request, with the defaults for anything the request leaves out.
+    """
+    return {
+        'number_to_return': data.get('number_to_return', 5),
+        'date_range': data.get('date_range', {
+            'start_year': 1970, 'start_month': 1, 'start_day': 1, 
+            'end_year': 2050, 'end_month': 12, 'end_day': 31
+        }),
+        'get_sponsors': data.get('get_sponsors', False),
+        'sponsor_aggregates': data.get('sponsor_aggregates', False),
+        'chamber': data.get('chamber', 'any'),  
+        'legislative_types': data.get('legislative_types', 'any'),
+        'require_bipartisan': data.get('require_bipartisan', False),
+        'query': query
+    }
+
+
+def execute_search(function_invoked: str, params: Dict[str, Any], full_text_id: Optional[int]) -> List:
+    """
+    Run the search engine function that GPT called. Full text results carry the index of each passage.
     """
     search_engine = app_config.search_engine
+    if function_invoked == 'search_summaries':
+        return search_engine.retrieve_summary(params)
+    elif function_invoked == 'search_full_texts':
+        return search_engine.retrieve_full_text_chunks(params, full_text_id, True)
+    raise ValueError('Unrecognized search function invoked.')
+
+
+def speculative_search_request(function_invoked: str, params: Dict[str, Any], full_text_id) -> Dict[str, Any]:
+    """
+    Everything that decides the results of a search, for matching a follow-up request to a speculative search.
+    """
+    return {
+        'function_invoked': function_invoked,
+        'params': json.dumps(params, sort_keys=True),
+        'full_text_id': int(full_text_id) if full_text_id is not None else None
+    }
+
+
+def start_speculative_search(chat_id: int, order_in_chat: int, message: Dict) -> None:
+    """
+    Start the search that GPT asked for in message, for the frontend's follow-up search request to collect.
+    The follow-up request does not send search params, so the search uses the defaults.
+    """
+    params = search_params({}, message['content'])
+    full_text_id = message['search_full_text_id']
+    app_config.speculative_searches.start(
+        (int(chat_id), order_in_chat),
+        speculative_search_request(message['function_invoked'], params, full_text_id),
+        execute_search, message['function_invoked'], dict(params), full_text_id
+    )
+
 
+async def collect_search(chat_id, order_in_chat: int, function_invoked: str, params: Dict[str, Any], full_text_id) -> List:
+    """
+    Results of the search requested at order_in_chat, from the speculative search if one was started for the
+    same search, and otherwise by running it now. Waiting for a speculative search gets the same budget as
+    running one, and the speculative search is cancelled if this request gives up on it. One that was dropped
+    from the search queue, or ran out of time, is run again for this request.
+    """
+    search = None
+    if app_config.speculative_searches is not None:
+        search = app_config.speculative_searches.take(
+            (int(chat_id), order_in_chat), speculative_search_request(function_invoked, params, full_text_id)
+        )
+    if search is not None:
+        timeout = deadlines.timeout('search.speculative', SEARCH_BUDGET)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(search.future), timeout)
+        except asyncio.TimeoutError:
+            search.cancel()
+            raise DeadlineExceeded('search')
+        except asyncio.CancelledError:
+            search.cancel()
+            raise
+        except (OverloadedError, DeadlineExceeded):
+            pass
+    return await run_search(execute_search, function_invoked, params, full_text_id)
+
+
+def present_search_results(function_invoked: str, results: List, full_text_id, max_tokens: int) -> Tuple[str, str, str]:
+    """
+    Search results as stored in Supabase, as displayed by the frontend, and as shown to GPT.
+    Only ids, ranks and scores are stored. They are looked up again when the chat is displayed.
+    """
+    database_version = app_config.search_engine.DATABASE_VERSION
+    if function_invoked == 'search_summaries':
+        stored_results = compact_summary_results(results, database_version)
+    else:
+        stored_results = compact_full_text_results(results, full_text_id, database_version)
+        results = [(chunk, score) for chunk, score, _ in results]
+    return (
+        stored_results,
+        format_results_for_display(results),
+        serialize_results_for_llm(results, function_invoked, max_tokens)
+    )
+
+
+async def hydrate_stored_results(content: str, record: Dict[str, Any]) -> List:
+    """
+    Full search results for a stored record, from the cache of hydrated results if they are there. Looking up
+    stored results by id is cheap, and a chat cannot be shown or continued without them, so the lookup runs on
+    a thread of its own instead of going through admission control and waiting behind searches.
+    """
+    results = app_config.hydrated_results.get(content)
+    if results is None:
+        results = await asyncio.to_thread(hydrate_results, record, app_config.search_engine)
+        app_config.hydrated_results.put(content, results)
+    return results
+
+
+async def search_results_for_llm(content: str, max_tokens: int = RECENT_SEARCH_RESULTS_BUDGET) -> str:
+    """
+    Expand stored search results into the compact text shown to GPT. Other content is returned unchanged.
+    """
+    record = parse_compact_results(content)
+    if record is None:
+        return content
+    results = await hydrate_stored_results(content, record)
+    return serialize_results_for_llm(results, record['function'], max_tokens)
+
+
+async def search_results_for_display(content: str) -> str:
+    """
+    Expand stored search results into the text displayed by the frontend. Other content is returned unchanged.
+    """
+    record = parse_compact_results(content)
+    if record is None:
+        return content
+    results = await hydrate_stored_results(content, record)
+    return format_results_for_display(results)
+
+
+async def prepare_chat(chat: List[Dict], language_model: str, system_prompts=[]) -> List[Dict]:
+    """
+    Turn a chat into the messages sent to GPT: search results are looked up again and the most recent messages
+    are packed into the model's token budget.
+    """
     # Ensure the chat is presented in chronological order
     chat = list(sorted(chat, key=lambda x: x['order_in_chat']))
 
-    # Truncate chat if it is greater than 15 messages
-    chat = chat[-15:]
+    # Messages beyond this point could never fit in the context
+    chat = chat[-MAX_CONTEXT_MESSAGES:]
 
-    for i, message in enumerate(chat):
-        message.pop('search_request', None)
-        message.pop('created_at', None)
-        message.pop('order_in_chat', None)
-        message.pop('search_response', None)
-        message.pop('function_invoked', None)
-        message.pop('search_full_text_id', None)
-        
-        # Feed GPT prior chat history with stopwords removed if not most recent user message
-        if i != len(chat) - 1:
-            message['content'] = search_engine.remove_stopwords(message['content'])
-    
-    chat = chat + system_prompts
+    # Search results are stored as ids, so look them up again for GPT. Only the most recent results get a full budget.
+    search_responses = [message for message in chat if message.get('search_response')]
+    budgets = [EARLIER_SEARCH_RESULTS_BUDGET] * (len(search_responses) - 1) + [RECENT_SEARCH_RESULTS_BUDGET]
+    with span('chat.hydrate_search_results'):
+        contents = await asyncio.gather(*[
+            search_results_for_llm(message['content'], budget) for message, budget in zip(search_responses, budgets)
+        ])
+    for message, content in zip(search_responses, contents):
+        message['content'] = content
 
-    summary_params = [
-        'query'
-    ]
+    # Pack the most recent messages into the model's token budget
+    with span('chat.build_context'):
+        return app_config.context_builder.build(chat, language_model, system_prompts)
 
-    full_text_params = [
-        'query', 'full_text_id'
-    ]
 
-    openai_client = app_config.openai_client
-    completion = openai_client.chat.completions.create(
-        model=language_model,
-        messages=chat,
-        functions=[
-            {
-                "name": "search_summaries",
-                "description": "Search for U.S. Congress bills.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "A search query that fits the user's request."
-                    }
-                    },
-                    "required": summary_params
-                }
-            },
-            {
-                "name": "search_full_texts",
-                "description": "Search for specific passages within one U.S. Congress bill.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "A search query that fits the user's request."
-                    },
-                    "full_text_id": {
-                        "type": "integer",
-                        "description": "The id that identifies the requested bill."
-                    }
-                    },
-                    "required": full_text_params
-                }
-            }
-        ],
-        timeout=60
-    )
+def parse_function_arguments(arguments: str) -> Tuple[str, Optional[int]]:
+    """
+    The search query and bill id in the arguments of a call to a search function.
+    """
+    args = json.loads(arguments)
+    chat_text = ', '.join([args[key] for key in SUMMARY_PARAMS if key in args])
+    return chat_text.lower(), args.get('full_text_id')
+
+
+async def ask_gpt(chat: List[Dict], language_model: str, system_prompts=[]) -> Dict: 
+    """
+    Generate GPT's next message in an ongoing chat.
+    """
+    chat = await prepare_chat(chat, language_model, system_prompts)
+
+    openai_client = get_openai_client()
+    with span('chat.openai'):
+        completion = await openai_client.chat.completions.create(
+            model=language_model,
+            messages=chat,
+            functions=SEARCH_FUNCTIONS,
+            timeout=deadlines.timeout('chat.openai', OPENAI_BUDGET)
+        )
 
     if len(completion.choices) > 1:
         raise Exception('OpenAI unexpectedly returned >1 completion choice.')
@@ -303,14 +504,8 @@ def ask_gpt(chat: List[Dict], language_model: str, system_prompts=[]) -> Dict:
     # Add back the stop token if stop was triggered
     if completion.choices[0].finish_reason == 'function_call':
         function_invoked = completion.choices[0].message.function_call.name
-
-        args = json.loads(completion.choices[0].message.function_call.arguments)
-        chat_text = ', '.join([args[key] for key in summary_params if key in args])
-        chat_text = chat_text.lower()
+        chat_text, ft_id = parse_function_arguments(completion.choices[0].message.function_call.arguments)
         search_request = True
-        
-        if 'full_text_id' in args:
-            ft_id = args['full_text_id']
 
     else:
         chat_text = completion.choices[0].message.content
@@ -326,7 +521,39 @@ def ask_gpt(chat: List[Dict], language_model: str, system_prompts=[]) -> Dict:
     }
 
 
-def extract_token(request: requests.Response): 
+async def ask_gpt_cached(chat: List[Dict], language_model: str, system_prompts=[]) -> Dict:
+    """
+    ask_gpt, answered from the semantic response cache if it is enabled and the chat is a single opening prompt.
+    Later turns depend on the whole chat, so they always go to GPT.
+    """
+    llm_cache = app_config.llm_cache
+    if llm_cache is None or len(chat) != 1 or system_prompts:
+        return await ask_gpt(chat, language_model, system_prompts)
+
+    # The cache only saves time, so a prompt that cannot be embedded in time, or at all, goes to GPT instead
+    # of failing the request. Embedding skips admission control, so that it never takes a search's place.
+    try:
+        with span('chat.llm_cache_lookup'):
+            embedding = await asyncio.wait_for(
+                asyncio.to_thread(llm_cache.embed, chat[0]['content']),
+                deadlines.timeout('chat.llm_cache_lookup', LLM_CACHE_EMBED_BUDGET)
+            )
+            cached = llm_cache.lookup(language_model, embedding)
+    except Exception:
+        logger.warning('Semantic response cache lookup failed, asking GPT instead.', exc_info=True)
+        return await ask_gpt(chat, language_model, system_prompts)
+    if cached is not None:
+        return cached
+
+    new_llm_message = await ask_gpt(chat, language_model, system_prompts)
+    try:
+        llm_cache.store(language_model, embedding, new_llm_message)
+    except Exception:
+        logger.warning('Failed to store a response in the semantic response cache.', exc_info=True)
+    return new_llm_message
+
+
+def extract_token(request): 
     """
     Extract JWT token from request.
 
@@ -358,49 +585,93 @@ def check_for_llm_loop(chat: List[Dict]) -> bool:
     return repeat_assistant_messages == LOOKBACK
     
 
-def start_new_chat(access_token) -> int:
+async def start_new_chat(access_token, title: str = None) -> int:
     """
-    Create a new chat in Supabase. Returns the id for the new chat, which should be returned to the frontend.
+    Create a new chat in Supabase, with its title if one is given. Returns the id for the new chat, which should be
+    returned to the frontend.
     """
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key  
+    # Have PostgREST return the inserted row, so the new id comes back in the same round trip
+    headers = supabase_headers(access_token)
+    headers['Prefer'] = 'return=representation'
+
+    params = {
+        "select": "id"
     }
     
     data = {
         'created_at': str(datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc))
     }
+    if title is not None:
+        data['chat_title'] = title
 
-    response = requests.post(
-        f"{url}/rest/v1/chats",
-        headers=headers,
-        data=json.dumps(data)  
-    )
-
-    params = {
-        "select": "id",
-        "order": "id.desc",
-        "limit": "1"
-    }
-
-    if response.status_code == 201:
-        select_response = requests.get(
+    with span('chat.supabase_create_chat'):
+        response = await get_http_client().post(
             f"{url}/rest/v1/chats",
             headers=headers,
-            params=params
+            params=params,
+            content=json.dumps(data),
+            timeout=deadlines.timeout('chat.supabase_create_chat', SUPABASE_BUDGET)
         )
-        new_chat_id = select_response.json()[0]['id']
 
-        return new_chat_id
+    if response.status_code == 201:
+        return response.json()[0]['id']
     else:
         raise Exception('Create new chat failed with status code:', response.status_code)
 
 
-def prompt(data, access_token):
+def local_chat_title(message: str) -> Optional[str]:
+    """
+    Title for a new chat to be created with, or None if it is generated by GPT once the chat exists.
+    """
+    if CHAT_TITLE_MODE == 'local':
+        return local_title(message)
+    return None
+
+
+def queue_chat_title(message: str, access_token, chat_id: int) -> None:
+    """
+    Generate a new chat's title in the background, if titles are generated by GPT. The title is cosmetic, so it is
+    dropped if the queue is full.
+    """
+    if CHAT_TITLE_MODE != 'llm':
+        return
+    try:
+        app_config.background_executor.submit(generate_chat_title, message, access_token, chat_id, retries=1)
+    except QueueFullError:
+        logger.warning('Skipped title generation for chat %s because the background queue is full.', chat_id)
+
+
+def llm_message_for_insert(new_llm_message: Dict, chat_id, order_in_chat: int) -> Message:
+    """
+    GPT's message, as returned by ask_gpt, as it is written to Supabase.
+    """
+    return Message(
+        content=new_llm_message['content'],
+        chats_id=chat_id,
+        order_in_chat=order_in_chat,
+        role=new_llm_message['role'],
+        search_request=new_llm_message['search_request'],
+        search_response=new_llm_message['search_response'],
+        search_full_text_id=new_llm_message['search_full_text_id'],
+        function_invoked=new_llm_message['function_invoked']
+    )
+
+
+async def start_new_chat_for_message(access_token, message: Message) -> int:
+    """
+    Create a new chat for its first message, and queue its title so that it does not wait on GPT. The message is
+    written with GPT's reply, so that a search request never reaches the database without the prompt before it.
+    Returns the id for the new chat.
+    """
+    chat_id = await start_new_chat(access_token, local_chat_title(message.content))
+    queue_chat_title(message.content, access_token, chat_id)
+    message.chats_id = chat_id
+    return chat_id
+
+
+async def prompt(data, access_token):
     """
     Returns the system's response to the user.
     """
@@ -410,14 +681,15 @@ def prompt(data, access_token):
     language_model = data.get('language_model', DEFAULT_LANGUAGE_MODEL)
 
     chat = []
+    new_chat = None
 
-    if chat_id is None:
-        chat_id = start_new_chat(access_token)
+    user_message_for_insert = Message(content=prompt, chats_id=chat_id, order_in_chat=order_in_chat, role='user')
 
-        # Generate chat title asynchronously
-        threading.Thread(target=generate_chat_title, args=(prompt, access_token, chat_id)).start()
+    if chat_id is None:
+        # A new chat has no history, so its creation can overlap with the call to GPT
+        new_chat = asyncio.create_task(start_new_chat_for_message(access_token, user_message_for_insert))
     else:  # Get the previous messages in the same chat
-        chat = get_prior_chat_messages(access_token, chat_id)
+        chat = await get_prior_chat_messages(access_token, chat_id)
 
     chat.append({
         'role': 'user', 
@@ -436,37 +708,27 @@ def prompt(data, access_token):
     # }]
     system_prompts=[]
 
-    new_llm_message = ask_gpt(chat, language_model, system_prompts)
+    if new_chat is None:
+        new_llm_message = await ask_gpt(chat, language_model, system_prompts)
+    else:
+        # Opening prompts repeat across users, so they may be answered from the cache
+        chat_id, new_llm_message = await asyncio.gather(new_chat, ask_gpt_cached(chat, language_model, system_prompts))
+
+    messages_for_insert = [user_message_for_insert, llm_message_for_insert(new_llm_message, chat_id, order_in_chat + 1)]
 
-    messages_for_insert = [
-        {
-            'content': prompt, 
-            'chats_id': chat_id, 
-            'order_in_chat': order_in_chat, 
-            'role': 'user', 
-            'search_request': False,
-            'search_response': False,
-            'search_full_text_id': None,
-            'function_invoked': None
-        },
-        {
-            'content': new_llm_message['content'],
-            'chats_id': chat_id,
-            'order_in_chat': order_in_chat + 1,
-            'role': new_llm_message['role'],
-            'search_request': new_llm_message['search_request'],
-            'search_response': new_llm_message['search_response'],
-            'search_full_text_id': new_llm_message['search_full_text_id'],
-            'function_invoked': new_llm_message['function_invoked']
-        }
-    ]
+    # The frontend follows up on a search request right away, so start the search now for the follow-up to collect
+    if new_llm_message['search_request'] and app_config.speculative_searches is not None:
+        start_speculative_search(chat_id, order_in_chat + 1, new_llm_message)
+
+    # Nothing is written for a request that ran out of time, since its client has stopped waiting
+    deadlines.check('chat.supabase_write')
 
     # The frontend will immediately follow up on a search request, so this cannot be done asynchronously
-    if messages_for_insert[-1]['search_request']:
-        post_new_message(access_token, language_model, messages_for_insert)
+    if messages_for_insert[-1].search_request:
+        await post_new_message(access_token, language_model, messages_for_insert)
     else:
         # Asynchronously POST the user's prompt and the LLM's response to the database
-        threading.Thread(target=post_new_message, args=(access_token, language_model, messages_for_insert)).start()
+        await queue_new_messages(access_token, language_model, messages_for_insert)
 
     return JsonResponse({
         'content': new_llm_message['content'],
@@ -478,27 +740,17 @@ def prompt(data, access_token):
     })
 
 
-def search_prompt(data, access_token, chat_id=None, language_model=DEFAULT_LANGUAGE_MODEL):    
+async def search_prompt(data, access_token, chat_id=None, language_model=DEFAULT_LANGUAGE_MODEL):    
     """
     Returns search engine results and associated GPT summarization. Throws an error if the most recent message in the chat
     was not flagged as a search request. 
     """
-    number_to_return = data.get('number_to_return', 5)
-    date_range = data.get('date_range', {
-        'start_year': 1970, 'start_month': 1, 'start_day': 1, 
-        'end_year': 2050, 'end_month': 12, 'end_day': 31
-    })
-    get_sponsors = data.get('get_sponsors', False)
-    chamber = data.get('chamber', 'any')
-    legislative_types = data.get('legislative_types', 'any')
-    require_bipartisan = data.get('require_bipartisan', False)
-    
     if chat_id is None:
         return JsonResponse({'error': 'chat_id required for search_engine endpoint'}, 400)
     
     chat = []
     # Get the previous messages in the same chat
-    chat = get_prior_chat_messages(access_token, chat_id)
+    chat = await get_prior_chat_messages(access_token, chat_id)
 
 
     chat = list(sorted(chat, key=lambda x: x['order_in_chat']))
@@ -509,73 +761,48 @@ def search_prompt(data, access_token, chat_id=None, language_model=DEFAULT_LANGU
     last_order_in_chat = chat[-1]['order_in_chat']
 
     # Get search engine response
-    params = {
-        'number_to_return': number_to_return,
-        'date_range': date_range,
-        'get_sponsors': get_sponsors,
-        'chamber': chamber,  
-        'legislative_types': legislative_types,
-        'require_bipartisan': require_bipartisan,
-        'query': search_query
-    }
+    params = search_params(data, search_query)
 
-    search_engine = app_config.search_engine
-    if chat[-1]['function_invoked'] == 'search_summaries':
-        results = search_engine.retrieve_summary(params)
-    elif chat[-1]['function_invoked'] == 'search_full_texts':
-        results = search_engine.retrieve_full_text_chunks(params, chat[-1]['search_full_text_id'])
-    else:
-        raise ValueError('Unrecognized search function invoked.')
+    function_invoked = chat[-1]['function_invoked']
+    full_text_id = chat[-1]['search_full_text_id']
+    with span('chat.search'):
+        results = await collect_search(chat_id, last_order_in_chat, function_invoked, params, full_text_id)
+
+    stored_results, displayed_results, llm_results = present_search_results(
+        function_invoked, results, full_text_id, RECENT_SEARCH_RESULTS_BUDGET
+    )
 
     chat.append({
         'role': 'assistant', 
-        'content': str(results), 
+        'content': llm_results, 
         'search_request': False, 
         'search_response': True, 
         'order_in_chat': last_order_in_chat + 1,
         'created_at': str(datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc))
     })
 
-    system_prompts = [{
-        "role": "system", 
-        "content": """
-            Summarize the search results for the user. If the search results are not relevant, tell the user. Suggest ways to improve the search query, and ask the user if they want you to do another search.
-        """
-    }]
+    system_prompts = [SUMMARIZE_RESULTS_PROMPT]
 
     if check_for_llm_loop(chat):
         return JsonResponse({'error', 'GPT repeated itself too many times.'}, 400)
     
-    new_llm_message = ask_gpt(chat, language_model, system_prompts)
+    new_llm_message = await ask_gpt(chat, language_model, system_prompts)
 
+    # Only ids, ranks and scores are stored. They are looked up again when the chat is displayed.
     messages_for_insert = [
-        {
-            'content': str(results), 
-            'chats_id': chat_id, 
-            'order_in_chat': last_order_in_chat + 1, 
-            'role': 'assistant', 
-            'search_request': False,
-            'search_response': True,
-            'search_full_text_id': None,
-            'function_invoked': None
-        },
-        {
-            'content': new_llm_message['content'],
-            'chats_id': chat_id,
-            'order_in_chat': last_order_in_chat + 2,
-            'role': new_llm_message['role'],
-            'search_request': new_llm_message['search_request'],
-            'search_response': new_llm_message['search_response'],
-            'search_full_text_id': new_llm_message['search_full_text_id'],
-            'function_invoked': new_llm_message['function_invoked']
-        }
+        Message(
+            content=stored_results, chats_id=chat_id, order_in_chat=last_order_in_chat + 1, role='assistant',
+            search_response=True
+        ),
+        llm_message_for_insert(new_llm_message, chat_id, last_order_in_chat + 2)
     ]
 
-    # Register the user's prompt and the LLM's response in the database
-    threading.Thread(target=post_new_message, args=(access_token, language_model, messages_for_insert)).start()
+    # Register the user's prompt and the LLM's response in the database, unless the client has stopped waiting
+    deadlines.check('chat.supabase_write')
+    await queue_new_messages(access_token, language_model, messages_for_insert)
 
     return [{
-        'content': str(results), 
+        'content': displayed_results, 
         'chats_id': chat_id, 
         'order_in_chat': last_order_in_chat + 1, 
         'role': 'assistant', 
@@ -592,25 +819,135 @@ def search_prompt(data, access_token, chat_id=None, language_model=DEFAULT_LANGU
     }]
 
 
+async def agent_turn(data, access_token) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Run a whole turn of the chat in one request: GPT's searches are run here as soon as it asks for them, and
+    GPT is called again with their results, until it answers or AGENT_MAX_STEPS rounds of searches have run.
+    GPT may ask for several searches at once, and they run in parallel. Yields (event, message) pairs as the
+    turn progresses: 'chat' once the chat id is known, 'search_request' and 'search_response' for each search,
+    'message' for GPT's answer and 'done' at the end. Every message of the turn is written to Supabase at once.
+    """
+    prompt = data.get('prompt')
+    chat_id = data.get('chat_id', None)
+    order_in_chat = int(data.get('order_in_chat', 0))
+    language_model = data.get('language_model', DEFAULT_LANGUAGE_MODEL)
+
+    chat = []
+    new_chat = None
+    if chat_id is None:
+        # A new chat has no history, so its creation can overlap with the call to GPT
+        new_chat = asyncio.create_task(start_new_chat(access_token, local_chat_title(prompt)))
+    else:
+        chat = await get_prior_chat_messages(access_token, chat_id)
+
+    chat.append({
+        'role': 'user', 
+        'content': prompt,
+        'search_request': False, 
+        'search_response': False,
+        'order_in_chat': order_in_chat,
+        'created_at': str(datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc))
+    })
+    messages_for_insert = [Message(content=prompt, chats_id=chat_id, order_in_chat=order_in_chat, role='user')]
+
+    history = await prepare_chat(chat, language_model)
+    # Tool calls and results of this turn, in the form GPT expects them
+    turn = []
+    position = order_in_chat
+    openai_client = get_openai_client()
+
+    for step in range(AGENT_MAX_STEPS + 1):
+        messages = history + ([SUMMARIZE_RESULTS_PROMPT] if turn else []) + turn
+        with span('chat.openai'):
+            completion = await openai_client.chat.completions.create(
+                model=language_model,
+                messages=messages,
+                tools=SEARCH_TOOLS,
+                # Once the searches are used up, GPT has to answer
+                tool_choice='none' if step == AGENT_MAX_STEPS else 'auto',
+                timeout=deadlines.timeout('chat.openai', OPENAI_BUDGET)
+            )
+
+        if new_chat is not None:
+            chat_id = await new_chat
+            new_chat = None
+            queue_chat_title(prompt, access_token, chat_id)
+            messages_for_insert[0].chats_id = chat_id
+            yield 'chat', {'chats_id': chat_id, 'order_in_chat': order_in_chat}
+
+        message = completion.choices[0].message
+        if not message.tool_calls:
+            break
+
+        calls = []
+        for i, tool_call in enumerate(message.tool_calls):
+            query, full_text_id = parse_function_arguments(tool_call.function.arguments)
+            # Each search is stored as its request followed by its results
+            request_position = position + 2 * i + 1
+            request = Message(
+                content=query, chats_id=chat_id, order_in_chat=request_position, role='assistant',
+                search_request=True, search_full_text_id=full_text_id, function_invoked=tool_call.function.name
+            )
+            messages_for_insert.append(request)
+            calls.append((tool_call, request))
+            yield 'search_request', request.to_dict()
+        position += 2 * len(calls)
+
+        with span('chat.search'):
+            results = await asyncio.gather(*[
+                run_search(execute_search, request.function_invoked, search_params(data, request.content), request.search_full_text_id)
+                for _, request in calls
+            ])
+
+        turn.append({
+            'role': 'assistant',
+            'content': message.content,
+            'tool_calls': [
+                {'id': tool_call.id, 'type': 'function', 'function': {'name': tool_call.function.name, 'arguments': tool_call.function.arguments}}
+                for tool_call, _ in calls
+            ]
+        })
+        # Results share the budget of one search, so that many searches do not crowd out the chat
+        budget = max(EARLIER_SEARCH_RESULTS_BUDGET, RECENT_SEARCH_RESULTS_BUDGET // len(calls))
+        for (tool_call, request), result in zip(calls, results):
+            stored_results, displayed_results, llm_results = present_search_results(
+                request.function_invoked, result, request.search_full_text_id, budget
+            )
+            response = Message(
+                content=stored_results, chats_id=chat_id, order_in_chat=request.order_in_chat + 1, role='assistant',
+                search_response=True
+            )
+            messages_for_insert.append(response)
+            turn.append({'role': 'tool', 'tool_call_id': tool_call.id, 'content': llm_results})
+            yield 'search_response', dict(response.to_dict(), content=displayed_results)
+
+    position += 1
+    answer = Message(content=message.content, chats_id=chat_id, order_in_chat=position, role=message.role)
+    messages_for_insert.append(answer)
+    yield 'message', answer.to_dict()
+
+    # The whole turn is written in one bulk insert, in order, unless the client has stopped waiting
+    deadlines.check('chat.supabase_write')
+    messages_for_insert.sort(key=lambda m: m.order_in_chat)
+    await queue_new_messages(access_token, language_model, messages_for_insert)
+    yield 'done', {'chats_id': chat_id, 'order_in_chat': position}
+
+
 # Make a request to the Supabase API to fetch chat ids associated with the authenticated user
-def get_chats_for_user(access_token):
+async def get_chats_for_user(access_token):
     """
     Gets ids of all user chats.
     """
-    key: str = config("VITE_SUPABASE_KEY")
     url = config("VITE_SUPABASE_URL")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "apikey": key
-    }
-
     params = {
         "select": "id"
     }
 
-    response = requests.get(f"{url}/rest/v1/chats", headers=headers, params=params)
+    response = await get_http_client().get(
+        f"{url}/rest/v1/chats", headers=supabase_headers(access_token), params=params,
+        timeout=deadlines.timeout('chat.supabase_fetch', SUPABASE_BUDGET)
+    )
 
     if response.status_code == 200:
         chats = response.json()
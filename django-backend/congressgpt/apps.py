@@ -1,15 +1,101 @@
 from django.apps import AppConfig
 from search_engine import SearchEngine
+from sharded_search import ShardedSearchEngine
+from background_tasks import BackgroundExecutor
+from speculative_search import SpeculativeSearches
+from clients import close_clients
+from context_builder import ContextBuilder
+from llm_cache import SemanticResponseCache
+from search_results import HydratedResultsCache
+from admission import Admission, SearchExecutor
+import deadlines
+import tracing
 from decouple import config
-from openai import OpenAI
 import nltk
 
 
 class CongressgptConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'congressgpt'
-    search_engine = SearchEngine()
-    openai_client = OpenAI(
-        api_key=config("OPENAI_API_KEY")
+    # Bounds the search queue and the threads using the encoders and SQLite, shedding load past those bounds
+    admission = Admission(
+        max_queued_searches=config("ADMISSION_MAX_QUEUED_SEARCHES", default=64, cast=int),
+        queue_timeout=config("ADMISSION_QUEUE_TIMEOUT", default=10, cast=float),
+        degrade_queue_depth=config("ADMISSION_DEGRADE_QUEUE_DEPTH", default=16, cast=int),
+        encoder_concurrency=config("ADMISSION_ENCODER_CONCURRENCY", default=32, cast=int),
+        sqlite_concurrency=config("ADMISSION_SQLITE_CONCURRENCY", default=8, cast=int)
+    ) if config("ADMISSION_ENABLED", default=True, cast=bool) else None
+    search_engine_options = dict(
+        encoder_backend=config("ENCODER_BACKEND", default='torch'),
+        onnx_dir=config("ONNX_MODEL_DIR", default='./onnx_models'),
+        batch_window_ms=config("EMBEDDING_BATCH_WINDOW_MS", default=5, cast=float),
+        max_batch_size=config("EMBEDDING_MAX_BATCH_SIZE", default=32, cast=int),
+        model_server=config("MODEL_SERVER_SOCKET", default=None),
+        # Required with a model server, which runs pickled requests from anyone who has the key
+        model_server_authkey=config("MODEL_SERVER_AUTHKEY").encode() if config("MODEL_SERVER_SOCKET", default=None) else None,
+        metadata_dir=config("METADATA_STORE_DIR", default=None),
+        filter_index=config("FILTER_INDEX_ENABLED", default=False, cast=bool),
+        embeddings_dir=config("COMPRESSED_EMBEDDINGS_DIR", default=None),
+        singleflight=config("SEARCH_SINGLEFLIGHT", default=True, cast=bool),
+        admission=admission,
+        rerank_budget=deadlines.RERANK_BUDGET
+    )
+    # Search a database split by Congress with build_shards.py, if a shard manifest is configured
+    if config("SEARCH_SHARD_MANIFEST", default=None):
+        search_engine = ShardedSearchEngine(
+            config("SEARCH_SHARD_MANIFEST"),
+            max_workers=config("SEARCH_SHARD_WORKERS", default=None, cast=lambda v: int(v) if v else None),
+            **search_engine_options
+        )
+    else:
+        search_engine = SearchEngine(**search_engine_options)
+    context_builder = ContextBuilder()
+    # Stored search results already looked up, since chats send their earlier results to GPT every turn
+    hydrated_results = HydratedResultsCache(max_entries=config("HYDRATED_RESULTS_CACHE_SIZE", default=1024, cast=int))
+    # Opt-in cache of GPT's responses to opening prompts, matched by Sentence BERT similarity
+    llm_cache = SemanticResponseCache(
+        search_engine.encoders()[1],
+        threshold=config("LLM_CACHE_THRESHOLD", default=0.95, cast=float),
+        ttl=config("LLM_CACHE_TTL", default=86400, cast=float),
+        max_entries=config("LLM_CACHE_MAX_ENTRIES", default=10000, cast=int)
+    ) if config("LLM_CACHE_ENABLED", default=False, cast=bool) else None
+    # CPU-bound search work runs here so that it does not block the event loop
+    search_executor = SearchExecutor(
+        max_workers=config("SEARCH_EXECUTOR_WORKERS", default=4, cast=int),
+        thread_name_prefix='search'
+    )
+    # Searches started when GPT asks for one, for the frontend's follow-up search request to collect
+    speculative_searches = SpeculativeSearches(
+        search_executor,
+        ttl=config("SPECULATIVE_SEARCH_TTL", default=30, cast=float),
+        max_entries=config("SPECULATIVE_SEARCH_MAX_ENTRIES", default=1000, cast=int),
+        admission=admission,
+        budget=deadlines.SEARCH_BUDGET
+    ) if config("SPECULATIVE_SEARCH_ENABLED", default=True, cast=bool) else None
+    # Bounded pool for Supabase writes and chat titles that happen after the response is sent
+    background_executor = BackgroundExecutor(
+        max_workers=config("BACKGROUND_WORKERS", default=4, cast=int),
+        max_queue_size=config("BACKGROUND_QUEUE_SIZE", default=1000, cast=int),
+        coalesce_window=config("BACKGROUND_COALESCE_WINDOW", default=0.05, cast=float),
+        worker_cleanup=close_clients
     )
     nltk.download('punkt')
+
+    def ready(self):
+        tracing.register_stats('background_executor', self.background_executor.stats)
+        tracing.register_stats('context_builder', self.context_builder.stats)
+        tracing.register_stats('hydrated_results', self.hydrated_results.stats)
+        tracing.register_stats('encoders', self.search_engine.encoder_stats)
+        tracing.register_stats('metadata_store', self.search_engine.metadata_stats)
+        tracing.register_stats('filter_index', self.search_engine.filter_stats)
+        tracing.register_stats('embeddings', self.search_engine.embedding_stats)
+        tracing.register_stats('singleflight', self.search_engine.singleflight_stats)
+        if self.llm_cache is not None:
+            tracing.register_stats('llm_cache', self.llm_cache.stats)
+        if self.admission is not None:
+            tracing.register_stats('admission', self.admission.stats)
+        if self.speculative_searches is not None:
+            tracing.register_stats('speculative_search', self.speculative_searches.stats)
+        tracing.register_stats('search_executor', self.search_executor.stats)
+        if config("OTEL_ENABLED", default=False, cast=bool):
+            tracing.enable_opentelemetry()
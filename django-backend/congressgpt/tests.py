@@ -1,3 +1,961 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import AuthenticationError, Connection, answer_challenge, deliver_challenge
+from unittest import mock
+import ast
+import asyncio
+import contextvars
+import importlib.util
+import json
+import os
+import socket
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import numpy as np
+from decouple import config
+from django.test import SimpleTestCase
+from admission import Admission, OverloadedError, ResourceLimiter, SearchExecutor
+from background_tasks import BackgroundExecutor, QueueFullError
+from benchmarks import synthetic_db
+from build_shards import build_shard
+from context_builder import EARLIER_SEARCH_RESULTS_BUDGET, MESSAGE_OVERHEAD_TOKENS, ContextBuilder
+from deadlines import DeadlineExceeded
+from embedding_service import BatchingEncoder
+from encoders import DEFAULT_ONNX_DIR, load_encoder, onnx_model_file
+from metadata_store import MetadataStore
+from model_server import MODELS, ModelServer, RemoteEncoder
+from onnx_export import DEFAULT_PARITY_TOLERANCE, MODEL_PATHS, SAMPLE_TEXTS, cosine_similarities, load_encoders
+from records import BILL_FIELDS, Bill, Sponsor
+from search_results import HydratedResultsCache, compact_summary_results, format_results_for_display
+from search_engine import SearchEngine
+from sharded_search import ShardedSearchEngine, _merge_results
+from singleflight import SingleFlight
+from speculative_search import SpeculativeSearches
+import context_builder
+import congress_gpt
+import deadlines
 
-# Create your tests here.
+
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.admission = Admission(max_queued_searches=2, queue_timeout=5, degrade_queue_depth=1)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.release = threading.Event()
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(self.release.set)
+
+
+    def block_worker(self):
+        """
+        Occupy the executor's only worker until self.release is set, so that later searches stay queued.
+        """
+        started = threading.Event()
+        future = self.admission.submit(self.executor, lambda: started.set() or self.release.wait(5))
+        self.assertTrue(started.wait(5))
+        return future
+
+
+    def test_cancelled_queued_search_leaves_queue(self):
+        self.block_worker()
+        future = self.admission.submit(self.executor, lambda: 'ran')
+        self.assertEqual(self.admission.stats()['searches']['queue_depth'], 1)
+
+        self.assertTrue(future.cancel())
+        self.assertEqual(self.admission.stats()['searches']['queue_depth'], 0)
+        self.assertEqual(self.admission.stats()['searches']['abandoned'], 1)
+        self.assertFalse(self.admission.overloaded())
+
+
+    def test_abandon_after_run_does_not_leave_queue_twice(self):
+        ticket = self.admission.enqueue()
+        self.assertEqual(self.admission.run(ticket, lambda: 'ran'), 'ran')
+        self.admission.abandon(ticket)
+        self.assertEqual(self.admission.stats()['searches']['queue_depth'], 0)
+        with self.assertRaises(OverloadedError):
+            self.admission.run(ticket, lambda: 'ran again')
+
+
+    def test_sheds_when_queue_is_full_and_recovers(self):
+        self.block_worker()
+        futures = [self.admission.submit(self.executor, lambda: 'ran') for _ in range(2)]
+        with self.assertRaises(OverloadedError) as raised:
+            self.admission.submit(self.executor, lambda: 'ran')
+        self.assertEqual(raised.exception.reason, 'queue full')
+        self.assertTrue(self.admission.overloaded())
+
+        self.release.set()
+        self.assertEqual([future.result(5) for future in futures], ['ran', 'ran'])
+        self.assertFalse(self.admission.overloaded())
+        self.assertEqual(self.admission.submit(self.executor, lambda: 'ran').result(5), 'ran')
+        self.assertEqual(self.admission.stats()['searches']['shed_queue_full'], 1)
+
+
+    def test_degrades_while_queue_is_long(self):
+        self.assertFalse(self.admission.should_degrade())
+        self.block_worker()
+        self.admission.submit(self.executor, lambda: None)
+        self.assertTrue(self.admission.should_degrade())
+        self.release.set()
+
+
+    def test_drops_search_that_waited_past_its_deadline(self):
+        admission = Admission(queue_timeout=0)
+        ticket = admission.enqueue()
+        time.sleep(0.01)
+        with self.assertRaises(OverloadedError) as raised:
+            admission.run(ticket, self.fail)
+        self.assertEqual(raised.exception.reason, 'deadline passed in queue')
+        self.assertEqual(admission.stats()['searches']['queue_depth'], 0)
+
+
+    def test_resource_limiter_sheds_and_recovers(self):
+        limiter = ResourceLimiter('sqlite', max_concurrent=1, max_queue=0, timeout=1)
+        limiter.acquire()
+        with self.assertRaises(OverloadedError):
+            limiter.acquire()
+        limiter.release()
+        with limiter.slot():
+            self.assertEqual(limiter.stats()['in_use'], 1)
+        self.assertEqual(limiter.stats()['in_use'], 0)
+
+
+    def test_resource_limiter_times_out_in_queue(self):
+        limiter = ResourceLimiter('encoder', max_concurrent=1, max_queue=1, timeout=0.05)
+        limiter.acquire()
+        with self.assertRaises(OverloadedError) as raised:
+            limiter.acquire()
+        self.assertEqual(raised.exception.reason, 'timed out in queue')
+        self.assertEqual(limiter.queue_depth(), 0)
+
+
+class SearchExecutorTests(SimpleTestCase):
+    def test_counts_queued_running_and_cancelled_work(self):
+        executor = SearchExecutor(max_workers=1)
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+
+        running = executor.submit(lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+        queued = [executor.submit(lambda: 'ran') for _ in range(2)]
+        self.assertEqual(executor.stats(), {'workers': 1, 'queue_depth': 2, 'running': 1, 'completed': 0})
+
+        self.assertTrue(queued[0].cancel())
+        self.assertEqual(executor.stats()['queue_depth'], 1)
+        release.set()
+        self.assertEqual(queued[1].result(5), 'ran')
+        self.assertTrue(running.result(5))
+        self.assertEqual(executor.stats(), {'workers': 1, 'queue_depth': 0, 'running': 0, 'completed': 2})
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_no_deadline_outside_request(self):
+        self.assertIsNone(deadlines.current())
+        self.assertIsNone(deadlines.remaining())
+        deadlines.check('test')
+        self.assertEqual(deadlines.timeout('test', 3), 3)
+
+
+    def test_request_deadline_is_reset_after_request(self):
+        with deadlines.request_deadline(10) as deadline:
+            self.assertIs(deadlines.current(), deadline)
+            self.assertLessEqual(deadlines.remaining(), 10)
+        self.assertIsNone(deadlines.current())
+
+
+    def test_stage_is_bounded_by_request(self):
+        with deadlines.request_deadline(1) as request:
+            with deadlines.stage(60) as stage:
+                self.assertIs(stage.parent, request)
+                self.assertEqual(stage.expires_at, request.expires_at)
+                self.assertLessEqual(deadlines.timeout('test', 60), 1)
+            self.assertIs(deadlines.current(), request)
+
+
+    def test_cancelling_request_cancels_stage(self):
+        with deadlines.request_deadline(10) as request:
+            with deadlines.stage(5):
+                request.cancel()
+                with self.assertRaises(DeadlineExceeded) as raised:
+                    deadlines.check('test')
+                self.assertEqual(raised.exception.reason, 'cancelled')
+
+
+    def test_expired_deadline_raises(self):
+        with deadlines.request_deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                deadlines.check('test')
+            with self.assertRaises(DeadlineExceeded):
+                deadlines.timeout('test', 3)
+            with self.assertRaises(DeadlineExceeded):
+                deadlines.call('test', self.fail, 'called after the deadline')
+
+
+    def test_deadline_follows_copied_context_onto_threads(self):
+        with deadlines.request_deadline(10) as deadline, ThreadPoolExecutor(max_workers=1) as executor:
+            context = contextvars.copy_context()
+            self.assertIs(executor.submit(context.run, deadlines.current).result(), deadline)
+            self.assertIsNone(executor.submit(deadlines.current).result())
+
+
+class RunSearchTests(SimpleTestCase):
+    def setUp(self):
+        self.admission = Admission(max_queued_searches=4, queue_timeout=5, degrade_queue_depth=4)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.release = threading.Event()
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(self.release.set)
+        patcher = mock.patch.multiple(
+            congress_gpt.app_config, admission=self.admission, search_executor=self.executor
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_runs_in_request_context(self):
+        with deadlines.request_deadline(10) as request:
+            current = asyncio.run(congress_gpt.run_search(deadlines.current))
+        self.assertIs(current.parent, request)
+
+
+    def test_deadline_passing_in_queue_raises_and_frees_queue(self):
+        started = threading.Event()
+        self.executor.submit(lambda: started.set() or self.release.wait(5))
+        self.assertTrue(started.wait(5))
+
+        with deadlines.request_deadline(0.1):
+            with self.assertRaises(DeadlineExceeded) as raised:
+                asyncio.run(congress_gpt.run_search(self.fail, 'search ran after its deadline'))
+        self.assertEqual(raised.exception.stage, 'search')
+        self.assertEqual(self.admission.stats()['searches']['queue_depth'], 0)
+        self.assertFalse(self.admission.overloaded())
+
+
+class ModelServerTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The server runs until the tests exit, and removes its socket then
+        cls.address = os.path.join(tempfile.mkdtemp(), 'models', 'models.sock')
+        encoders = {name: BatchingEncoder(load_encoder(path, 'hashing'), 8, 0) for name, path in MODELS.items()}
+        server = ModelServer(cls.address, b'secret', encoders, receive_timeout=0.5)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # The socket is made private once it is listening; it exists a moment earlier, but refuses connections
+        for _ in range(100):
+            if os.path.exists(cls.address) and stat.S_IMODE(os.stat(cls.address).st_mode) == 0o600:
+                break
+            time.sleep(0.01)
+
+
+    def test_socket_is_private(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.address).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(self.address)).st_mode), 0o700)
+
+
+    def test_wrong_key_is_rejected(self):
+        with self.assertRaises(AuthenticationError):
+            RemoteEncoder('legal_bert', self.address, b'guess').encode(['a bill'])
+
+
+    def test_silent_client_does_not_block_others(self):
+        with socket.socket(socket.AF_UNIX) as silent:
+            silent.connect(self.address)
+            encoder = RemoteEncoder('legal_bert', self.address, b'secret')
+            self.assertEqual(len(encoder.encode(['a bill'])), 1)
+
+
+    def test_stalled_server_times_out_and_drops_the_connection(self):
+        dropped = threading.Event()
+        with socket.socket(socket.AF_UNIX) as listener:
+            address = os.path.join(os.path.dirname(self.address), 'stalled.sock')
+            listener.bind(address)
+            listener.listen()
+
+            def serve():
+                # Authenticate and take the request, but never reply
+                sock, _ = listener.accept()
+                with Connection(sock.detach()) as client:
+                    deliver_challenge(client, b'secret')
+                    answer_challenge(client, b'secret')
+                    client.recv()
+                    try:
+                        client.poll(5)
+                        client.recv()
+                    except EOFError:
+                        dropped.set()
+
+            threading.Thread(target=serve, daemon=True).start()
+            encoder = RemoteEncoder('legal_bert', address, b'secret', request_timeout=5)
+            start = time.monotonic()
+            with self.assertRaises(DeadlineExceeded):
+                with deadlines.request_deadline(0.2):
+                    encoder.encode(['a bill'])
+            self.assertLess(time.monotonic() - start, 2)
+            # The client closed its connection, so a late reply cannot be read by its next request
+            self.assertTrue(dropped.wait(5))
+        os.remove(address)
+
+
+    def test_client_reconnects_after_idle_timeout(self):
+        encoder = RemoteEncoder('sentence_bert', self.address, b'secret')
+        encoder.encode(['a bill'])
+        time.sleep(1)
+        self.assertEqual(len(encoder.encode(['a bill'])), 1)
+
+
+class SemanticCacheFallbackTests(SimpleTestCase):
+    def setUp(self):
+        self.llm_cache = mock.Mock()
+        self.llm_cache.lookup.return_value = None
+        # A full search queue must not keep the cache from embedding
+        admission = Admission(max_queued_searches=0)
+        patcher = mock.patch.multiple(congress_gpt.app_config, llm_cache=self.llm_cache, admission=admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.chat = [{'role': 'user', 'content': 'bills on climate change'}]
+
+
+    def ask(self):
+        with mock.patch.object(congress_gpt, 'ask_gpt', mock.AsyncMock(return_value={'content': 'answer'})) as ask_gpt:
+            response = asyncio.run(congress_gpt.ask_gpt_cached(self.chat, 'gpt-4'))
+        return response, ask_gpt
+
+
+    def test_embedding_skips_admission(self):
+        self.llm_cache.embed.return_value = [1.0]
+        response, ask_gpt = self.ask()
+        self.assertEqual(response, {'content': 'answer'})
+        self.llm_cache.store.assert_called_once_with('gpt-4', [1.0], {'content': 'answer'})
+
+
+    def test_cached_response_is_returned(self):
+        self.llm_cache.lookup.return_value = {'content': 'cached'}
+        response, ask_gpt = self.ask()
+        self.assertEqual(response, {'content': 'cached'})
+        ask_gpt.assert_not_called()
+
+
+    def test_cache_errors_fall_back_to_gpt(self):
+        for error in [OverloadedError('encoder', 'queue full'), DeadlineExceeded('chat.llm_cache_lookup'), RuntimeError('encoder failed')]:
+            self.llm_cache.embed.side_effect = error
+            with self.assertLogs('congress_gpt', 'WARNING'):
+                response, ask_gpt = self.ask()
+            self.assertEqual(response, {'content': 'answer'})
+            ask_gpt.assert_awaited_once()
+
+
+    def test_store_errors_are_ignored(self):
+        self.llm_cache.embed.return_value = [1.0]
+        self.llm_cache.store.side_effect = RuntimeError('cache full')
+        with self.assertLogs('congress_gpt', 'WARNING'):
+            response, ask_gpt = self.ask()
+        self.assertEqual(response, {'content': 'answer'})
+
+
+class BillRecordTests(SimpleTestCase):
+    def setUp(self):
+        self.bill = Bill(
+            7, title='Clean Water Act', congress=117, score=0.25,
+            sponsors=[Sponsor('S001', 'Smith', 'John Smith', 'house', 'D')], sponsor_aggregates={'D': 1}
+        )
+
+
+    def test_to_dict_leaves_out_the_score(self):
+        bill = self.bill.to_dict()
+        self.assertNotIn('score', bill)
+        self.assertEqual(list(bill), ['id', *BILL_FIELDS, 'sponsors', 'sponsor_aggregates'])
+        self.assertEqual(bill['sponsors'], [self.bill.sponsors[0].to_dict()])
+
+
+    def test_displayed_results_leave_out_the_score(self):
+        displayed = ast.literal_eval(format_results_for_display([self.bill, Bill(8)]))
+        # The shape bills were displayed in before search results carried scores
+        self.assertEqual(list(displayed[0]), ['id', *BILL_FIELDS, 'sponsors', 'sponsor_aggregates'])
+        self.assertEqual(list(displayed[1]), ['id', *BILL_FIELDS])
+
+
+class NewChatTests(SimpleTestCase):
+    def setUp(self):
+        self.post_new_message = mock.AsyncMock()
+        self.queue_new_messages = mock.AsyncMock()
+        patcher = mock.patch.multiple(
+            congress_gpt,
+            start_new_chat=mock.AsyncMock(return_value=42),
+            queue_chat_title=mock.Mock(),
+            post_new_message=self.post_new_message,
+            queue_new_messages=self.queue_new_messages
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.multiple(congress_gpt.app_config, speculative_searches=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def reply(self, search_request):
+        return {
+            'role': 'assistant', 'content': 'climate bills', 'search_request': search_request, 'search_response': False,
+            'search_full_text_id': None, 'function_invoked': 'search_summaries' if search_request else None
+        }
+
+
+    def prompt(self, reply):
+        with mock.patch.object(congress_gpt, 'ask_gpt_cached', mock.AsyncMock(return_value=reply)):
+            return asyncio.run(congress_gpt.prompt({'prompt': 'bills on climate change'}, 'token'))
+
+
+    def test_search_request_is_written_with_the_prompt(self):
+        self.prompt(self.reply(search_request=True))
+        self.queue_new_messages.assert_not_called()
+        self.post_new_message.assert_awaited_once()
+        messages = self.post_new_message.await_args.args[2]
+        self.assertEqual([(m.role, m.chats_id, m.order_in_chat) for m in messages], [('user', 42, 0), ('assistant', 42, 1)])
+        self.assertEqual(messages[0].content, 'bills on climate change')
+
+
+    def test_answer_is_queued_with_the_prompt(self):
+        self.prompt(self.reply(search_request=False))
+        self.post_new_message.assert_not_called()
+        messages = self.queue_new_messages.await_args.args[2]
+        self.assertEqual([(m.role, m.chats_id) for m in messages], [('user', 42), ('assistant', 42)])
+
+
+class StoredResultsTests(SimpleTestCase):
+    def setUp(self):
+        self.search_engine = mock.Mock(DATABASE_VERSION='v2.4')
+        self.search_engine.get_summaries.side_effect = lambda ids: [Bill(id, title=f'Bill {id}') for id in ids]
+        # Stored results are looked up even when no search would be admitted
+        patcher = mock.patch.multiple(
+            congress_gpt.app_config,
+            search_engine=self.search_engine,
+            hydrated_results=HydratedResultsCache(max_entries=2),
+            admission=Admission(max_queued_searches=0)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stored = compact_summary_results([Bill(7, score=0.5), Bill(3, score=0.25)], 'v2.4')
+
+
+    def test_hydrates_outside_admission(self):
+        text = asyncio.run(congress_gpt.search_results_for_llm(self.stored))
+        self.assertIn('Bill 7', text)
+        self.assertLess(text.index('Bill 7'), text.index('Bill 3'))
+
+
+    def test_hydrated_results_are_cached(self):
+        asyncio.run(congress_gpt.search_results_for_llm(self.stored))
+        asyncio.run(congress_gpt.search_results_for_display(self.stored))
+        self.search_engine.get_summaries.assert_called_once_with([7, 3])
+
+
+    def test_other_content_is_unchanged(self):
+        self.assertEqual(asyncio.run(congress_gpt.search_results_for_llm('plain text')), 'plain text')
+        self.search_engine.get_summaries.assert_not_called()
+
+
+class SpeculativeSearchTests(SimpleTestCase):
+    def setUp(self):
+        self.admission = Admission(max_queued_searches=4, queue_timeout=5, degrade_queue_depth=2)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.release = threading.Event()
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(self.release.set)
+        self.searches = SpeculativeSearches(self.executor, ttl=30, admission=self.admission, budget=5)
+        patcher = mock.patch.multiple(
+            congress_gpt.app_config,
+            admission=self.admission, search_executor=self.executor, speculative_searches=self.searches
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def block_worker(self):
+        started = threading.Event()
+        self.executor.submit(lambda: started.set() or self.release.wait(5))
+        self.assertTrue(started.wait(5))
+
+
+    def queue_depth(self):
+        return self.admission.stats()['searches']['queue_depth']
+
+
+    def test_runs_with_deadline_of_its_own(self):
+        with deadlines.request_deadline(60) as request:
+            self.searches.start('key', {}, deadlines.current)
+        search = self.searches.take('key', {})
+        deadline = search.future.result(5)
+        self.assertIsNone(deadline.parent)
+        self.assertIs(deadline, search.deadline)
+        self.assertIsNot(deadline, request)
+
+
+    def test_skipped_while_overloaded(self):
+        self.block_worker()
+        self.admission.enqueue()
+        self.admission.enqueue()
+        self.searches.start('key', {}, self.fail)
+        self.assertEqual(self.searches.stats()['skipped'], 1)
+        self.assertIsNone(self.searches.take('key', {}))
+
+
+    def test_dropped_first_when_degraded(self):
+        self.block_worker()
+        self.searches.start('key', {}, self.fail, 'speculative search ran while degraded')
+        self.admission.submit(self.executor, lambda: None)
+        self.admission.submit(self.executor, lambda: None)
+        self.release.set()
+        with self.assertRaises(OverloadedError):
+            self.searches.take('key', {}).future.result(5)
+        self.assertEqual(self.admission.stats()['searches']['shed_optional'], 1)
+
+
+    def test_mismatched_search_leaves_queue(self):
+        self.block_worker()
+        self.searches.start('key', {'query': 'a'}, self.fail)
+        self.assertEqual(self.queue_depth(), 1)
+        self.assertIsNone(self.searches.take('key', {'query': 'b'}))
+        self.assertEqual(self.queue_depth(), 0)
+
+
+    def test_collect_gives_up_within_request_deadline(self):
+        self.block_worker()
+        request = congress_gpt.speculative_search_request('search_summaries', {}, None)
+        self.searches.start((1, 2), request, self.fail)
+        with deadlines.request_deadline(0.1):
+            with self.assertRaises(DeadlineExceeded):
+                asyncio.run(congress_gpt.collect_search(1, 2, 'search_summaries', {}, None))
+        self.assertEqual(self.queue_depth(), 0)
+
+
+class OnnxParityTests(SimpleTestCase):
+    """
+    The exported ONNX models against PyTorch. Skipped unless ONNX Runtime, PyTorch and the models exported by
+    onnx_export.py are all there.
+    """
+    def test_onnx_embeddings_match_torch(self):
+        for module in ['onnxruntime', 'torch', 'transformers']:
+            if importlib.util.find_spec(module) is None:
+                self.skipTest(f'{module} is not installed')
+        onnx_dir = config("ONNX_MODEL_DIR", default=DEFAULT_ONNX_DIR)
+        for model_path in MODEL_PATHS:
+            for quantized in [False, True]:
+                if not os.path.exists(onnx_model_file(model_path, onnx_dir, quantized)):
+                    self.skipTest(f'{model_path} has not been exported to {onnx_dir}')
+
+        for model_path in MODEL_PATHS:
+            encoders = load_encoders(model_path, onnx_dir)
+            reference = encoders.pop('torch').encode(SAMPLE_TEXTS)
+            for name, encoder in encoders.items():
+                with self.subTest(model=model_path, encoder=name):
+                    cosine = cosine_similarities(encoder.encode(SAMPLE_TEXTS), reference)
+                    self.assertGreaterEqual(cosine.min(), DEFAULT_PARITY_TOLERANCE)
+
+
+class BackgroundExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = BackgroundExecutor(max_workers=2, coalesce_window=0.05, retry_backoff=0)
+        self.addCleanup(self.executor.shutdown)
+
+
+    def test_coalesces_items_under_one_key(self):
+        batches = []
+        self.executor.coalesce(('token', 'gpt-4'), [1], lambda *args: batches.append(args))
+        self.executor.coalesce(('token', 'gpt-4'), [2, 3], lambda *args: batches.append(args))
+        self.executor.coalesce(('token', 'gpt-3.5'), [4], lambda *args: batches.append(args))
+        self.executor.shutdown()
+        self.assertCountEqual(batches, [('token', 'gpt-4', [1, 2, 3]), ('token', 'gpt-3.5', [4])])
+        self.assertEqual(self.executor.stats()['coalesced_items'], 4)
+
+
+    def test_shutdown_drains_queued_work(self):
+        done = []
+        for i in range(20):
+            self.executor.submit(lambda i: time.sleep(0.001) or done.append(i), i)
+        self.executor.coalesce('key', ['buffered'], lambda key, items: done.extend(items))
+        self.executor.shutdown()
+        self.assertCountEqual(done, list(range(20)) + ['buffered'])
+        with self.assertRaises(QueueFullError):
+            self.executor.submit(done.append, 'late')
+
+
+    def test_runs_coroutines_and_retries(self):
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise ConnectionError('try again')
+
+        self.executor.submit(flaky, retries=1)
+        self.executor.shutdown()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.executor.stats()['retried'], 1)
+        self.assertEqual(self.executor.stats()['completed'], 1)
+
+
+    def test_rejects_work_when_queue_is_full(self):
+        executor = BackgroundExecutor(max_workers=1, max_queue_size=1)
+        release = threading.Event()
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        started = threading.Event()
+        executor.submit(lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+        executor.submit(lambda: None)
+        with self.assertRaises(QueueFullError):
+            executor.submit(lambda: None)
+        with self.assertRaises(QueueFullError):
+            executor.coalesce('key', [1], lambda key, items: None)
+        self.assertEqual(executor.stats()['rejected'], 2)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def call_concurrently(self, flight, function, error_types=()):
+        """
+        Make a second call for the same key while the first is still running. Returns the second call's result
+        or error.
+        """
+        started, release = threading.Event(), threading.Event()
+        outcome = {}
+
+        def leader():
+            started.set()
+            release.wait(5)
+            return function()
+
+        def follower():
+            try:
+                outcome['result'] = flight.do('key', function)
+            except Exception as e:
+                outcome['error'] = e
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leading = executor.submit(flight.do, 'key', leader)
+            self.assertTrue(started.wait(5))
+            following = executor.submit(follower)
+            while flight.stats()['coalesced'] == 0:
+                time.sleep(0.001)
+            release.set()
+            try:
+                outcome['leader'] = leading.result(5)
+            except error_types as e:
+                outcome['leader_error'] = e
+            following.result(5)
+        return outcome
+
+
+    def test_concurrent_calls_share_one_result(self):
+        calls = []
+        flight = SingleFlight()
+        outcome = self.call_concurrently(flight, lambda: calls.append(1) or ['result'])
+        self.assertEqual(outcome['result'], ['result'])
+        self.assertIs(outcome['result'], outcome['leader'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+
+    def test_copy_results(self):
+        outcome = self.call_concurrently(SingleFlight(copy_results=True), lambda: ['result'])
+        self.assertEqual(outcome['result'], outcome['leader'])
+        self.assertIsNot(outcome['result'], outcome['leader'])
+
+
+    def test_errors_reach_every_caller(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('search failed')
+
+        outcome = self.call_concurrently(flight, fail, ValueError)
+        self.assertIsInstance(outcome['leader_error'], ValueError)
+        self.assertIs(outcome['error'], outcome['leader_error'])
+        self.assertEqual(flight.stats()['errors'], 1)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+
+    def test_retry_errors_are_not_shared(self):
+        flight = SingleFlight(retry_errors=(DeadlineExceeded,))
+        calls = []
+
+        def search():
+            calls.append(1)
+            if len(calls) == 1:
+                raise DeadlineExceeded('search')
+            return 'result'
+
+        outcome = self.call_concurrently(flight, search, DeadlineExceeded)
+        self.assertIsInstance(outcome['leader_error'], DeadlineExceeded)
+        self.assertEqual(outcome['result'], 'result')
+        self.assertEqual(len(calls), 2)
+
+
+class ContextBuilderTests(SimpleTestCase):
+    def setUp(self):
+        # Count tokens by estimate, so that the tests do not depend on downloading tiktoken's encodings
+        patcher = mock.patch.object(context_builder, 'tiktoken', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.builder = ContextBuilder(budgets={'gpt-4': 400})
+
+
+    def tokens(self, messages):
+        return sum(self.builder.count_tokens(m['content'], 'gpt-4') + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+    def test_keeps_most_recent_messages_within_budget(self):
+        chat = [{'role': 'user' if i % 2 else 'assistant', 'content': f'message {i} ' + 'word ' * 40} for i in range(20)]
+        system_prompts = [{'role': 'system', 'content': 'Be brief.'}]
+        messages = self.builder.build(chat, 'gpt-4', system_prompts)
+        self.assertLessEqual(self.tokens(messages), 400)
+        self.assertEqual(messages[-1], system_prompts[0])
+        self.assertEqual(messages[-2]['content'], chat[-1]['content'])
+        kept = [m['content'] for m in messages[:-1]]
+        self.assertEqual(kept, [m['content'] for m in chat[-len(kept):]])
+        self.assertLess(len(kept), len(chat))
+
+
+    def test_truncates_oversized_newest_message(self):
+        chat = [{'role': 'user', 'content': 'word ' * 2000}]
+        messages = self.builder.build(chat, 'gpt-4')
+        self.assertEqual(len(messages), 1)
+        self.assertLessEqual(self.tokens(messages), 400)
+
+
+    def test_earlier_search_results_get_a_small_budget(self):
+        results = 'result ' * 600
+        chat = [
+            {'role': 'function', 'content': results, 'search_response': True},
+            {'role': 'function', 'content': results, 'search_response': True}
+        ]
+        builder = ContextBuilder(budgets={'gpt-4': 8000})
+        messages = builder.build(chat, 'gpt-4')
+        self.assertLessEqual(builder.count_tokens(messages[0]['content'], 'gpt-4'), EARLIER_SEARCH_RESULTS_BUDGET)
+        self.assertGreater(builder.count_tokens(messages[1]['content'], 'gpt-4'), EARLIER_SEARCH_RESULTS_BUDGET)
+
+
+class MultiQueryFusionTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.directory.name, 'congress.db')
+        synthetic_db.generate(path, 300, words_per_bill=80, vocabulary_size=2000, embeddings='hashing')
+        cls.engine = SearchEngine(encoder_backend='hashing', db_path=path, singleflight=False)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+    def test_single_ranking_scores_by_rank(self):
+        query = ' '.join(synthetic_db.POLICY_WORDS[:2])
+        results = self.engine.retrieve_summary_multi({'number_to_return': 10}, [query])
+        self.assertEqual(len(results), 10)
+        for rank, bill in enumerate(results):
+            self.assertAlmostEqual(bill.score, 1 / (60 + rank + 1))
+
+
+    def test_fused_scores_add_up_over_rankings(self):
+        query = ' '.join(synthetic_db.POLICY_WORDS[:2])
+        single = self.engine.retrieve_summary_multi({'number_to_return': 10}, [query])
+        doubled = self.engine.retrieve_summary_multi({'number_to_return': 10}, [query, query])
+        self.assertEqual([bill.id for bill in doubled], [bill.id for bill in single])
+        for once, twice in zip(single, doubled):
+            self.assertAlmostEqual(twice.score, 2 * once.score)
+
+
+    def test_bills_ranked_well_by_several_variants_come_first(self):
+        variants = [' '.join(synthetic_db.POLICY_WORDS[i:i + 2]) for i in range(3)]
+        fused = self.engine.retrieve_summary_multi({'number_to_return': 20}, variants)
+        self.assertEqual([bill.score for bill in fused], sorted([bill.score for bill in fused], reverse=True))
+        # A bill ranked first by one variant alone scores 1 / 61; anything above that was found by several
+        self.assertGreater(fused[0].score, 1 / 61)
+
+
+class MetadataStoreTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.databases = []
+        for bills, seed in [(100, 0), (120, 1)]:
+            path = os.path.join(cls.directory.name, f'congress_{bills}.db')
+            synthetic_db.generate(path, bills, seed, words_per_bill=20, vocabulary_size=500, embeddings='random', embedding_dimension=4)
+            cls.databases.append(path)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+    def test_concurrent_opens_build_once(self):
+        store_dir = tempfile.mkdtemp(dir=self.directory.name)
+        build = MetadataStore.build
+
+        with mock.patch.object(MetadataStore, 'build', side_effect=build) as counted:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                stores = list(executor.map(
+                    lambda _: MetadataStore.open(store_dir, lambda: sqlite3.connect(self.databases[0]), 'v1'), range(4)
+                ))
+        self.assertEqual(counted.call_count, 1)
+        self.assertTrue(all(len(store) == 100 for store in stores))
+
+
+    def test_rebuild_leaves_mapped_store_intact(self):
+        store_dir = tempfile.mkdtemp(dir=self.directory.name)
+        old = MetadataStore.open(store_dir, lambda: sqlite3.connect(self.databases[0]), 'v1')
+        old_ids = np.array(old.ids)
+
+        new = MetadataStore.open(store_dir, lambda: sqlite3.connect(self.databases[1]), 'v2')
+        self.assertEqual(len(new), 120)
+        self.assertEqual(new.database_version, 'v2')
+        np.testing.assert_array_equal(old.ids, old_ids)
+
+
+    def test_fails_loudly_if_saved_store_cannot_be_loaded(self):
+        store_dir = tempfile.mkdtemp(dir=self.directory.name)
+        with mock.patch.object(MetadataStore, 'load', return_value=None):
+            with self.assertRaises(RuntimeError):
+                MetadataStore.open(store_dir, lambda: sqlite3.connect(self.databases[0]), 'v1')
+
+
+class FilteredSearchTests(SimpleTestCase):
+    DECADE = {'date_range': {'start_year': 2001, 'start_month': 1, 'start_day': 1, 'end_year': 2010, 'end_month': 12, 'end_day': 31}}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.directory.name, 'congress.db')
+        synthetic_db.generate(path, 600, words_per_bill=80, vocabulary_size=2000, embeddings='hashing')
+        cls.engine = SearchEngine(
+            encoder_backend='hashing', db_path=path, metadata_dir=os.path.join(cls.directory.name, 'metadata'),
+            filter_index=True, singleflight=False
+        )
+        cls.query = ' '.join(synthetic_db.POLICY_WORDS[:2])
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+    def search(self, filters):
+        return self.engine.retrieve_summary({'query': self.query, 'number_to_return': 50, **filters})
+
+
+    def test_selective_filter_returns_only_passing_bills(self):
+        results = self.search(self.DECADE)
+        self.assertGreater(len(results), 0)
+        for bill in results:
+            self.assertEqual(bill.bill_type, 'hr')
+            self.assertTrue('2001-01-01' <= bill.date[:10] <= '2010-12-31')
+
+
+    def test_skipping_failing_bills_ranks_like_dropping_them(self):
+        prefiltered = self.search(self.DECADE)
+        # Make every filter count as broad, so that failing bills are dropped from BM25's ranking instead
+        with mock.patch.object(self.engine, '_SearchEngine__max_prefilter_share', 0):
+            postfiltered = self.search(self.DECADE)
+        self.assertEqual([bill.id for bill in prefiltered], [bill.id for bill in postfiltered])
+
+
+class CrsEvaluationTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        path = os.path.join(os.path.dirname(__file__), '..', '..', 'crs_evaluation', 'evaluate.py')
+        spec = importlib.util.spec_from_file_location('crs_evaluate', path)
+        cls.evaluate = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cls.evaluate)
+
+        cls.directory = tempfile.TemporaryDirectory()
+        db_path = os.path.join(cls.directory.name, 'congress.db')
+        synthetic_db.generate(db_path, 300, words_per_bill=80, vocabulary_size=2000, embeddings='hashing')
+        cls.evaluate._engine = SearchEngine(encoder_backend='hashing', db_path=db_path, singleflight=False)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.evaluate._engine = None
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+    def test_run_query_ranks_primary_keys(self):
+        query = ' '.join(synthetic_db.POLICY_WORDS[:2])
+        returned_query, keys, latency_ms = self.evaluate._run_query(query, 10)
+        results = self.evaluate._engine.retrieve_summary({'query': query, 'number_to_return': 10})
+        self.assertEqual(returned_query, query)
+        self.assertEqual(keys, [f'hr_{bill.bill_number}_{bill.congress}th' for bill in results])
+        self.assertGreater(latency_ms, 0)
+
+
+class ShardedSearchTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        source = os.path.join(cls.directory.name, 'congress.db')
+        synthetic_db.generate(source, 300, words_per_bill=80, vocabulary_size=2000, embeddings='hashing')
+        middle = (synthetic_db.FIRST_CONGRESS + synthetic_db.LAST_CONGRESS) // 2
+        shards = [
+            build_shard(source, os.path.join(cls.directory.name, f'shard_{first}.db'), first, last)
+            for first, last in [(synthetic_db.FIRST_CONGRESS, middle), (middle + 1, synthetic_db.LAST_CONGRESS)]
+        ]
+        manifest = os.path.join(cls.directory.name, 'manifest.json')
+        with open(manifest, 'w') as f:
+            json.dump({'database_version': SearchEngine.DATABASE_VERSION, 'shards': shards}, f)
+        cls.engine = ShardedSearchEngine(manifest, encoder_backend='hashing', singleflight=False)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+    def test_merge_orders_reranked_results_by_score(self):
+        merged = _merge_results([[Bill(1, score=0.9), Bill(2, score=0.5)], [Bill(3, score=0.7)]], 3)
+        self.assertEqual([bill.id for bill in merged], [1, 3, 2])
+
+
+    def test_merge_takes_turns_between_shards_for_unranked_results(self):
+        results = [
+            [Bill(1, score=0.9), Bill(2), Bill(3), Bill(4)],
+            [Bill(5), Bill(6)],
+            [Bill(7, score=0.8), Bill(8)]
+        ]
+        self.assertEqual([bill.id for bill in _merge_results(results, 7)], [1, 7, 2, 5, 8, 3, 6])
+
+
+    def test_searches_every_shard(self):
+        query = ' '.join(synthetic_db.POLICY_WORDS[:2])
+        results = self.engine.retrieve_summary({'query': query, 'number_to_return': 10})
+        self.assertEqual(len(results), 10)
+        scores = [bill.score for bill in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+
+    def test_stops_waiting_for_shards_at_the_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stuck(engine, params):
+            release.wait(5)
+            return []
+
+        with mock.patch.object(SearchEngine, 'retrieve_summary', stuck):
+            start = time.monotonic()
+            with self.assertRaises(DeadlineExceeded) as raised:
+                with deadlines.request_deadline(0.05):
+                    self.engine.retrieve_summary({'query': 'health', 'number_to_return': 5})
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(raised.exception.stage, 'search.shards')
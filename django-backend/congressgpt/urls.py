@@ -5,6 +5,8 @@ urlpatterns = [
     path('csrf', views.get_csrf_token, name='get_csrf_token'),
     path('ask', views.ask_congressgpt, name='ask'),
     path('search', views.search_congressgpt, name='search'),
+    path('agent', views.agent_congressgpt, name='agent'),
     path('get_history', views.get_history_congressgpt, name='get_history'),
     path('get_historybar', views.get_historybar_congressgpt, name='get_historybar'),
+    path('metrics', views.metrics_congressgpt, name='metrics'),
 ]
\ No newline at end of file
@@ -1,14 +1,41 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
 from api import *
+from admission import OverloadedError
+from deadlines import DeadlineExceeded
+import deadlines
+import httpx
+import openai
 from django.middleware.csrf import get_token
 import json
+import logging
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning that a request ran out of time, including network calls whose timeouts were cut short by its deadline
+TIMEOUT_ERRORS = (DeadlineExceeded, httpx.TimeoutException, openai.APITimeoutError)
+
+def overloaded_response(error: OverloadedError):
+    # Turned away by admission control: fail fast so that the client can retry, instead of waiting in a long queue
+    logger.warning('Request shed: %s', error)
+    return JsonResponse({"error": "The server is busy. Please try again shortly."}, status=503, headers={"Retry-After": "1"})
+
+def timeout_response(error: Exception):
+    logger.warning('Request ran out of time: %s', error)
+    return JsonResponse({"error": "The request took too long. Please try again."}, status=504)
 
 def get_csrf_token(request):
     return JsonResponse({"csrfToken": get_token(request)})
 
+# Action for the /congress-gpt/metrics route.
+def metrics_congressgpt(request):
+    # Stage latency histograms, cache hit rates and pool statistics
+    return JsonResponse(tracing.metrics_snapshot())
+
 # Action for the /congress-gpt/ask-congressgpt route.
-def ask_congressgpt(request):
+async def ask_congressgpt(request):
     # Handle the incoming user message
     # if request.method == 'POST':
     data = json.loads(request.body)
@@ -24,7 +51,13 @@ def ask_congressgpt(request):
         return JsonResponse({"error": "token cannot be empty"}, status=400)
 
     # call a chatbot api
-    bot_response = talk(user_input, token, created_at, str(chat_id), str(order_in_chat), language_model)
+    with tracing.collect_timings() as timings, deadlines.request_deadline():
+        try:
+            bot_response = await talk(user_input, token, created_at, str(chat_id), str(order_in_chat), language_model)
+        except OverloadedError as e:
+            return overloaded_response(e)
+        except TIMEOUT_ERRORS as e:
+            return timeout_response(e)
 
     # Check for errors in the bot response using is_error method
     if hasattr(bot_response, 'error') and bot_response.error:
@@ -37,10 +70,57 @@ def ask_congressgpt(request):
         "searchRequest": bot_response.search_request,
         "searchResponse": bot_response.search_response
     }
+    # In debug mode, show where the time went
+    if settings.DEBUG:
+        response["timings"] = timings
     # Return the bot's response to the client
     return JsonResponse(response)
 
-def search_congressgpt(request):
+# Action for the /congress-gpt/agent route.
+async def agent_congressgpt(request):
+    # Runs a whole turn, searches included, and streams its progress as one JSON event per line
+    data = json.loads(request.body)
+    user_input = data.get('user_input')
+    token = data.get('password')
+    chat_id = data.get('chat_id')
+    order_in_chat = data.get('order_in_chat')
+    created_at = data.get('created_at')
+    language_model = data.get('language_model')
+    if not user_input:
+        return JsonResponse({"error": "Input cannot be empty"}, status=400)
+    if not token:
+        return JsonResponse({"error": "token cannot be empty"}, status=400)
+
+    async def events():
+        with tracing.collect_timings() as timings, deadlines.request_deadline():
+            try:
+                async for event, r in agent(user_input, token, created_at, str(chat_id), str(order_in_chat), language_model):
+                    line = {
+                        "event": event,
+                        "chatId": r.chat_id,
+                        "orderInChat": r.pos,
+                        "content": r.content,
+                        "role": r.role,
+                        "searchRequest": r.search_request,
+                        "searchResponse": r.search_response
+                    }
+                    # In debug mode, show where the time went
+                    if event == 'done' and settings.DEBUG:
+                        line["timings"] = timings
+                    yield json.dumps(line) + "\n"
+            except OverloadedError as e:
+                logger.warning('Request shed: %s', e)
+                yield json.dumps({"event": "error", "error": "The server is busy. Please try again shortly."}) + "\n"
+            except TIMEOUT_ERRORS as e:
+                logger.warning('Request ran out of time: %s', e)
+                yield json.dumps({"event": "error", "error": "The request took too long. Please try again."}) + "\n"
+            except Exception:
+                logger.exception('Agent turn failed.')
+                yield json.dumps({"event": "error", "error": "The request could not be completed."}) + "\n"
+
+    return StreamingHttpResponse(events(), content_type='application/x-ndjson')
+
+async def search_congressgpt(request):
     data = json.loads(request.body)
     token = data.get('password')
     chat_id = data.get('chat_id')
@@ -52,7 +132,13 @@ def search_congressgpt(request):
         return JsonResponse({"error": "Token cannot be empty"}, status=400)
 
     # call a chatbot api
-    bot_response = search(str(token), str(chat_id), language_model)
+    with tracing.collect_timings() as timings, deadlines.request_deadline():
+        try:
+            bot_response = await search(str(token), str(chat_id), language_model)
+        except OverloadedError as e:
+            return overloaded_response(e)
+        except TIMEOUT_ERRORS as e:
+            return timeout_response(e)
     # Check for errors in the bot response using is_error method
     if hasattr(bot_response, 'error') and bot_response.error:
         return JsonResponse({"error": bot_response.error}, status=400)
@@ -69,11 +155,14 @@ def search_congressgpt(request):
         }
         response.append(data)
     json_data = {"response": response}   
+    # In debug mode, show where the time went
+    if settings.DEBUG:
+        json_data["timings"] = timings
 
     # Return the bot's response to the client
     return JsonResponse(json_data)    
 
-def get_history_congressgpt(request):
+async def get_history_congressgpt(request):
     data = json.loads(request.body)
     token = data.get('token')
     chat_id = data.get('chat_id')
@@ -83,7 +172,13 @@ def get_history_congressgpt(request):
     if not token:
         return JsonResponse({"error": "token cannot be empty"}, status=400)
     # call a chatbot api
-    bot_response = history(token, chat_id)
+    try:
+        with deadlines.request_deadline():
+            bot_response = await history(token, chat_id)
+    except OverloadedError as e:
+        return overloaded_response(e)
+    except TIMEOUT_ERRORS as e:
+        return timeout_response(e)
     response = []
     for r in bot_response:
         data = {
@@ -101,7 +196,7 @@ def get_history_congressgpt(request):
     # Return the bot's response to the client
     return JsonResponse(json_data)    
 
-def get_historybar_congressgpt(request):
+async def get_historybar_congressgpt(request):
     data = json.loads(request.body)
     token = data.get('token')
 
@@ -109,7 +204,7 @@ def get_historybar_congressgpt(request):
         return JsonResponse({"error": "user_token cannot be empty"}, status=400)
 
     # call a chatbot api
-    bot_response = titles(token) 
+    bot_response = await titles(token) 
     response =[]
     for r in bot_response:
         data = {
@@ -0,0 +1,163 @@
+from typing import Dict, List, Optional
+from collections import OrderedDict
+import threading
+from search_results import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to estimating token counts from text length
+    tiktoken = None
+
+
+# Prompt token budget for each model. These are well under the context windows, to leave room for the
+# function definitions and the completion, and to keep OpenAI latency predictable.
+MODEL_TOKEN_BUDGETS = {
+    'gpt-4-1106-preview': 8000,
+    'gpt-3.5-turbo-1106': 6000,
+    'gpt-4': 4000,
+    'gpt-3.5-turbo': 2500
+}
+
+# Budget for models that are not listed above.
+DEFAULT_TOKEN_BUDGET = 2500
+
+# Tokens used by the chat format around each message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Token budget for the most recent search results, and for any earlier search results in the chat.
+RECENT_SEARCH_RESULTS_BUDGET = 1500
+EARLIER_SEARCH_RESULTS_BUDGET = 250
+
+# Most messages that are ever considered for the context, however small they are.
+MAX_CONTEXT_MESSAGES = 30
+
+
+class ContextBuilder:
+    """
+    Assembles the messages sent to GPT. The most recent messages are packed into a per-model token budget,
+    counted with the model's tokenizer. Token counts are cached, since most of a chat is re-sent every turn.
+    """
+    def __init__(self, budgets: Dict[str, int] = None, cache_size: int = 4096) -> None:
+        self.__budgets = dict(MODEL_TOKEN_BUDGETS if budgets is None else budgets)
+        self.__cache_size = cache_size
+        self.__token_counts = OrderedDict()
+        self.__encodings = {}
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+
+    def budget(self, language_model: str) -> int:
+        """
+        Prompt token budget for a model.
+        """
+        return self.__budgets.get(language_model, DEFAULT_TOKEN_BUDGET)
+
+
+    def count_tokens(self, text: str, language_model: str) -> int:
+        """
+        Count the tokens in a string for the given model.
+        """
+        encoding = self.__get_encoding(language_model)
+        key = (encoding.name if encoding is not None else None, text)
+
+        with self.__lock:
+            count = self.__token_counts.get(key)
+            if count is not None:
+                self.__token_counts.move_to_end(key)
+                self.__hits += 1
+                return count
+            self.__misses += 1
+
+        count = len(encoding.encode(text, disallowed_special=())) if encoding is not None else estimate_tokens(text)
+
+        with self.__lock:
+            self.__token_counts[key] = count
+            if len(self.__token_counts) > self.__cache_size:
+                self.__token_counts.popitem(last=False)
+        return count
+
+
+    def truncate(self, text: str, max_tokens: int, language_model: str) -> str:
+        """
+        Cut text down to at most max_tokens tokens for the given model.
+        """
+        encoding = self.__get_encoding(language_model)
+        if encoding is None:
+            if estimate_tokens(text) <= max_tokens:
+                return text
+            return text[:max(0, max_tokens - 1) * 4]
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        # Leave room for the ellipsis, which is a single token
+        return encoding.decode(tokens[:max(0, max_tokens - 1)]) + ' ...'
+
+
+    def build(self, chat: List[Dict], language_model: str, system_prompts: List[Dict] = []) -> List[Dict]:
+        """
+        Select the messages to send to GPT. Messages are taken newest first until the budget is spent.
+        The newest message is always kept, truncated if it is larger than the whole budget.
+        Search results other than the most recent are cut down to a small budget of their own.
+        Returns role and content only, in chronological order, followed by the system prompts.
+        """
+        budget = self.budget(language_model)
+        budget -= sum(self.__message_tokens(m['content'], language_model) for m in system_prompts)
+
+        recent_search_seen = False
+        selected = []
+        for i, message in enumerate(reversed(chat[-MAX_CONTEXT_MESSAGES:])):
+            content = message['content'] or ''
+
+            if message.get('search_response'):
+                limit = EARLIER_SEARCH_RESULTS_BUDGET if recent_search_seen else RECENT_SEARCH_RESULTS_BUDGET
+                recent_search_seen = True
+                if self.count_tokens(content, language_model) > limit:
+                    content = self.truncate(content, limit, language_model)
+
+            tokens = self.__message_tokens(content, language_model)
+            if i == 0 and tokens > budget:
+                content = self.truncate(content, max(0, budget - MESSAGE_OVERHEAD_TOKENS), language_model)
+                tokens = budget
+            elif tokens > budget:
+                break
+
+            budget -= tokens
+            selected.append({'role': message['role'], 'content': content})
+
+        return selected[::-1] + [{'role': m['role'], 'content': m['content']} for m in system_prompts]
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Token count cache statistics.
+        """
+        with self.__lock:
+            return {
+                'token_cache_hits': self.__hits,
+                'token_cache_misses': self.__misses,
+                'token_cache_size': len(self.__token_counts)
+            }
+
+
+    def __message_tokens(self, content: str, language_model: str) -> int:
+        """
+        Tokens taken up by one message, including the chat format overhead.
+        """
+        return self.count_tokens(content, language_model) + MESSAGE_OVERHEAD_TOKENS
+
+
+    def __get_encoding(self, language_model: str) -> Optional[object]:
+        """
+        Get the tokenizer for a model, or None if tiktoken is not installed.
+        """
+        if tiktoken is None:
+            return None
+        encoding = self.__encodings.get(language_model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(language_model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            self.__encodings[language_model] = encoding
+        return encoding
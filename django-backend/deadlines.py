@@ -0,0 +1,150 @@
+from typing import Callable, Optional, Tuple
+from contextlib import contextmanager
+import contextvars
+import time
+from decouple import config
+
+
+# Time in seconds a request may take in all.
+REQUEST_BUDGET = config("DEADLINE_REQUEST", default=90, cast=float)
+
+# Most time in seconds for one call to OpenAI, one request to Supabase, one search, and the BERT reranking
+# within a search. A search whose reranking runs out of time returns BM25's order instead.
+OPENAI_BUDGET = config("DEADLINE_OPENAI", default=60, cast=float)
+SUPABASE_BUDGET = config("DEADLINE_SUPABASE", default=15, cast=float)
+SEARCH_BUDGET = config("DEADLINE_SEARCH", default=30, cast=float)
+RERANK_BUDGET = config("DEADLINE_RERANK", default=5, cast=float)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised at a cancellation check when the request's deadline, or the budget of the stage it is in, has passed,
+    or when the request has been abandoned.
+    """
+    def __init__(self, stage: str, reason: str = 'deadline passed') -> None:
+        super().__init__(f'{stage}: {reason}')
+        self.stage = stage
+        self.reason = reason
+
+
+class Deadline:
+    """
+    The time by which a request, or one stage of it, has to finish, and whether it has been abandoned. A stage's
+    deadline is never later than its parent's, and is abandoned along with it.
+    """
+    __slots__ = ['expires_at', 'parent', '_cancelled']
+
+    def __init__(self, expires_at: float, parent: 'Deadline' = None) -> None:
+        self.expires_at = expires_at if parent is None else min(expires_at, parent.expires_at)
+        self.parent = parent
+        self._cancelled = False
+
+
+    def remaining(self) -> float:
+        """
+        Seconds left, which may be negative.
+        """
+        return self.expires_at - time.monotonic()
+
+
+    def cancel(self) -> None:
+        """
+        Mark the work as abandoned, so that it stops at its next check. Work on other threads sees this as well,
+        since copied contexts share the Deadline.
+        """
+        self._cancelled = True
+
+
+    def cancelled(self) -> bool:
+        return self._cancelled or (self.parent is not None and self.parent.cancelled())
+
+
+    def check(self, stage: str) -> None:
+        if self.cancelled():
+            raise DeadlineExceeded(stage, 'cancelled')
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar('deadline', default=None)
+
+
+def current() -> Optional[Deadline]:
+    """
+    The deadline of the innermost request or stage being run, if any.
+    """
+    return _current.get()
+
+
+@contextmanager
+def request_deadline(seconds: float = REQUEST_BUDGET):
+    """
+    Give the work in a with block a deadline of its own, seconds from now. The deadline is a context variable,
+    so it follows the request onto the search threads.
+    """
+    deadline = Deadline(time.monotonic() + seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def detached_context(seconds: float) -> Tuple[contextvars.Context, Deadline]:
+    """
+    An empty context with a deadline of its own, seconds from now, for work that is not part of the request that
+    starts it. Run the work with context.run, and cancel the deadline to stop it.
+    """
+    deadline = Deadline(time.monotonic() + seconds)
+    context = contextvars.Context()
+    context.run(_current.set, deadline)
+    return context, deadline
+
+
+@contextmanager
+def stage(seconds: float):
+    """
+    Give the work in a with block a budget of seconds, within the current deadline if there is one.
+    """
+    deadline = Deadline(time.monotonic() + seconds, _current.get())
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def check(stage: str) -> None:
+    """
+    Cancellation check between stages: raise DeadlineExceeded if the current deadline has passed or the request
+    has been abandoned. Does nothing outside a request.
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the current deadline, or None outside a request.
+    """
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def timeout(stage: str, budget: float) -> float:
+    """
+    Timeout for a network call: the stage's budget, cut short by the current deadline. Raises DeadlineExceeded
+    instead of returning a timeout that has already run out.
+    """
+    check(stage)
+    left = remaining()
+    return budget if left is None else min(budget, left)
+
+
+def call(stage: str, function: Callable, *args):
+    """
+    function(*args), unless the deadline passed while it waited to run.
+    """
+    check(stage)
+    return function(*args)
@@ -0,0 +1,206 @@
+"""
+Compress the passage embeddings in bert_embeddings for reranking, and measure what compression costs in recall.
+
+    python embedding_compression.py encode --codec int8 --out ./embeddings_int8
+    python embedding_compression.py encode --codec pq --subspaces 128 --out ./embeddings_pq128
+    python embedding_compression.py report --codecs float16 int8 pq --subspaces 64 128
+
+Set COMPRESSED_EMBEDDINGS_DIR to the output directory to have the web app rerank with the compressed embeddings.
+The report scores every bill against each CRS evaluation query with each codec, and compares the top k with the
+exact float32 ranking.
+"""
+from typing import Dict, Iterator, List, Tuple
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import time
+import numpy as np
+from encoders import LEGAL_BERT_PATH, DEFAULT_ONNX_DIR, load_encoder
+from embedding_store import CODECS, EmbeddingStore, Int8Codec, PQCodec, make_codec
+from search_engine import SearchEngine
+
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'crs_evaluation', 'crs_queries.json')
+
+
+def read_embeddings(conn: sqlite3.Connection, batch_size: int = 20000) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Batches of (bill ids, passage vectors), in bill order.
+    """
+    cur = conn.execute("""
+        select full_text_id, embedding_blob
+        from bert_embeddings
+        where embedding_blob is not null
+        order by full_text_id, id
+    """)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        vectors = np.stack([np.asarray(pickle.loads(row[1]), dtype=np.float32).ravel() for row in rows])
+        yield ids, vectors
+
+
+def sample_embeddings(conn: sqlite3.Connection, size: int) -> np.ndarray:
+    """
+    A random sample of passage vectors, for training codecs.
+    """
+    rows = conn.execute(
+        'select embedding_blob from bert_embeddings where embedding_blob is not null order by random() limit ?', (size,)
+    ).fetchall()
+    return np.stack([np.asarray(pickle.loads(row[0]), dtype=np.float32).ravel() for row in rows])
+
+
+def train_codec(name: str, sample: np.ndarray, subspaces: int):
+    """
+    Create a codec and fit it to a sample, if it needs fitting.
+    """
+    if name == 'int8':
+        codec = Int8Codec()
+        codec.train(sample)
+    elif name == 'pq':
+        codec = PQCodec()
+        codec.train(sample, subspaces)
+    else:
+        codec = make_codec(name)
+    return codec
+
+
+def build_store(conn: sqlite3.Connection, codec, database_version: str) -> EmbeddingStore:
+    """
+    Encode every passage embedding in the database with a trained codec.
+    """
+    count = conn.execute('select count(*) from bert_embeddings where embedding_blob is not null').fetchone()[0]
+    passage_bill_ids = np.empty(count, dtype=np.int64)
+    codes = None
+
+    offset = 0
+    for ids, vectors in read_embeddings(conn):
+        batch_codes = codec.encode(vectors)
+        if codes is None:
+            codes = np.empty((count,) + batch_codes.shape[1:], dtype=batch_codes.dtype)
+        codes[offset : offset + len(ids)] = batch_codes
+        passage_bill_ids[offset : offset + len(ids)] = ids
+        offset += len(ids)
+
+    if codes is None:
+        raise ValueError('The database has no embeddings to compress.')
+
+    bill_ids, starts = np.unique(passage_bill_ids, return_index=True)
+    starts = np.append(starts, count).astype(np.int64)
+    return EmbeddingStore(codec, bill_ids, starts, codes, database_version)
+
+
+def recall_at_k(exact: np.ndarray, approximate: np.ndarray, k: int) -> float:
+    """
+    Share of the exact top k bills that are also in the approximate top k.
+    """
+    exact = np.nan_to_num(exact, nan=-np.inf)
+    approximate = np.nan_to_num(approximate, nan=-np.inf)
+    k = min(k, len(exact))
+    exact_top = np.argpartition(-exact, k - 1)[:k]
+    approximate_top = np.argpartition(-approximate, k - 1)[:k]
+    return len(np.intersect1d(exact_top, approximate_top)) / k
+
+
+def load_queries(path: str) -> List[str]:
+    with open(path) as f:
+        queries = json.load(f)
+    return sorted({query for values in queries.values() for query in values})
+
+
+def report(
+    conn: sqlite3.Connection,
+    codecs: List[str],
+    subspaces: List[int],
+    queries: List[str],
+    encoder,
+    ks: List[int],
+    sample_size: int
+) -> List[Dict]:
+    """
+    Memory, compression ratio, scoring time and recall at k of each codec against exact float32 scores.
+    """
+    database_version = SearchEngine.DATABASE_VERSION
+    sample = sample_embeddings(conn, sample_size)
+    query_embeddings = encoder.encode(queries)
+
+    exact_store = build_store(conn, make_codec('float32'), database_version)
+    exact_scores = [exact_store.score_all(q) for q in query_embeddings]
+    exact_bytes = exact_store.memory_report()['code_bytes']
+
+    configurations = [(name, None) for name in codecs if name != 'pq']
+    if 'pq' in codecs:
+        configurations += [('pq', m) for m in subspaces]
+
+    rows = []
+    for name, m in [('float32', None)] + configurations:
+        start = time.perf_counter()
+        store = exact_store if name == 'float32' else build_store(conn, train_codec(name, sample, m), database_version)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = [store.score_all(q) for q in query_embeddings]
+        score_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        memory = store.memory_report()
+        row = {
+            'codec': name if m is None else f'pq{m}',
+            'bytes_per_passage': memory['bytes_per_passage'],
+            'total_bytes': memory['code_bytes'] + memory['codec_param_bytes'],
+            'compression': exact_bytes / memory['code_bytes'],
+            'build_seconds': build_seconds,
+            'full_scan_ms_per_query': score_ms
+        }
+        for k in ks:
+            row[f'recall@{k}'] = float(np.mean([recall_at_k(e, a, k) for e, a in zip(exact_scores, scores)]))
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['encode', 'report'])
+    parser.add_argument('--db', default=SearchEngine.DATABASE_PATH)
+    parser.add_argument('--codec', default='int8', choices=CODECS, help='Codec to encode with.')
+    parser.add_argument('--codecs', nargs='+', default=['float16', 'int8', 'pq'], choices=CODECS, help='Codecs to report on.')
+    parser.add_argument('--subspaces', type=int, nargs='+', default=[128], help='Product quantization subspaces.')
+    parser.add_argument('--sample', type=int, default=100000, help='Vectors to train codecs on.')
+    parser.add_argument('--out', default=None, help='Directory to write the compressed embeddings to.')
+    parser.add_argument('--queries', default=DEFAULT_QUERIES)
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 50, 150])
+    parser.add_argument('--encoder', default='torch', choices=['torch', 'onnx', 'hashing'])
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--output', default=None, help='Write the report to this JSON file.')
+    args = parser.parse_args()
+
+    conn = sqlite3.Connection(args.db)
+
+    if args.command == 'encode':
+        assert args.out is not None, '--out is required to encode.'
+        codec = train_codec(args.codec, sample_embeddings(conn, args.sample), args.subspaces[0])
+        store = build_store(conn, codec, SearchEngine.DATABASE_VERSION)
+        store.save(args.out)
+        memory = store.memory_report()
+        print(f'Wrote {memory["passages"]} passages of {memory["bills"]} bills to {args.out} '
+              f'({memory["code_bytes"] / 1e6:.1f} MB, {memory["bytes_per_passage"]:.0f} bytes per passage)')
+        return
+
+    encoder = load_encoder(LEGAL_BERT_PATH, args.encoder, args.onnx_dir)
+    rows = report(conn, args.codecs, args.subspaces, load_queries(args.queries), encoder, args.k, args.sample)
+
+    columns = list(rows[0])
+    print(''.join(f'{c:>24s}' for c in columns))
+    for row in rows:
+        print(''.join(f'{row[c]:>24.4f}' if isinstance(row[c], float) else f'{row[c]:>24}' for c in columns))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
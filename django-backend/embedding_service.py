@@ -0,0 +1,125 @@
+from typing import Dict, List
+from concurrent.futures import Future
+import logging
+import threading
+import time
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the batch size histogram buckets.
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+
+class BatchingEncoder:
+    """
+    Shares one encoder between concurrent callers by batching their requests. The first request opens a window of
+    max_wait_ms; everything that arrives before it closes, up to max_batch_size texts, is encoded in a single
+    padded forward pass and the embeddings are handed back to each caller. A longer window trades latency for
+    throughput. Exposes the same encode(texts) method as the encoder it wraps.
+    """
+    def __init__(self, encoder, max_batch_size: int = 32, max_wait_ms: float = 5) -> None:
+        self.__encoder = encoder
+        self.__max_batch_size = max_batch_size
+        self.__max_wait = max_wait_ms / 1000
+
+        self.__lock = threading.Lock()
+        self.__requests_ready = threading.Condition(self.__lock)
+        self.__pending = []
+
+        self.__batches = 0
+        self.__texts = 0
+        self.__histogram = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self.__encode_seconds = 0.0
+
+        self.__worker = threading.Thread(target=self.__work, name='embedding-batcher', daemon=True)
+        self.__worker.start()
+
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a list of texts. Blocks until the batch containing them has been encoded.
+        """
+        if len(texts) == 0:
+            return self.__encoder.encode(texts)
+
+        future = Future()
+        with self.__lock:
+            self.__pending.append((texts, future))
+            self.__requests_ready.notify()
+        return future.result()
+
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Batch counts and the histogram of batch sizes, for tuning the window and batch size.
+        """
+        with self.__lock:
+            labels = [f'<={b}' for b in BATCH_SIZE_BUCKETS] + [f'>{BATCH_SIZE_BUCKETS[-1]}']
+            return {
+                'batches': self.__batches,
+                'texts': self.__texts,
+                'mean_batch_size': self.__texts / self.__batches if self.__batches else 0,
+                'encode_seconds': self.__encode_seconds,
+                'queued_requests': len(self.__pending),
+                'batch_size_histogram': dict(zip(labels, self.__histogram)),
+                'max_batch_size': self.__max_batch_size,
+                'max_wait_ms': self.__max_wait * 1000
+            }
+
+
+    def __next_batch(self) -> List:
+        """
+        Wait for a request, then collect requests until the window closes or the batch is full.
+        """
+        with self.__lock:
+            while not self.__pending:
+                self.__requests_ready.wait()
+
+            window_closes = time.monotonic() + self.__max_wait
+            while sum(len(texts) for texts, _ in self.__pending) < self.__max_batch_size:
+                remaining = window_closes - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__requests_ready.wait(remaining)
+
+            # Take whole requests up to the batch size. A single oversized request is still encoded on its own.
+            batch = []
+            size = 0
+            while self.__pending and (not batch or size + len(self.__pending[0][0]) <= self.__max_batch_size):
+                texts, future = self.__pending.pop(0)
+                batch.append((texts, future))
+                size += len(texts)
+            return batch
+
+
+    def __work(self) -> None:
+        """
+        Worker thread: encode batches and fan the embeddings back out to the waiting callers.
+        """
+        while True:
+            batch = self.__next_batch()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+
+            start = time.perf_counter()
+            try:
+                embeddings = self.__encoder.encode(texts)
+            except Exception as e:
+                logger.exception('Embedding batch of %d texts failed.', len(texts))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - start
+
+            offset = 0
+            for request_texts, future in batch:
+                future.set_result(embeddings[offset : offset + len(request_texts)])
+                offset += len(request_texts)
+
+            with self.__lock:
+                self.__batches += 1
+                self.__texts += len(texts)
+                self.__encode_seconds += elapsed
+                bucket = next((i for i, b in enumerate(BATCH_SIZE_BUCKETS) if len(texts) <= b), len(BATCH_SIZE_BUCKETS))
+                self.__histogram[bucket] += 1
@@ -0,0 +1,305 @@
+from typing import Any, Dict, List
+import json
+import os
+import numpy as np
+
+
+# Version of the on-disk layout.
+FORMAT_VERSION = 1
+
+CODECS = ['float32', 'float16', 'int8', 'pq']
+
+
+class Float32Codec:
+    """
+    Stores vectors as they are. The reference the other codecs are measured against.
+    """
+    name = 'float32'
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.astype(np.float32)
+
+
+    def prepare(self, query: np.ndarray) -> np.ndarray:
+        return query.astype(np.float32)
+
+
+    def score(self, codes: np.ndarray, prepared: np.ndarray) -> np.ndarray:
+        return codes @ prepared
+
+
+    def params(self) -> Dict[str, np.ndarray]:
+        return {}
+
+
+class Float16Codec(Float32Codec):
+    """
+    Stores vectors at half precision: 2x smaller, with no training.
+    """
+    name = 'float16'
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.astype(np.float16)
+
+
+    def score(self, codes: np.ndarray, prepared: np.ndarray) -> np.ndarray:
+        # NumPy has no fast float16 matrix product, so the candidate rows are widened as they are scored
+        return codes.astype(np.float32) @ prepared
+
+
+class Int8Codec:
+    """
+    Symmetric scalar quantization with one scale per dimension: 4x smaller. The scales are folded into the query,
+    so the int8 codes are scored directly without being decoded.
+    """
+    name = 'int8'
+
+    def __init__(self, scale: np.ndarray = None) -> None:
+        self.scale = scale
+
+
+    def train(self, sample: np.ndarray, clip_quantile: float = 0.9999) -> None:
+        """
+        Pick each dimension's scale so that all but the most extreme values fit in [-127, 127].
+        """
+        self.scale = np.maximum(np.quantile(np.abs(sample), clip_quantile, axis=0), 1e-12).astype(np.float32) / 127
+
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+
+    def prepare(self, query: np.ndarray) -> np.ndarray:
+        return (query * self.scale).astype(np.float32)
+
+
+    def score(self, codes: np.ndarray, prepared: np.ndarray) -> np.ndarray:
+        return codes @ prepared
+
+
+    def params(self) -> Dict[str, np.ndarray]:
+        return {'scale': self.scale}
+
+
+class PQCodec:
+    """
+    Product quantization: each vector is split into subspaces, and each subvector is stored as the index of its
+    nearest of 256 centroids, so a vector takes one byte per subspace. Scores use asymmetric distance computation:
+    the query is compared with every centroid once, and a vector's score is the sum of its codes' table entries.
+    """
+    name = 'pq'
+
+    def __init__(self, centroids: np.ndarray = None) -> None:
+        # (subspaces, 256, subspace size)
+        self.centroids = centroids
+
+
+    def train(self, sample: np.ndarray, subspaces: int, iterations: int = 20, seed: int = 0) -> None:
+        """
+        Learn the centroids of each subspace with k-means on a sample of vectors.
+        """
+        dimension = sample.shape[1]
+        assert dimension % subspaces == 0, 'The embedding size must be divisible by the number of subspaces.'
+        size = dimension // subspaces
+        rng = np.random.default_rng(seed)
+        centroids = np.zeros((subspaces, 256, size), dtype=np.float32)
+        for m in range(subspaces):
+            sub = sample[:, m * size : (m + 1) * size].astype(np.float32)
+            centers = sub[rng.choice(len(sub), size=256, replace=len(sub) < 256)]
+            for _ in range(iterations):
+                assignment = _nearest(sub, centers)
+                counts = np.bincount(assignment, minlength=256)
+                sums = np.stack([np.bincount(assignment, weights=sub[:, j], minlength=256) for j in range(size)], axis=1)
+                empty = counts == 0
+                centers = np.where(empty[:, None], centers, sums / np.maximum(counts, 1)[:, None])
+            centroids[m] = centers
+        self.centroids = centroids
+
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subspaces, _, size = self.centroids.shape
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+        for m in range(subspaces):
+            codes[:, m] = _nearest(vectors[:, m * size : (m + 1) * size].astype(np.float32), self.centroids[m])
+        return codes
+
+
+    def prepare(self, query: np.ndarray) -> np.ndarray:
+        """
+        Table of the dot product of each query subvector with each centroid, (subspaces, 256).
+        """
+        subspaces, _, size = self.centroids.shape
+        return np.einsum('mkd,md->mk', self.centroids, query.astype(np.float32).reshape(subspaces, size))
+
+
+    def score(self, codes: np.ndarray, prepared: np.ndarray) -> np.ndarray:
+        return prepared[np.arange(prepared.shape[0]), codes].sum(axis=1)
+
+
+    def params(self) -> Dict[str, np.ndarray]:
+        return {'centroids': self.centroids}
+
+
+def make_codec(name: str, params: Dict[str, np.ndarray] = None):
+    """
+    Create a codec by name, with its trained parameters if it has any.
+    """
+    params = params or {}
+    if name == 'float32':
+        return Float32Codec()
+    elif name == 'float16':
+        return Float16Codec()
+    elif name == 'int8':
+        return Int8Codec(params.get('scale'))
+    elif name == 'pq':
+        return PQCodec(params.get('centroids'))
+    raise ValueError(f'Unrecognized embedding codec: {name}')
+
+
+class EmbeddingStore:
+    """
+    The passage embeddings of every bill, compressed with one of the codecs and laid out so that a bill's
+    passages are contiguous. Scores bills against a query the same way as the BERT reranking step, as the mean
+    dot product of the query with the bill's passages, without fetching or unpickling anything from SQLite.
+    """
+    def __init__(self, codec, bill_ids: np.ndarray, starts: np.ndarray, codes: np.ndarray, database_version: str) -> None:
+        self.__codec = codec
+        self.__bill_ids = bill_ids
+        self.__starts = starts
+        self.__codes = codes
+        self.database_version = database_version
+
+
+    @property
+    def codec(self) -> str:
+        return self.__codec.name
+
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(directory, 'bill_ids.npy'), self.__bill_ids)
+        np.save(os.path.join(directory, 'starts.npy'), self.__starts)
+        np.save(os.path.join(directory, 'codes.npy'), self.__codes)
+        params = self.__codec.params()
+        for key, value in params.items():
+            np.save(os.path.join(directory, f'{key}.npy'), value)
+
+        with open(meta_path, 'w') as f:
+            json.dump({
+                'format_version': FORMAT_VERSION,
+                'codec': self.__codec.name,
+                'params': list(params),
+                'database_version': self.database_version,
+                'bills': len(self.__bill_ids),
+                'passages': len(self.__codes)
+            }, f)
+
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'EmbeddingStore':
+        """
+        Load a store written by embedding_compression.py, memory-mapping the codes unless mmap is False.
+        """
+        meta_path = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"""
+                Compressed embeddings not found in {directory}.
+                Build them first with: python embedding_compression.py encode --out {directory}
+            """)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'Compressed embeddings in {directory} were written in an unsupported format.')
+
+        params = {key: np.load(os.path.join(directory, f'{key}.npy')) for key in meta['params']}
+        return cls(
+            make_codec(meta['codec'], params),
+            np.load(os.path.join(directory, 'bill_ids.npy')),
+            np.load(os.path.join(directory, 'starts.npy')),
+            np.load(os.path.join(directory, 'codes.npy'), mmap_mode='r' if mmap else None),
+            meta['database_version']
+        )
+
+
+    def score_bills(self, query: np.ndarray, ids: List[int]) -> np.ndarray:
+        """
+        Mean passage score of each bill, in the order given, with NaN for bills that have no embeddings.
+        """
+        return self.score_bills_multi(np.asarray(query, dtype=np.float32).reshape(1, -1), ids)[0]
+
+
+    def score_bills_multi(self, queries: np.ndarray, ids: List[int]) -> np.ndarray:
+        """
+        Mean passage score of each bill against each query, as a (queries, bills) array. The bills' passages are
+        gathered once and scored against every query.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+        ids = np.asarray(ids, dtype=np.int64)
+        scores = np.full((len(queries), len(ids)), np.nan, dtype=np.float32)
+        if len(ids) == 0 or len(self.__bill_ids) == 0:
+            return scores
+
+        positions = np.minimum(np.searchsorted(self.__bill_ids, ids), len(self.__bill_ids) - 1)
+        found = np.flatnonzero(self.__bill_ids[positions] == ids)
+        if len(found) == 0:
+            return scores
+
+        starts = self.__starts[positions[found]]
+        lengths = self.__starts[positions[found] + 1] - starts
+        # Row of every passage of every found bill, bill after bill
+        group_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        rows = np.repeat(starts - group_starts, lengths) + np.arange(lengths.sum())
+        codes = np.asarray(self.__codes[rows])
+
+        # Every bill in the store has at least one passage, so no group is empty
+        for i, query in enumerate(queries):
+            passage_scores = self.__codec.score(codes, self.__codec.prepare(query))
+            scores[i, found] = np.add.reduceat(passage_scores, group_starts) / lengths
+        return scores
+
+
+    def score_all(self, query: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        """
+        Mean passage score of every bill in the store, in bill_ids order, for exhaustive search.
+        """
+        prepared = self.__codec.prepare(np.asarray(query, dtype=np.float32).ravel())
+        passage_scores = np.concatenate([
+            self.__codec.score(np.asarray(self.__codes[i : i + batch_size]), prepared)
+            for i in range(0, len(self.__codes), batch_size)
+        ]) if len(self.__codes) else np.zeros(0, dtype=np.float32)
+        if len(passage_scores) == 0:
+            return passage_scores
+        return np.add.reduceat(passage_scores, self.__starts[:-1]) / np.diff(self.__starts)
+
+
+    @property
+    def bill_ids(self) -> np.ndarray:
+        return self.__bill_ids
+
+
+    def memory_report(self) -> Dict[str, Any]:
+        """
+        Bytes used by the codes and the codec parameters.
+        """
+        params_bytes = sum(value.nbytes for value in self.__codec.params().values())
+        return {
+            'codec': self.__codec.name,
+            'bills': len(self.__bill_ids),
+            'passages': len(self.__codes),
+            'code_bytes': self.__codes.nbytes,
+            'codec_param_bytes': params_bytes,
+            'index_bytes': self.__bill_ids.nbytes + self.__starts.nbytes,
+            'bytes_per_passage': self.__codes.nbytes / max(1, len(self.__codes))
+        }
+
+
+def _nearest(vectors: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest center to each vector, by Euclidean distance.
+    """
+    distances = (centers ** 2).sum(axis=1)[None, :] - 2 * vectors @ centers.T
+    return distances.argmin(axis=1)
@@ -0,0 +1,135 @@
+from typing import List
+import os
+import zlib
+import numpy as np
+
+
+# Hugging Face models used by the search engine.
+LEGAL_BERT_PATH = "nlpaueb/legal-bert-small-uncased"
+SENTENCE_BERT_PATH = "sentence-transformers/msmarco-MiniLM-L6-cos-v5"
+
+# Embedding size of each model.
+MODEL_DIMENSIONS = {
+    LEGAL_BERT_PATH: 512,
+    SENTENCE_BERT_PATH: 384
+}
+
+# Longest input, in tokens, that the encoders accept. Longer inputs are truncated.
+MAX_LENGTH = 512
+
+# Directory holding the models exported by onnx_export.py.
+DEFAULT_ONNX_DIR = './onnx_models'
+
+
+def mean_pool(last_hidden_state: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """
+    Average the token embeddings of each input, ignoring padding.
+    """
+    mask = attention_mask[..., np.newaxis].astype(last_hidden_state.dtype)
+    return (last_hidden_state * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+
+
+def onnx_model_file(model_path: str, onnx_dir: str = DEFAULT_ONNX_DIR, quantized: bool = True) -> str:
+    """
+    Location of the exported ONNX model for a Hugging Face model.
+    """
+    name = model_path.split('/')[-1]
+    return os.path.join(onnx_dir, f"{name}.int8.onnx" if quantized else f"{name}.onnx")
+
+
+class TorchEncoder:
+    """
+    Encodes text as the mean of a transformer's last hidden state, using PyTorch.
+    """
+    def __init__(self, model_path: str) -> None:
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+
+        self.__torch = torch
+        self.__tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.__model = AutoModel.from_pretrained(model_path)
+        self.__model.eval()
+
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts. Returns an array of shape (len(texts), embedding size).
+        """
+        inputs = self.__tokenizer(
+            texts, return_tensors="pt", max_length=MAX_LENGTH, truncation=True, padding=True
+        )
+        # Inference only, so skip building the autograd graph
+        with self.__torch.inference_mode():
+            outputs = self.__model(**inputs)
+        return mean_pool(outputs.last_hidden_state.numpy(), inputs['attention_mask'].numpy())
+
+
+class OnnxEncoder:
+    """
+    Encodes text like TorchEncoder, using a model exported to ONNX and run with ONNX Runtime on the CPU.
+    """
+    def __init__(self, model_path: str, onnx_file: str, intra_op_threads: int = 0) -> None:
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(onnx_file):
+            raise FileNotFoundError(f"""
+                ONNX model not found at {onnx_file}.
+                Export it first with: python onnx_export.py export
+            """)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+
+        self.__tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.__session = onnxruntime.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+        self.__input_names = [i.name for i in self.__session.get_inputs()]
+
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts. Returns an array of shape (len(texts), embedding size).
+        """
+        inputs = self.__tokenizer(
+            texts, return_tensors="np", max_length=MAX_LENGTH, truncation=True, padding=True
+        )
+        feed = {name: inputs[name].astype(np.int64) for name in self.__input_names}
+        last_hidden_state = self.__session.run(None, feed)[0]
+        return mean_pool(last_hidden_state, inputs['attention_mask'])
+
+
+class HashingEncoder:
+    """
+    Stand-in for a transformer that embeds text by hashing its words into a vector of the model's size. Needs no
+    model download, so benchmarks can run the whole search pipeline, but the embeddings only capture word overlap.
+    """
+    def __init__(self, model_path: str, dimension: int = None) -> None:
+        self.__dimension = dimension if dimension is not None else MODEL_DIMENSIONS[model_path]
+
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts. Returns an array of shape (len(texts), embedding size) with unit-length rows.
+        """
+        embeddings = np.zeros((len(texts), self.__dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                h = zlib.crc32(word.encode())
+                embeddings[i, h % self.__dimension] += 1.0 if h & 0x80000000 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def load_encoder(model_path: str, backend: str = 'torch', onnx_dir: str = DEFAULT_ONNX_DIR, quantized: bool = True):
+    """
+    Create an encoder for a Hugging Face model with the given backend: 'torch', 'onnx' or 'hashing'.
+    """
+    if backend == 'torch':
+        return TorchEncoder(model_path)
+    elif backend == 'onnx':
+        return OnnxEncoder(model_path, onnx_model_file(model_path, onnx_dir, quantized))
+    elif backend == 'hashing':
+        return HashingEncoder(model_path)
+    else:
+        raise ValueError(f'Unrecognized encoder backend: {backend}')
@@ -0,0 +1,231 @@
+from typing import Any, Dict, Iterable, List, Optional
+import sqlite3
+import numpy as np
+from metadata_store import MetadataStore, UNKNOWN_DATE
+
+
+# Columns of the metadata store that get one bitmap per distinct value.
+BITMAP_COLUMNS = ['publisher', 'bill_type', 'congress', 'legis_type', 'multiple_parties']
+
+
+class FilterIndex:
+    """
+    Precomputed filters over the bills in a MetadataStore. Each filterable value has a packed bitset with one bit
+    per bill, in store order, and dates are kept as a sorted array so that a range becomes two binary searches.
+    Bitmaps combine with bitwise operations on a few kilobytes, so a whole filter is evaluated in microseconds
+    and can be applied to BM25 candidates or to any array of bills.
+    """
+    def __init__(self, store: MetadataStore, conn: sqlite3.Connection = None) -> None:
+        self.__store = store
+        self.__size = len(store)
+        self.__bitmaps = {column: self.__build_bitmaps(column) for column in BITMAP_COLUMNS}
+
+        dates = np.asarray(store.date_days)
+        self.__date_order = np.argsort(dates, kind='stable')
+        self.__sorted_dates = dates[self.__date_order]
+        known = self.__sorted_dates[self.__sorted_dates != UNKNOWN_DATE]
+        self.__date_bounds = (int(known[0]), int(known[-1])) if len(known) else None
+
+        # Store position of the bill in each row of the congress_bm25 table, so that BM25 results can be read as
+        # rowids, which unlike ft_id do not need a lookup of each row, and the row of each bill, so that BM25 can
+        # skip the rows of bills that fail a filter
+        self.__bm25_positions = None
+        self.__bm25_rowids = None
+        if conn is not None:
+            rows = np.array(conn.execute('select rowid, ft_id from congress_bm25').fetchall(), dtype=np.int64).reshape(-1, 2)
+            positions = store.index_of(rows[:, 1])
+            self.__bm25_positions = np.full(int(rows[:, 0].max()) + 1 if len(rows) else 0, -1, dtype=np.int64)
+            self.__bm25_positions[rows[:, 0]] = positions
+            found = positions >= 0
+            self.__bm25_rowids = np.full(self.__size, -1, dtype=np.int64)
+            self.__bm25_rowids[positions[found]] = rows[found, 0]
+
+
+    def __build_bitmaps(self, column: str) -> Dict[Any, np.ndarray]:
+        """
+        One packed bitset per distinct value of a column.
+        """
+        if self.__store.kind(column) == 'category':
+            codes = np.asarray(self.__store.codes(column))
+            values = self.__store.categories(column)
+        else:
+            codes = np.asarray(self.__store.values(column))
+            values = None
+
+        bitmaps = {}
+        for code in np.unique(codes):
+            value = values[code] if values is not None else int(code)
+            bitmaps[value] = np.packbits(codes == code)
+        return bitmaps
+
+
+    def all(self) -> np.ndarray:
+        """
+        Bitmap with every bill set.
+        """
+        return np.packbits(np.ones(self.__size, dtype=bool))
+
+
+    def none(self) -> np.ndarray:
+        """
+        Bitmap with no bill set.
+        """
+        return np.zeros((self.__size + 7) // 8, dtype=np.uint8)
+
+
+    def bitmap(self, column: str, value) -> np.ndarray:
+        """
+        Bills whose column equals value.
+        """
+        bitmap = self.__bitmaps[column].get(value)
+        return bitmap if bitmap is not None else self.none()
+
+
+    def any_of(self, column: str, values: Iterable) -> np.ndarray:
+        """
+        Bills whose column equals any of the values.
+        """
+        result = self.none()
+        for value in values:
+            result = result | self.bitmap(column, value)
+        return result
+
+
+    def date_range(self, start_days: int, end_days: int) -> Optional[np.ndarray]:
+        """
+        Bills dated within a range of days since 1970-01-01, inclusive. Returns None if the range covers every
+        known date, so that the default range costs nothing.
+        """
+        if self.__date_bounds is None or (start_days <= self.__date_bounds[0] and end_days >= self.__date_bounds[1]):
+            return None
+        start = np.searchsorted(self.__sorted_dates, max(start_days, UNKNOWN_DATE + 1), side='left')
+        end = np.searchsorted(self.__sorted_dates, end_days, side='right')
+        mask = np.zeros(self.__size, dtype=bool)
+        mask[self.__date_order[start:end]] = True
+        return np.packbits(mask)
+
+
+    def for_params(self, params: Dict[str, Any]) -> Optional[np.ndarray]:
+        """
+        Bitmap for the filters in a set of search params (chamber, date_range, require_bipartisan and
+        legislative_types), or None if they do not filter anything out.
+        """
+        bitmaps = []
+        if params.get('chamber', 'any') != 'any':
+            bitmaps.append(self.bitmap('publisher', params['chamber']))
+
+        if 'date_range' in params:
+            date_range = params['date_range']
+            bitmaps.append(self.date_range(
+                _days(date_range['start_year'], date_range['start_month'], date_range['start_day']),
+                _days(date_range['end_year'], date_range['end_month'], date_range['end_day'])
+            ))
+
+        if params.get('require_bipartisan') is True:
+            bitmaps.append(self.bitmap('multiple_parties', 1))
+
+        legislative_types = params.get('legislative_types', 'any')
+        if legislative_types != 'any':
+            if isinstance(legislative_types, str):
+                legislative_types = [legislative_types]
+            bitmaps.append(self.any_of('legis_type', legislative_types))
+
+        return intersect([b for b in bitmaps if b is not None])
+
+
+    def count(self, bitmap: np.ndarray) -> int:
+        """
+        Number of bills set in a bitmap.
+        """
+        return int(np.unpackbits(bitmap, count=self.__size).sum())
+
+
+    def positions(self, bitmap: np.ndarray) -> np.ndarray:
+        """
+        Store positions of the bills set in a bitmap, for indexing into dense arrays such as embeddings.
+        """
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.__size))
+
+
+    def ids(self, bitmap: np.ndarray) -> np.ndarray:
+        """
+        Ids of the bills set in a bitmap.
+        """
+        return np.asarray(self.__store.ids)[self.positions(bitmap)]
+
+
+    def contains(self, bitmap: np.ndarray, ids) -> np.ndarray:
+        """
+        Boolean mask of which of the given bill ids are set in a bitmap.
+        """
+        return self.__contains_positions(bitmap, self.__store.index_of(ids))
+
+
+    def bm25_ids(self, bitmap: np.ndarray, rowids) -> np.ndarray:
+        """
+        Ids of the bills in the given rows of the congress_bm25 table that are set in a bitmap, in the order of
+        the rows.
+        """
+        if self.__bm25_positions is None:
+            raise ValueError('FilterIndex was built without a database connection.')
+        rowids = np.asarray(rowids, dtype=np.int64)
+        positions = np.full(len(rowids), -1, dtype=np.int64)
+        indexed = rowids < len(self.__bm25_positions)
+        positions[indexed] = self.__bm25_positions[rowids[indexed]]
+        return np.asarray(self.__store.ids)[positions[self.__contains_positions(bitmap, positions)]]
+
+
+    def bm25_rowids(self, bitmap: np.ndarray) -> np.ndarray:
+        """
+        Rows of the congress_bm25 table for the bills set in a bitmap.
+        """
+        if self.__bm25_rowids is None:
+            raise ValueError('FilterIndex was built without a database connection.')
+        rowids = self.__bm25_rowids[self.positions(bitmap)]
+        return rowids[rowids >= 0]
+
+
+    @staticmethod
+    def __contains_positions(bitmap: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of which of the given store positions are set in a bitmap. Positions of -1 are not.
+        """
+        found = positions >= 0
+        bits = np.zeros(len(positions), dtype=bool)
+        bits[found] = (bitmap[positions[found] >> 3] >> (7 - (positions[found] & 7))) & 1
+        return bits
+
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Number of bitmaps per column and the memory they use.
+        """
+        bitmap_bytes = {column: sum(b.nbytes for b in bitmaps.values()) for column, bitmaps in self.__bitmaps.items()}
+        return {
+            'bills': self.__size,
+            'bitmaps': {column: len(bitmaps) for column, bitmaps in self.__bitmaps.items()},
+            'bitmap_bytes': bitmap_bytes,
+            'date_index_bytes': self.__date_order.nbytes + self.__sorted_dates.nbytes,
+            'bm25_position_bytes': self.__bm25_positions.nbytes if self.__bm25_positions is not None else 0,
+            'bm25_rowid_bytes': self.__bm25_rowids.nbytes if self.__bm25_rowids is not None else 0
+        }
+
+
+def intersect(bitmaps: List[np.ndarray]) -> Optional[np.ndarray]:
+    """
+    Bills set in every bitmap, or None if there are no bitmaps.
+    """
+    if len(bitmaps) == 0:
+        return None
+    result = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        result = result & bitmap
+    return result
+
+
+def _days(year: int, month: int, day: int) -> int:
+    """
+    Days since 1970-01-01 for a date given as numbers. Days past the end of the month roll over into the next.
+    """
+    month_start = np.datetime64(f'{int(year):04d}-{int(month):02d}', 'M').astype('datetime64[D]')
+    return int((month_start + (int(day) - 1)).astype(np.int64))
@@ -0,0 +1,91 @@
+from typing import Any, Dict, Optional
+import copy
+import threading
+import time
+import numpy as np
+
+
+class SemanticResponseCache:
+    """
+    GPT's responses to opening prompts, looked up by meaning rather than by exact text. Prompts are embedded with
+    Sentence BERT, and a prompt whose embedding is at least threshold similar (by cosine) to a cached prompt's
+    gets the cached response, whether that is a search function call or an answer. Each language model has its
+    own table of at most max_entries prompts, held as one matrix so that a lookup is a single matrix-vector
+    product; when a table is full the oldest entry is replaced. Entries expire after ttl seconds.
+    """
+    def __init__(self, encoder, threshold: float = 0.95, ttl: float = 86400, max_entries: int = 10000) -> None:
+        self.__encoder = encoder
+        self.__threshold = threshold
+        self.__ttl = ttl
+        self.__max_entries = max_entries
+        # language model -> {'embeddings', 'expires', 'responses', 'next'}
+        self.__tables = {}
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__stores = 0
+
+
+    def embed(self, prompt: str) -> np.ndarray:
+        """
+        Unit-length embedding of a prompt, for lookup and store.
+        """
+        embedding = np.asarray(self.__encoder.encode([prompt]), dtype=np.float32).ravel()
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+
+    def lookup(self, language_model: str, embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """
+        The cached response to the most similar unexpired prompt, if it is similar enough.
+        """
+        with self.__lock:
+            table = self.__tables.get(language_model)
+            if table is not None:
+                similarities = table['embeddings'] @ embedding
+                similarities[table['expires'] < time.time()] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.__threshold:
+                    self.__hits += 1
+                    return copy.deepcopy(table['responses'][best])
+            self.__misses += 1
+            return None
+
+
+    def store(self, language_model: str, embedding: np.ndarray, response: Dict[str, Any]) -> None:
+        """
+        Cache GPT's response to a prompt.
+        """
+        with self.__lock:
+            table = self.__tables.get(language_model)
+            if table is None:
+                table = {
+                    'embeddings': np.zeros((self.__max_entries, len(embedding)), dtype=np.float32),
+                    # Empty slots never match, since they have already expired
+                    'expires': np.zeros(self.__max_entries, dtype=np.float64),
+                    'responses': [None] * self.__max_entries,
+                    'next': 0
+                }
+                self.__tables[language_model] = table
+
+            slot = table['next']
+            table['embeddings'][slot] = embedding
+            table['expires'][slot] = time.time() + self.__ttl
+            table['responses'][slot] = copy.deepcopy(response)
+            table['next'] = (slot + 1) % self.__max_entries
+            self.__stores += 1
+
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hit and miss counts, and the number of live entries for each language model.
+        """
+        now = time.time()
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'hit_rate': self.__hits / (self.__hits + self.__misses) if self.__hits + self.__misses else 0,
+                'stores': self.__stores,
+                'entries': {model: int((table['expires'] >= now).sum()) for model, table in self.__tables.items()},
+                'threshold': self.__threshold
+            }
@@ -0,0 +1,343 @@
+from typing import Any, Dict, List, Optional
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import sqlite3
+import numpy as np
+from records import Bill
+
+
+# Version of the on-disk layout. Stores written with another version are rebuilt.
+FORMAT_VERSION = 1
+
+# (key in search results, SQL expression, kind). 'text' columns are stored as UTF-8 bytes with offsets,
+# 'category' columns as integer codes into a list of distinct values, and 'int' columns as int64 arrays.
+# An 'int' column falls back to 'category' if the database holds anything but integers in it.
+COLUMNS = [
+    ('summary_text', 'coalesce(bs.summary_text, substr(ft.text, 1, 300))', 'text'),
+    ('title', 'ft.title', 'text'),
+    ('official_title', 'ft.official_title', 'text'),
+    ('available_chunks', 'ft.available_chunks', 'int'),
+    ('multiple_parties', 'ft.multiple_parties', 'int'),
+    ('generated_url', 'ft.generated_url', 'text'),
+    ('stage_in_process', 'ft.file_stage', 'category'),
+    ('bill_number', 'ft.file_number', 'int'),
+    ('bill_type', 'ft.file_chamber', 'category'),
+    ('congress', 'ft.file_congress', 'int'),
+    ('date', 'ft.date', 'category'),
+    ('legis_type', 'ft.legis_type', 'category'),
+    ('committee_name', 'ft.committee_name', 'category'),
+    ('publisher', 'ft.publisher', 'category'),
+    ('current_chamber', 'ft.current_chamber', 'category'),
+    ('session', 'ft.session', 'int')
+]
+
+# Days since 1970-01-01 for bills whose date could not be parsed.
+UNKNOWN_DATE = np.iinfo(np.int32).min
+
+
+class MetadataStore:
+    """
+    Bill metadata held in memory as columns, indexed by each bill's position in the sorted array of ids.
+    Hydrating search results becomes array lookups instead of a SQL query, and filters can be evaluated on whole
+    columns at once. Built from the SQLite database and saved as .npy files, which are memory-mapped when loaded,
+    so that processes on one machine share the pages.
+    """
+    def __init__(self, ids: np.ndarray, columns: Dict[str, Dict[str, Any]], date_days: np.ndarray, database_version: str) -> None:
+        self.__ids = ids
+        self.__columns = columns
+        self.__date_days = date_days
+        self.database_version = database_version
+
+
+    @classmethod
+    def build(cls, conn: sqlite3.Connection, database_version: str) -> 'MetadataStore':
+        """
+        Read the metadata of every bill from the database.
+        """
+        select = ', '.join(expression for _, expression, _ in COLUMNS)
+        rows = conn.execute(f"""
+            select ft.id, {select}
+            from full_texts ft left join bill_summaries bs
+                on ft.summaries_match = bs.id
+            order by ft.id
+        """).fetchall()
+
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = {}
+        for i, (name, _, kind) in enumerate(COLUMNS):
+            values = [row[i + 1] for row in rows]
+            if kind == 'int' and not all(v is None or type(v) == int for v in values):
+                kind = 'category'
+            columns[name] = cls.__encode_column(values, kind)
+
+        date_days = np.array([_parse_date(d) for d in (row[1 + _column_position('date')] for row in rows)], dtype=np.int32)
+        return cls(ids, columns, date_days, database_version)
+
+
+    @staticmethod
+    def __encode_column(values: List, kind: str) -> Dict[str, Any]:
+        """
+        Encode one column's values as arrays.
+        """
+        nulls = np.array([v is None for v in values], dtype=bool)
+        column = {'kind': kind}
+        if kind == 'text':
+            encoded = [v.encode('utf-8') if v is not None else b'' for v in values]
+            column['offsets'] = np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)]).astype(np.int64)
+            column['data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        elif kind == 'category':
+            categories = sorted(set(values), key=lambda v: (v is None, str(type(v)), v if v is not None else 0))
+            code_of = {v: i for i, v in enumerate(categories)}
+            column['categories'] = categories
+            column['codes'] = np.array([code_of[v] for v in values], dtype=np.int32)
+        elif kind == 'int':
+            column['values'] = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+        else:
+            raise ValueError(f'Unrecognized column kind: {kind}')
+
+        if nulls.any() and kind != 'category':
+            column['nulls'] = nulls
+        return column
+
+
+    def save(self, directory: str) -> None:
+        """
+        Write the store to a directory, replacing any store already there. Each file is written under a temporary
+        name and renamed into place, so that processes with the old files memory-mapped keep reading the old
+        contents instead of a file being rewritten under them. Callers other than open() must make sure no other
+        process is saving or loading the same directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        _save_array(os.path.join(directory, 'ids.npy'), self.__ids)
+        _save_array(os.path.join(directory, 'date_days.npy'), self.__date_days)
+
+        meta = {'format_version': FORMAT_VERSION, 'database_version': self.database_version, 'count': len(self.__ids), 'columns': {}}
+        for name, column in self.__columns.items():
+            meta['columns'][name] = {
+                'kind': column['kind'],
+                'arrays': [key for key, value in column.items() if isinstance(value, np.ndarray)],
+                'categories': column.get('categories')
+            }
+            for key, value in column.items():
+                if isinstance(value, np.ndarray):
+                    _save_array(os.path.join(directory, f'{name}.{key}.npy'), value)
+
+        # Written last, so that an interrupted save is not mistaken for a complete one
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> Optional['MetadataStore']:
+        """
+        Load a saved store, memory-mapping its arrays unless mmap is False. Returns None if there is no complete
+        store in the directory or it was written in another format.
+        """
+        meta_path = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('format_version') != FORMAT_VERSION:
+            return None
+
+        mmap_mode = 'r' if mmap else None
+        columns = {}
+        for name, column_meta in meta['columns'].items():
+            column = {'kind': column_meta['kind']}
+            if column_meta['categories'] is not None:
+                column['categories'] = column_meta['categories']
+            for key in column_meta['arrays']:
+                column[key] = np.load(os.path.join(directory, f'{name}.{key}.npy'), mmap_mode=mmap_mode)
+            columns[name] = column
+
+        return cls(
+            np.load(os.path.join(directory, 'ids.npy'), mmap_mode=mmap_mode),
+            columns,
+            np.load(os.path.join(directory, 'date_days.npy'), mmap_mode=mmap_mode),
+            meta['database_version']
+        )
+
+
+    @classmethod
+    def open(cls, directory: str, conn_factory, database_version: str) -> 'MetadataStore':
+        """
+        Load the store saved in directory, or build and save it if it is missing or was built from another
+        version of the database. Server processes starting together take turns, so that one builds the store and
+        the others load what it saved.
+        """
+        with _locked(directory):
+            store = cls.load(directory)
+            if store is not None and store.database_version == database_version:
+                return store
+
+            conn = conn_factory()
+            try:
+                store = cls.build(conn, database_version)
+            finally:
+                conn.close()
+            store.save(directory)
+
+            store = cls.load(directory)
+            if store is None:
+                raise RuntimeError(f'The metadata store saved in {directory} could not be loaded.')
+            return store
+
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+
+    @property
+    def ids(self) -> np.ndarray:
+        """
+        Bill ids in ascending order. A bill's position in this array is its index in every column.
+        """
+        return self.__ids
+
+
+    @property
+    def date_days(self) -> np.ndarray:
+        """
+        Each bill's date as days since 1970-01-01, or UNKNOWN_DATE.
+        """
+        return self.__date_days
+
+
+    def index_of(self, ids) -> np.ndarray:
+        """
+        Positions of the given bill ids, with -1 for ids that are not in the store.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.__ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.__ids, ids), len(self.__ids) - 1)
+        return np.where(self.__ids[positions] == ids, positions, -1)
+
+
+    def codes(self, name: str) -> np.ndarray:
+        """
+        Integer codes of a category column, for filtering.
+        """
+        return self.__columns[name]['codes']
+
+
+    def categories(self, name: str) -> List:
+        """
+        Distinct values of a category column. A value's position in this list is its code.
+        """
+        return self.__columns[name]['categories']
+
+
+    def values(self, name: str) -> np.ndarray:
+        """
+        Values of an int column, for filtering. Null entries are 0.
+        """
+        return self.__columns[name]['values']
+
+
+    def kind(self, name: str) -> str:
+        return self.__columns[name]['kind']
+
+
+    def hydrate(self, ids: List[int]) -> List[Bill]:
+        """
+        The same records as a search engine summary lookup, in the order of the given ids. Ids that are not in the
+        store are left out.
+        """
+        positions = self.index_of(ids)
+        positions = positions[positions >= 0]
+
+        decoded = {name: self.__gather(column, positions) for name, column in self.__columns.items()}
+        results = []
+        for i, position in enumerate(positions):
+            bill = Bill(int(self.__ids[position]))
+            for name, values in decoded.items():
+                setattr(bill, name, values[i])
+            results.append(bill)
+        return results
+
+
+    @staticmethod
+    def __gather(column: Dict[str, Any], positions: np.ndarray) -> List:
+        """
+        Decode the values of one column at the given positions.
+        """
+        kind = column['kind']
+        if kind == 'text':
+            offsets = column['offsets']
+            data = column['data']
+            values = [bytes(data[offsets[p] : offsets[p + 1]]).decode('utf-8') for p in positions]
+        elif kind == 'category':
+            categories = column['categories']
+            values = [categories[code] for code in column['codes'][positions]]
+        else:
+            values = column['values'][positions].tolist()
+
+        if 'nulls' in column:
+            nulls = column['nulls'][positions]
+            values = [None if null else value for value, null in zip(values, nulls)]
+        return values
+
+
+    def memory_report(self) -> Dict[str, Any]:
+        """
+        Bytes held by each column, and in total.
+        """
+        def size(column):
+            return sum(value.nbytes for value in column.values() if isinstance(value, np.ndarray))
+
+        columns = {name: size(column) for name, column in self.__columns.items()}
+        columns['id'] = self.__ids.nbytes
+        columns['date_days'] = self.__date_days.nbytes
+        return {
+            'bills': len(self.__ids),
+            'database_version': self.database_version,
+            'column_bytes': columns,
+            'total_bytes': sum(columns.values())
+        }
+
+
+def _save_array(path: str, array: np.ndarray) -> None:
+    """
+    Write an array to a .npy file by renaming a new file into place, leaving any existing file's contents as they
+    are for the processes that have it memory-mapped.
+    """
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def _locked(directory: str):
+    """
+    Hold an exclusive lock on a store directory, shared by every process on the machine.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _column_position(name: str) -> int:
+    return next(i for i, (column, _, _) in enumerate(COLUMNS) if column == name)
+
+
+def _parse_date(value) -> int:
+    """
+    Days since 1970-01-01 for a date stored as text starting with YYYY-MM-DD.
+    """
+    try:
+        date = np.datetime64(str(value)[:10], 'D')
+    except (ValueError, TypeError):
+        return UNKNOWN_DATE
+    return UNKNOWN_DATE if np.isnat(date) else int(date.astype(np.int64))
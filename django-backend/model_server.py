@@ -0,0 +1,222 @@
+"""
+Standalone model server. Loads the search engine's encoders once and serves encode requests from any number of
+web workers over a UNIX socket, so that each worker does not hold its own copy of the models.
+
+    MODEL_SERVER_AUTHKEY=<secret> python model_server.py --backend onnx
+
+Set MODEL_SERVER_SOCKET to the socket it logs at startup, and MODEL_SERVER_AUTHKEY to the same secret, to have the
+web app use it.
+Requests are pickled, so anyone who can connect with the key can run code in the server: the key has to be
+secret, and the socket is kept in a directory that only its owner can open.
+"""
+from typing import Dict, List
+from multiprocessing.connection import AuthenticationError, Client, Listener, answer_challenge, deliver_challenge
+import argparse
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import numpy as np
+from encoders import LEGAL_BERT_PATH, SENTENCE_BERT_PATH, DEFAULT_ONNX_DIR, load_encoder
+from embedding_service import BatchingEncoder
+from deadlines import DeadlineExceeded
+import deadlines
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f'congressgpt-{os.getuid()}', 'models.sock')
+
+# Seconds the server waits for the next request on a connection, or for a client to finish authenticating,
+# before closing the connection. Clients reconnect when they find their connection closed.
+DEFAULT_RECEIVE_TIMEOUT = 60
+
+# Seconds a client waits for a reply outside a request, which has a deadline of its own.
+DEFAULT_REQUEST_TIMEOUT = 30
+
+# Names that clients use for the models.
+MODELS = {
+    'legal_bert': LEGAL_BERT_PATH,
+    'sentence_bert': SENTENCE_BERT_PATH
+}
+
+
+class RemoteEncoder:
+    """
+    Client for one model on the model server. Exposes the same encode(texts) method as a local encoder.
+    Each thread keeps its own connection, since a connection carries one request at a time.
+    A reply is waited for until the request's deadline, or for request_timeout seconds outside a request.
+    """
+    def __init__(self, model_name: str, address: str, authkey: bytes, request_timeout: float = DEFAULT_REQUEST_TIMEOUT) -> None:
+        assert model_name in MODELS, 'Unrecognized model name.'
+        self.__model_name = model_name
+        self.__address = address
+        self.__authkey = authkey
+        self.__request_timeout = request_timeout
+        self.__local = threading.local()
+
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts on the model server.
+        """
+        return self.__request('encode', self.__model_name, texts)
+
+
+    def stats(self) -> Dict:
+        """
+        Batching statistics for this model on the model server.
+        """
+        return self.__request('stats', self.__model_name)
+
+
+    def __request(self, *request):
+        """
+        Send a request and wait for the reply, reconnecting once if the connection has gone away. Raises
+        DeadlineExceeded if no reply comes in time.
+        """
+        for attempt in range(2):
+            timeout = deadlines.timeout('model_server', self.__request_timeout)
+            connection = getattr(self.__local, 'connection', None)
+            try:
+                if connection is None:
+                    connection = Client(self.__address, family='AF_UNIX', authkey=self.__authkey)
+                    self.__local.connection = connection
+                connection.send(request)
+                if not connection.poll(timeout):
+                    # The reply may still come, and must not be read as the reply to the next request
+                    self.__local.connection = None
+                    connection.close()
+                    raise DeadlineExceeded('model_server', 'no reply in time')
+                status, result = connection.recv()
+                break
+            except (EOFError, ConnectionError, BrokenPipeError):
+                self.__local.connection = None
+                if attempt == 1:
+                    raise
+
+        if status == 'error':
+            raise RuntimeError(f'Model server error: {result}')
+        return result
+
+
+class ModelServer:
+    """
+    Serves encode requests for every model in MODELS. Each connection is authenticated and handled on its own
+    thread, and requests from all connections are batched together per model.
+    """
+    def __init__(
+        self, address: str, authkey: bytes, encoders: Dict[str, BatchingEncoder], receive_timeout: float = DEFAULT_RECEIVE_TIMEOUT
+    ) -> None:
+        self.__address = address
+        self.__authkey = authkey
+        self.__encoders = encoders
+        self.__receive_timeout = receive_timeout
+
+
+    def serve_forever(self) -> None:
+        """
+        Accept connections until the process is stopped.
+        """
+        prepare_socket_directory(self.__address)
+        if os.path.exists(self.__address):
+            os.remove(self.__address)
+
+        # Connections are authenticated on their own threads, so that a client that never answers the challenge
+        # does not hold up the others
+        with Listener(self.__address, family='AF_UNIX') as listener:
+            os.chmod(self.__address, 0o600)
+            logger.info('Model server listening on %s', self.__address)
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception:
+                    logger.exception('Failed to accept a connection.')
+                    continue
+                threading.Thread(target=self.__handle, args=(connection,), daemon=True).start()
+
+
+    def __handle(self, connection) -> None:
+        """
+        Authenticate a connection and answer its requests until the client disconnects or goes quiet for longer
+        than the receive timeout.
+        """
+        with connection:
+            set_receive_timeout(connection, self.__receive_timeout)
+            try:
+                deliver_challenge(connection, self.__authkey)
+                answer_challenge(connection, self.__authkey)
+            except (AuthenticationError, OSError, EOFError) as e:
+                logger.warning('Closed a connection that failed to authenticate: %r', e)
+                return
+
+            while True:
+                try:
+                    request = connection.recv()
+                except (OSError, EOFError):
+                    return
+
+                try:
+                    command, model_name, *args = request
+                    encoder = self.__encoders[model_name]
+                    if command == 'encode':
+                        reply = ('ok', encoder.encode(*args))
+                    elif command == 'stats':
+                        reply = ('ok', encoder.stats())
+                    else:
+                        reply = ('error', f'Unrecognized command: {command}')
+                except Exception as e:
+                    logger.exception('Request failed.')
+                    reply = ('error', repr(e))
+
+                connection.send(reply)
+
+
+def prepare_socket_directory(address: str) -> None:
+    """
+    Create the directory that will hold the socket, open to this user only, or check that an existing one is.
+    """
+    directory = os.path.dirname(os.path.abspath(address))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'{directory} has to be owned by this user and closed to others (chmod 700).')
+
+
+def set_receive_timeout(connection, seconds: float) -> None:
+    """
+    Make reads from a connection fail with an OSError after seconds without data. The timeout is set on the
+    socket itself, so it applies to the connection's own blocking reads.
+    """
+    with socket.fromfd(connection.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', int(seconds), int(seconds % 1 * 1000000))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'hashing'])
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--batch-window-ms', type=float, default=5)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--receive-timeout', type=float, default=DEFAULT_RECEIVE_TIMEOUT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    authkey = os.environ.get('MODEL_SERVER_AUTHKEY')
+    if not authkey:
+        parser.error('Set MODEL_SERVER_AUTHKEY to a secret shared with the web app.')
+    encoders = {
+        name: BatchingEncoder(load_encoder(path, args.backend, args.onnx_dir), args.max_batch_size, args.batch_window_ms)
+        for name, path in MODELS.items()
+    }
+    ModelServer(args.socket, authkey.encode(), encoders, args.receive_timeout).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Export the search engine's encoders to ONNX with dynamic int8 quantization, check that the exported models
+agree with PyTorch, and benchmark both backends on the CPU.
+
+    python onnx_export.py export
+    python onnx_export.py parity --tolerance 0.99
+    python onnx_export.py benchmark --queries 200 --batch-size 16
+
+Set ENCODER_BACKEND=onnx to have the web app use the exported models.
+"""
+from typing import Dict, List
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+from encoders import (
+    LEGAL_BERT_PATH, SENTENCE_BERT_PATH, DEFAULT_ONNX_DIR, MAX_LENGTH, OnnxEncoder, TorchEncoder, onnx_model_file
+)
+
+
+MODEL_PATHS = [LEGAL_BERT_PATH, SENTENCE_BERT_PATH]
+
+# Minimum cosine similarity between an ONNX embedding and the PyTorch embedding of the same text.
+DEFAULT_PARITY_TOLERANCE = 0.99
+
+# Texts used for parity checks and benchmarks when no database is given.
+SAMPLE_TEXTS = [
+    'climate change',
+    'drug pricing and intellectual property',
+    'unemployment insurance',
+    'department of homeland security appropriations',
+    'A bill to amend the Internal Revenue Code of 1986 to extend the credit for electricity produced from renewable resources.',
+    'To require the Secretary of Energy to establish a program for the research, development, and demonstration of alternative fuels and vehicles.',
+    'Making appropriations for energy and water development and related agencies for the fiscal year ending September 30, 2022, and for other purposes.',
+    'To improve the cybersecurity of pipelines and liquefied natural gas facilities, and for other purposes.'
+]
+
+
+def export(model_path: str, onnx_dir: str, opset: int) -> None:
+    """
+    Export one model to ONNX, then write a dynamically quantized int8 copy next to it.
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path)
+    model.eval()
+
+    inputs = tokenizer(['an example input', 'a second example'], return_tensors='pt', padding=True, max_length=MAX_LENGTH, truncation=True)
+    input_names = [name for name in ['input_ids', 'attention_mask', 'token_type_ids'] if name in inputs]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    fp32_file = onnx_model_file(model_path, onnx_dir, quantized=False)
+    int8_file = onnx_model_file(model_path, onnx_dir, quantized=True)
+
+    with torch.inference_mode():
+        torch.onnx.export(
+            model,
+            tuple(inputs[name] for name in input_names),
+            fp32_file,
+            input_names=input_names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset
+        )
+    quantize_dynamic(fp32_file, int8_file, weight_type=QuantType.QInt8)
+
+    print(f'{model_path}: wrote {fp32_file} ({os.path.getsize(fp32_file) / 1e6:.1f} MB) '
+          f'and {int8_file} ({os.path.getsize(int8_file) / 1e6:.1f} MB)')
+
+
+def load_texts(db_path: str, limit: int) -> List[str]:
+    """
+    Bill titles from the database to encode, or the built-in samples if no database is given.
+    """
+    if db_path is None:
+        return SAMPLE_TEXTS
+    conn = sqlite3.Connection(db_path)
+    rows = conn.execute('select title from full_texts where title is not null order by random() limit ?', (limit,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def load_encoders(model_path: str, onnx_dir: str) -> Dict[str, object]:
+    """
+    The PyTorch encoder and both ONNX encoders for a model.
+    """
+    return {
+        'torch': TorchEncoder(model_path),
+        'onnx-fp32': OnnxEncoder(model_path, onnx_model_file(model_path, onnx_dir, quantized=False)),
+        'onnx-int8': OnnxEncoder(model_path, onnx_model_file(model_path, onnx_dir, quantized=True))
+    }
+
+
+def cosine_similarities(embeddings: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of each embedding with the reference embedding in the same row.
+    """
+    return (embeddings * reference).sum(axis=1) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1))
+
+
+def parity(model_path: str, onnx_dir: str, texts: List[str], tolerance: float) -> bool:
+    """
+    Compare ONNX embeddings with PyTorch embeddings. Passes if every embedding has cosine similarity of at least
+    the tolerance with its PyTorch counterpart.
+    """
+    encoders = load_encoders(model_path, onnx_dir)
+    reference = encoders.pop('torch').encode(texts)
+
+    passed = True
+    for name, encoder in encoders.items():
+        embeddings = encoder.encode(texts)
+        cosine = cosine_similarities(embeddings, reference)
+        max_abs = np.abs(embeddings - reference).max()
+        ok = bool(cosine.min() >= tolerance)
+        passed = passed and ok
+        print(f'{model_path} {name}: min cosine {cosine.min():.5f}, mean cosine {cosine.mean():.5f}, '
+              f'max abs diff {max_abs:.5f} -> {"ok" if ok else "FAIL"}')
+    return passed
+
+
+def benchmark(model_path: str, onnx_dir: str, texts: List[str], queries: int, batch_size: int) -> None:
+    """
+    Report single-query latency and batched throughput for each backend.
+    """
+    encoders = load_encoders(model_path, onnx_dir)
+    batch = (texts * (batch_size // len(texts) + 1))[:batch_size]
+
+    for name, encoder in encoders.items():
+        encoder.encode(texts[:1])  # Warm up
+
+        latencies = []
+        for i in range(queries):
+            start = time.perf_counter()
+            encoder.encode([texts[i % len(texts)]])
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+
+        start = time.perf_counter()
+        rounds = max(1, queries // batch_size)
+        for _ in range(rounds):
+            encoder.encode(batch)
+        throughput = rounds * batch_size / (time.perf_counter() - start)
+
+        print(f'{model_path} {name}: p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, '
+              f'{throughput:.1f} texts/s at batch size {batch_size}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'parity', 'benchmark'])
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--opset', type=int, default=14)
+    parser.add_argument('--db', default=None, help='Take texts from this database instead of the built-in samples.')
+    parser.add_argument('--texts', type=int, default=200, help='Number of texts to take from the database.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_PARITY_TOLERANCE, help='Minimum cosine similarity with PyTorch.')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        for model_path in MODEL_PATHS:
+            export(model_path, args.onnx_dir, args.opset)
+        return
+
+    texts = load_texts(args.db, args.texts)
+    if args.command == 'parity':
+        results = [parity(model_path, args.onnx_dir, texts, args.tolerance) for model_path in MODEL_PATHS]
+        sys.exit(0 if all(results) else 1)
+    elif args.command == 'benchmark':
+        for model_path in MODEL_PATHS:
+            benchmark(model_path, args.onnx_dir, texts, args.queries, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
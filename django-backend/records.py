@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+from dataclasses import dataclass
+
+
+# Metadata fields of a bill, in the order they are selected from SQLite and shown in search results.
+BILL_FIELDS = (
+    'summary_text', 'title', 'official_title', 'available_chunks', 'multiple_parties', 'generated_url',
+    'stage_in_process', 'bill_number', 'bill_type', 'congress', 'date', 'legis_type', 'committee_name',
+    'publisher', 'current_chamber', 'session'
+)
+
+
+@dataclass(slots=True)
+class Sponsor:
+    """
+    A sponsor or cosponsor of a bill.
+    """
+    loc_id: Optional[str]
+    name: Optional[str]
+    full_name: Optional[str]
+    chamber: Optional[str]
+    party: Optional[str]
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'loc_id': self.loc_id, 'name': self.name, 'full_name': self.full_name,
+            'chamber': self.chamber, 'party': self.party
+        }
+
+
+@dataclass(slots=True)
+class Bill:
+    """
+    A bill in search results. BM25 candidates carry only their id until the final results are hydrated.
+    Sponsors and their aggregates are None unless they were requested.
+    """
+    id: int
+    summary_text: Optional[str] = None
+    title: Optional[str] = None
+    official_title: Optional[str] = None
+    available_chunks: Optional[int] = None
+    multiple_parties: Optional[int] = None
+    generated_url: Optional[str] = None
+    stage_in_process: Optional[str] = None
+    bill_number: Optional[int] = None
+    bill_type: Optional[str] = None
+    congress: Optional[int] = None
+    date: Optional[str] = None
+    legis_type: Optional[str] = None
+    committee_name: Optional[str] = None
+    publisher: Optional[str] = None
+    current_chamber: Optional[str] = None
+    session: Optional[int] = None
+    score: Optional[float] = None
+    sponsors: Optional[List[Sponsor]] = None
+    sponsor_aggregates: Optional[Dict[str, Any]] = None
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The bill in the shape search results are displayed in: its id, its fields and any sponsors that were looked
+        up. The score only orders the results, and is not included.
+        """
+        bill = {'id': self.id}
+        for name in BILL_FIELDS:
+            bill[name] = getattr(self, name)
+        if self.sponsors is not None:
+            bill['sponsors'] = [sponsor.to_dict() for sponsor in self.sponsors]
+        if self.sponsor_aggregates is not None:
+            bill['sponsor_aggregates'] = self.sponsor_aggregates
+        return bill
+
+
+class Passage(NamedTuple):
+    """
+    A passage of a bill found by full text search, with its index within the bill. A tuple, so that it unpacks
+    as (passage, score, index).
+    """
+    text: str
+    score: float
+    index: int
+
+
+@dataclass(slots=True)
+class Message:
+    """
+    A chat message as written to Supabase.
+    """
+    content: Optional[str]
+    chats_id: Optional[int]
+    order_in_chat: int
+    role: str
+    search_request: bool = False
+    search_response: bool = False
+    search_full_text_id: Optional[int] = None
+    function_invoked: Optional[str] = None
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'content': self.content,
+            'chats_id': self.chats_id,
+            'order_in_chat': self.order_in_chat,
+            'role': self.role,
+            'search_request': self.search_request,
+            'search_response': self.search_response,
+            'search_full_text_id': self.search_full_text_id,
+            'function_invoked': self.function_invoked
+        }
+
+
+    def to_row(self, language_model: str) -> Dict[str, Any]:
+        """
+        The row inserted into the messages table.
+        """
+        row = self.to_dict()
+        row['language_model'] = language_model
+        if row['search_full_text_id'] is not None:
+            row['search_full_text_id'] = int(row['search_full_text_id'])
+        return row
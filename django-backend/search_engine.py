@@ -1,10 +1,24 @@
 from typing import *
 import sqlite3
-import pandas as pd
 import numpy as np
 import os
-from transformers import AutoTokenizer, AutoModel
+import json
+import contextvars
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics.pairwise import cosine_similarity
+from encoders import LEGAL_BERT_PATH, SENTENCE_BERT_PATH, DEFAULT_ONNX_DIR, load_encoder
+from embedding_service import BatchingEncoder
+from model_server import RemoteEncoder
+from metadata_store import MetadataStore
+from filter_index import FilterIndex, intersect
+from embedding_store import EmbeddingStore
+from singleflight import SingleFlight
+from records import Bill, Passage, Sponsor
+from admission import Admission, OverloadedError
+from deadlines import DeadlineExceeded
+import deadlines
+from tracing import span
 import nltk
 from nltk.stem import PorterStemmer
 from nltk.tokenize import word_tokenize
@@ -112,9 +126,9 @@ class QueryBuilder:
         return params
 
 
-    def evaluate(self) -> pd.DataFrame:
+    def evaluate(self) -> List[int]:
         """
-        Evaluate the assembled query and retrieve the results.
+        Evaluate the assembled query and retrieve the ids of the matching bills.
         """
         # select = self.__assemble_select()
         # where = self.__assemble_where()
@@ -131,7 +145,7 @@ class QueryBuilder:
 
         params = self.__assemble_params()
 
-        return pd.read_sql_query(query, self.__conn, params=params)
+        return [row[0] for row in self.__conn.execute(query, params)]
 
 
 class SearchEngine:
@@ -139,23 +153,116 @@ class SearchEngine:
     The search engine class allows for searching across all bills to retrieve summaries,
     and searching within one bill to retrieve matching text passages.
     """
-    def __init__(self):
-        legal_bert_path = "nlpaueb/legal-bert-small-uncased"
-        sentence_bert_path = "sentence-transformers/msmarco-MiniLM-L6-cos-v5"
-
+    # Version of the SQLite database. Stored alongside search results so that they can be hydrated later.
+    DATABASE_VERSION = 'v2.4'
+
+    # Location of the SQLite database. Benchmarks point this at a synthetic database.
+    DATABASE_PATH = f'./congress-data_{DATABASE_VERSION}.db'
+
+    def __init__(
+        self, 
+        encoder_backend: str = 'torch', 
+        onnx_dir: str = DEFAULT_ONNX_DIR, 
+        batch_window_ms: float = 0, 
+        max_batch_size: int = 32,
+        model_server: str = None,
+        model_server_authkey: bytes = None,
+        metadata_dir: str = None,
+        filter_index: bool = False,
+        embeddings_dir: str = None,
+        db_path: str = None,
+        encoders: Tuple = None,
+        singleflight: bool = True,
+        admission: Admission = None,
+        rerank_budget: float = None
+    ):
+        """
+        The encoder backend is 'torch', 'onnx' to use the int8 models exported by onnx_export.py, or 'hashing'
+        to run without models, for benchmarks.
+        If batch_window_ms is above zero, encode requests from concurrent searches are batched together.
+        If model_server is the socket path of a running model_server.py, the models are not loaded in this
+        process at all, and encode requests are sent to the server instead, authenticated with
+        model_server_authkey.
+        If metadata_dir is set, bill metadata is kept in a columnar store saved there (and built on first use),
+        and search results are hydrated from it instead of from SQLite. With filter_index as well, the search
+        filters are evaluated with precomputed bitmaps over the store, and BM25's ranking is read until enough
+        bills pass them.
+        If embeddings_dir holds compressed embeddings written by embedding_compression.py, reranking scores those
+        instead of the embeddings in SQLite.
+        db_path overrides DATABASE_PATH for this engine, such as for one shard of a sharded deployment. Engines
+        can share models by passing the encoders() of another engine as encoders.
+        With singleflight, identical searches that run at the same time are computed once and share the result,
+        and so are identical query embeddings.
+        With admission, encoding and SQLite queries wait for a slot of their resource's limiter, and searches skip
+        BERT scoring while the search queue is long or the encoders are overloaded, returning BM25's order
+        (or, within a bill, the order of the word-based scores) instead.
+        Searches stop at the next stage boundary once the request's deadline passes or it is abandoned (see
+        deadlines.py). If rerank_budget is set, reranking that takes longer than that many seconds is abandoned
+        for BM25's order.
+        """
         # For retrieving full text chunks
         self.__max_chunks_to_bert_score = 25
 
         # For retrieving summaries
         self.__bm25_ranking_depth = 150  
         self.__reranking_depth = 150   
-        self.__bert_tokenizer = AutoTokenizer.from_pretrained(legal_bert_path)
-        self.__bert_model = AutoModel.from_pretrained(legal_bert_path)
-        
-        self.__sentence_bert_tokenizer = AutoTokenizer.from_pretrained(sentence_bert_path)
-        self.__sentence_bert_model = AutoModel.from_pretrained(sentence_bert_path)
 
-        self.__bert_model.eval()
+        # For filtered searches: BM25 skips the rows of bills that fail filters passing at most this share of bills,
+        # and otherwise ranks every match and drops failing bills, reading at most this many times the ranking depth
+        self.__max_prefilter_share = 0.25
+        self.__max_bm25_overfetch = 64
+
+        # For multi-query searches: rank constant of reciprocal rank fusion, and the number of query variants
+        # whose BM25 searches run at once
+        self.__rrf_k = 60
+        self.__variant_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bm25')
+
+        self.__db_path = db_path
+
+        # Waiting callers get copies of shared search results, since callers may modify their results,
+        # and run a search again themselves if the one they waited on ran out of time
+        self.__searches = SingleFlight(copy_results=True, retry_errors=(DeadlineExceeded,)) if singleflight else None
+        self.__query_embeddings = SingleFlight() if singleflight else None
+
+        self.__admission = admission
+        self.__rerank_budget = rerank_budget
+
+        if encoders is not None:
+            self.__bert_encoder, self.__sentence_bert_encoder = encoders
+        elif model_server is not None:
+            if not model_server_authkey:
+                raise ValueError('The model server needs model_server_authkey.')
+            # The model server batches requests from all workers itself
+            self.__bert_encoder = RemoteEncoder('legal_bert', model_server, model_server_authkey)
+            self.__sentence_bert_encoder = RemoteEncoder('sentence_bert', model_server, model_server_authkey)
+        else:
+            self.__bert_encoder = load_encoder(LEGAL_BERT_PATH, encoder_backend, onnx_dir)
+            self.__sentence_bert_encoder = load_encoder(SENTENCE_BERT_PATH, encoder_backend, onnx_dir)
+
+        if batch_window_ms > 0 and model_server is None and encoders is None:
+            self.__bert_encoder = BatchingEncoder(self.__bert_encoder, max_batch_size, batch_window_ms)
+            self.__sentence_bert_encoder = BatchingEncoder(self.__sentence_bert_encoder, max_batch_size, batch_window_ms)
+
+        self.__metadata = None
+        if metadata_dir is not None:
+            self.__metadata = MetadataStore.open(metadata_dir, self.__connect, SearchEngine.DATABASE_VERSION)
+
+        self.__embeddings = None
+        if embeddings_dir is not None:
+            self.__embeddings = EmbeddingStore.load(embeddings_dir)
+            if self.__embeddings.database_version != SearchEngine.DATABASE_VERSION:
+                raise ValueError(f"""
+                    The compressed embeddings in {embeddings_dir} were built from database {self.__embeddings.database_version}, 
+                    not {SearchEngine.DATABASE_VERSION}. Rebuild them with: python embedding_compression.py encode --out {embeddings_dir}
+                """)
+
+        self.__filters = None
+        if filter_index:
+            assert self.__metadata is not None, 'The filter index needs the metadata store.'
+            conn = self.__connect()
+            self.__filters = FilterIndex(self.__metadata, conn)
+            conn.close()
+
         self.__stemmer = PorterStemmer()
         nltk.download('stopwords')
         self.__stop_words = set(stopwords.words('english'))
@@ -199,11 +306,11 @@ class SearchEngine:
     
 
     @staticmethod
-    def get_conn() -> sqlite3.Connection:
+    def get_conn(path: str = None) -> sqlite3.Connection:
         """
-        Centralized method for generating new SQLite DB connections.
+        Centralized method for generating new SQLite DB connections, to DATABASE_PATH unless a path is given.
         """
-        LATEST_VERSION_PATH = './congress-data_v2.4.db'
+        LATEST_VERSION_PATH = path if path is not None else SearchEngine.DATABASE_PATH
         if not os.path.exists(LATEST_VERSION_PATH):
             raise FileNotFoundError(f"""
                 Database file not found at {LATEST_VERSION_PATH}. 
@@ -213,69 +320,239 @@ class SearchEngine:
         return sqlite3.Connection(LATEST_VERSION_PATH)
 
 
-    def __get_full_text_chunks(self, query: str, full_text_id: int) -> pd.DataFrame:
+    def __connect(self) -> sqlite3.Connection:
+        """
+        New connection to this engine's database.
+        """
+        return SearchEngine.get_conn(self.__db_path)
+
+
+    def encoders(self) -> Tuple:
         """
-        Given a search query and a full text id, return matching passages from the identified bill.
+        The BERT and Sentence BERT encoders, for sharing with other engines.
+        """
+        return self.__bert_encoder, self.__sentence_bert_encoder
+
+
+    def __get_bill_chunks(self, full_text_id: int) -> List[str]:
+        """
+        Split the text of a bill into the passages that are scored by full text search.
+        """
+        conn = self.__connect()
+        with self.__slot('sqlite'):
+            text = conn.execute('select text from full_texts where id = ?', (full_text_id,)).fetchone()[0]
+        
+        chunks = self.__chunk_text(text, 150, 15)
+
+        return [x.replace('\t', ' ') for x in chunks]
+
+
+    def __get_full_text_chunks(self, query: str, full_text_id: int) -> List[Passage]:
+        """
+        Given a search query and a full text id, return matching passages from the identified bill, best first.
         """       
         query = self.remove_stopwords(query)
 
-        conn = SearchEngine.get_conn()
-        df = pd.read_sql_query('select text from full_texts where id = ?', conn, params=(full_text_id,))
-        
-        chunks = self.__chunk_text(df.text.values[0], 150, 15)
+        with span('search.full_text.load_chunks'):
+            chunks = self.__get_bill_chunks(full_text_id)
+        indices = list(range(len(chunks)))
+        deadlines.check('search.full_text.remove_stopwords')
 
-        chunks = [x.replace('\t', ' ') for x in chunks]
+        with span('search.full_text.remove_stopwords'):
+            scorable_chunks = [self.remove_stopwords(chunk) for chunk in chunks]
 
-        scorable_chunks = [self.remove_stopwords(chunk) for chunk in chunks]
+        if self.__degrade():
+            with span('search.full_text.word_vector_scores'):
+                scores = [float(self.__score_word_based_vectors(query, chunk)) for chunk in scorable_chunks]
+            return list(sorted(map(Passage, chunks, scores, indices), key=lambda x: x.score, reverse=True))
 
         # Use two stage retreival if there are too many chunks
         if len(scorable_chunks) > self.__max_chunks_to_bert_score:             
-            word_vector_scores = [self.__score_word_based_vectors(query, chunk) for chunk in scorable_chunks]
+            with span('search.full_text.word_vector_scores'):
+                word_vector_scores = [self.__score_word_based_vectors(query, chunk) for chunk in scorable_chunks]
 
             # Sort chunks and scorable chunks based on the simple word-based vector scores
-            chunks = sorted(zip(chunks, word_vector_scores), key=lambda x: x[1], reverse=True)
-            scorable_chunks = sorted(zip(scorable_chunks, word_vector_scores), key=lambda x: x[1], reverse=True)
+            order = sorted(range(len(chunks)), key=lambda i: word_vector_scores[i], reverse=True)
+
+            # Select the top n
+            order = order[:self.__max_chunks_to_bert_score]
 
-            # Convert back to list and select the top n
-            chunks = list(chunks)[:self.__max_chunks_to_bert_score]
-            scorable_chunks = list(scorable_chunks)[:self.__max_chunks_to_bert_score]
+            chunks = [chunks[i] for i in order]
+            scorable_chunks = [scorable_chunks[i] for i in order]
+            indices = [indices[i] for i in order]
 
-            chunks = [x[0] for x in chunks]
-            scorable_chunks = [x[0] for x in scorable_chunks]
+        deadlines.check('search.full_text.bert_scores')
 
-        scores = [self.__bert_score_sequence(query, chunk) for chunk in scorable_chunks]
+        with span('search.full_text.bert_scores'):
+            try:
+                scores = self.__bert_score_sequences(query, scorable_chunks)
+            except OverloadedError as e:
+                if e.resource != 'encoder':
+                    raise
+                scores = [float(self.__score_word_based_vectors(query, chunk)) for chunk in scorable_chunks]
 
-        return list(sorted(zip(chunks, scores), key=lambda x: x[1], reverse=True))
+        return list(sorted(map(Passage, chunks, map(float, scores), indices), key=lambda x: x.score, reverse=True))
 
 
-    def __get_bert_embedding(self, text: str, tokenizer, model):
+    def __get_bert_embedding(self, text: str, encoder):
         """
-        Generate BERT embeddings specified model and tokenizer.
+        Generate BERT embeddings with the specified encoder.
         """
         assert type(text) == str, 'Type of text must be str.'
-        inputs = tokenizer(
-            text, return_tensors="pt", max_length=512, truncation=True
-        )
-        outputs = model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1).detach().numpy()
+        if self.__query_embeddings is None:
+            return self.__encode(encoder, [text])
+        return self.__query_embeddings.do((id(encoder), text), self.__encode, encoder, [text])
+
+
+    def __encode(self, encoder, texts: List[str]):
+        """
+        Encode texts, holding an encoder slot if admission control is enabled.
+        """
+        with self.__slot('encoder'):
+            return encoder.encode(texts)
+
+
+    def __slot(self, resource: str):
+        """
+        Context manager holding a slot of the 'encoder' or 'sqlite' limiter, if admission control is enabled.
+        """
+        if self.__admission is None:
+            return nullcontext()
+        # Waiting for a slot counts against the request's deadline
+        return getattr(self.__admission, resource).slot(deadlines.remaining())
+
+
+    def __rerank_stage(self):
+        """
+        Context manager limiting the time reranking may take, if a rerank budget is set.
+        """
+        if self.__rerank_budget is None:
+            return nullcontext()
+        return deadlines.stage(self.__rerank_budget)
+
+
+    def __degrade(self) -> bool:
+        """
+        Whether this search should skip BERT scoring, because the search queue is long.
+        """
+        return self.__admission is not None and self.__admission.should_degrade()
+
+
+    def __bert_score_sequences(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Score many strings against one query with Sentence BERT, encoding the query once and the strings in one batch.
+        """
+        assert type(query) == str, 'Type of query must be str.'
+        if len(texts) == 0:
+            return []
 
+        embeddings = self.__encode(self.__sentence_bert_encoder, [query] + texts)
+        return list(np.dot(embeddings[1:], embeddings[0]))
 
-    def __bert_score_sequence(self, text1, text2):
+
+    def encoder_stats(self) -> Dict[str, Dict]:
         """
-        Given two strings, generate a BERT similarity score with Sentence BERT.
+        Batching statistics for each encoder, if encode requests are being batched here or on the model server.
         """
-        assert type(text1) == str, 'Type of text1 must be str.'
-        assert type(text2) == str, 'Type of text2 must be str.'
+        return {
+            name: encoder.stats() 
+            for name, encoder in [('legal_bert', self.__bert_encoder), ('sentence_bert', self.__sentence_bert_encoder)]
+            if isinstance(encoder, (BatchingEncoder, RemoteEncoder))
+        }
+
 
-        embedding1 = self.__get_bert_embedding(text1, self.__sentence_bert_tokenizer, self.__sentence_bert_model)
-        embedding2 = self.__get_bert_embedding(text2, self.__sentence_bert_tokenizer, self.__sentence_bert_model)
-        similarity = np.dot(
-            embedding1, np.transpose(embedding2)
-        )[0][0]
-        return similarity
+    def singleflight_stats(self) -> Dict[str, Any]:
+        """
+        Counts of identical concurrent searches and query embeddings that were coalesced, if coalescing is enabled.
+        """
+        if self.__searches is None:
+            return {}
+        return {'searches': self.__searches.stats(), 'query_embeddings': self.__query_embeddings.stats()}
 
 
-    def __search_summaries(self, params: Dict[str, Any], conn) -> List[Dict]:
+    def metadata_stats(self) -> Dict[str, Any]:
+        """
+        Memory used by each column of the metadata store, if it is enabled.
+        """
+        if self.__metadata is None:
+            return {}
+        return self.__metadata.memory_report()
+
+
+    def embedding_stats(self) -> Dict[str, Any]:
+        """
+        Memory used by the compressed embeddings, if they are enabled.
+        """
+        if self.__embeddings is None:
+            return {}
+        return self.__embeddings.memory_report()
+
+
+    def filter_stats(self) -> Dict[str, Any]:
+        """
+        Sizes of the filter bitmaps, if the filter index is enabled.
+        """
+        if self.__filters is None:
+            return {}
+        return self.__filters.stats()
+
+
+    def __bm25_query(self, text: str) -> str:
+        """
+        Turn a search query into the terms that are matched against the BM25 index.
+        """
+        # Remove punctuation
+        query = text.replace(',', ' ').replace('+', ' ').replace('.', ' ').replace("'", ' ')
+        return self.__remove_stopwords_and_stem(query)
+
+
+    def __search_summaries_filtered(self, params: Dict[str, Any], conn) -> List[Bill]:
+        """
+        BM25 candidate search using the filter index. Like __search_summaries, only HR bills are returned.
+        """
+        bitmap = intersect([
+            b for b in [self.__filters.bitmap('bill_type', 'hr'), self.__filters.for_params(params)] if b is not None
+        ])
+        passing_bills = self.__filters.count(bitmap)
+        if passing_bills == 0:
+            return []
+        terms = self.__bm25_query(params['query'])
+        match = ' OR '.join(list(set(terms.split(' '))))
+
+        # Scoring is what BM25 spends its time on, so a selective filter is applied before it. The rows of failing
+        # bills are skipped before bm25() is computed for them; the unary plus keeps SQLite from handing the IN to
+        # FTS5, which would look up each row separately.
+        if passing_bills <= self.__max_prefilter_share * len(self.__metadata):
+            rows = conn.execute("""
+                select rowid
+                from congress_bm25
+                where congress_bm25 match ? and +rowid in (select value from json_each(?))
+                order by bm25(congress_bm25)
+                limit ?
+            """, (match, json.dumps(self.__filters.bm25_rowids(bitmap).tolist()), self.__bm25_ranking_depth)).fetchall()
+            return [Bill(int(id)) for id in self.__filters.bm25_ids(bitmap, [row[0] for row in rows])]
+
+        # A broad filter saves little scoring, so BM25's best results are taken and those that fail the filter are
+        # dropped. The first fetch is deep enough to leave the ranking depth if matches pass the filter as often as
+        # bills do overall. If too few are left, a second and last fetch goes as deep as __max_bm25_overfetch allows.
+        # Rows are read by rowid, which is much cheaper for FTS5 than reading ft_id from each row.
+        fetch = self.__bm25_ranking_depth * int(np.ceil(len(self.__metadata) / passing_bills))
+        max_fetch = self.__bm25_ranking_depth * self.__max_bm25_overfetch
+        while True:
+            rows = conn.execute("""
+                select rowid
+                from congress_bm25
+                where congress_bm25 match ?
+                order by bm25(congress_bm25)
+                limit ?
+            """, (match, fetch)).fetchall()
+            passing = self.__filters.bm25_ids(bitmap, [row[0] for row in rows])
+            if len(passing) >= self.__bm25_ranking_depth or len(rows) < fetch or fetch >= max_fetch:
+                return [Bill(int(id)) for id in passing[:self.__bm25_ranking_depth]]
+            fetch = max_fetch
+
+
+    def __search_summaries(self, params: Dict[str, Any], conn) -> List[Bill]:
         """
         PARAMS = {
             'query': '',
@@ -311,11 +588,7 @@ class SearchEngine:
             end_date = f"{params['date_range']['end_year']}-{params['date_range']['end_month']}-{params['date_range']['end_day']}"
             query_builder.add_equality('ft.date', end_date, '<=', )
 
-        # Remove punctuation
-        query = params['query'] \
-            .replace(',', ' ').replace('+', ' ').replace('.', ' ').replace("'", ' ')
-        query = self.__remove_stopwords_and_stem(query)
-        query_builder.set_search_query(query)
+        query_builder.set_search_query(self.__bm25_query(params['query']))
 
         for string in params['exact_match_strings']:
             query_builder.add_exact_match_string(string)
@@ -349,68 +622,130 @@ class SearchEngine:
 
         query_builder.set_limit(int(self.__bm25_ranking_depth))
 
-        results = query_builder.evaluate()
-
-        return results.to_dict(orient='records')
+        return [Bill(id) for id in query_builder.evaluate()]
 
 
-    def __retrieve_sponsors(self, full_text_id, conn):
+    def __retrieve_sponsors(self, full_text_ids: List[int], conn) -> Dict[int, List[Sponsor]]:
         """
-        For a given bill, retrieve sponsors and cosponsors.
+        For a list of bills, retrieve sponsors and cosponsors with one query, grouped by bill.
         """
+        sponsors = {int(id): [] for id in full_text_ids}
+        if len(full_text_ids) == 0:
+            return sponsors
+
         cur = conn.cursor()
-        select = "select loc_id, name, full_name, chamber, party from sponsors where bill_sponsored = ?"
-        cur.execute(select, (full_text_id,))
-        sponsors = cur.fetchall()
-        result = []
-        for s in sponsors:
-            result.append({'loc_id': s[0], 'name': s[1], 'full_name': s[2], 'chamber': s[3], 'party': s[4]})
-        return result
+        select = f"""
+            select bill_sponsored, loc_id, name, full_name, chamber, party 
+            from sponsors 
+            where bill_sponsored in ({','.join('?' * len(sponsors))})
+        """
+        with self.__slot('sqlite'):
+            cur.execute(select, tuple(sponsors))
+            rows = cur.fetchall()
+        for s in rows:
+            sponsors[s[0]].append(Sponsor(*s[1:]))
+        return sponsors
+
+
+    @staticmethod
+    def __aggregate_sponsors(sponsors: List[Sponsor]) -> Dict[str, Any]:
+        """
+        Count a bill's sponsors by party and by chamber.
+        """
+        parties = {}
+        chambers = {}
+        for sponsor in sponsors:
+            parties[sponsor.party] = parties.get(sponsor.party, 0) + 1
+            chambers[sponsor.chamber] = chambers.get(sponsor.chamber, 0) + 1
+        return {'count': len(sponsors), 'parties': parties, 'chambers': chambers}
     
 
-    def __get_precomputed_embeddings(self, ft_ids: np.array, conn) -> pd.DataFrame:
+    def __get_precomputed_embeddings(self, ft_ids: Tuple, conn) -> List[Tuple[int, bytes]]:
+        """
+        Retrieve precomputed BERT embeddings from the SQLite database, as (bill id, pickled embedding) rows.
+        """
+        with self.__slot('sqlite'):
+            return conn.execute(f"""
+                select full_text_id as id, embedding_blob as embedding 
+                from bert_embeddings 
+                where full_text_id in ({','.join('?' * len(ft_ids))}) 
+            """, ft_ids).fetchall()
+
+
+    @staticmethod
+    def __mean_scores_by_bill(ids: List[int], rows: List[Tuple[int, bytes]], passage_scores: np.ndarray) -> np.ndarray:
         """
-        Retrieve precomputed BERT embeddings from the SQLite database.
+        Mean score of each bill's passages, as a (bills, queries) array in the order of ids, with NaN for bills
+        without embeddings. passage_scores holds the scores of the passages in rows, as a (passages, queries) array.
         """
-        return pd.read_sql_query(f"""
-            select full_text_id as id, embedding_blob as embedding 
-            from bert_embeddings 
-            where full_text_id in ({','.join('?' * len(ft_ids))}) 
-        """, conn, params=ft_ids)
+        column = {id: i for i, id in enumerate(ids)}
+        bills = np.array([column[row[0]] for row in rows], dtype=np.int64)
+        sums = np.zeros((len(ids), passage_scores.shape[1]), dtype=np.float64)
+        np.add.at(sums, bills, passage_scores)
+        counts = np.bincount(bills, minlength=len(ids))[:, None]
+        with np.errstate(invalid='ignore'):
+            return sums / counts
 
 
-    def __rerank_with_bert(self, documents: List[Dict], params: Dict[str, Any], conn) -> List[Dict]:
+    def __rerank_with_bert(self, documents: List[Bill], params: Dict[str, Any], conn) -> List[Bill]:
         """
         Reorder the given list of documents using BERT score. 
         """
-        embeddings = self.__get_precomputed_embeddings(tuple([str(d['id']) for d in documents]), conn)
+        if self.__embeddings is not None:
+            return self.__rerank_with_compressed_embeddings(documents, params)
+
+        with span('search.summaries.fetch_embeddings'):
+            rows = self.__get_precomputed_embeddings(tuple([str(d.id) for d in documents]), conn)
 
         # clean_query = self.__remove_stopwords_and_stem(params['query'])
 
-        query_embedding = self.__get_bert_embedding(params['query'], self.__bert_tokenizer, self.__bert_model)
+        deadlines.check('search.summaries.query_embedding')
+        with span('search.summaries.query_embedding'):
+            query_embedding = self.__get_bert_embedding(params['query'], self.__bert_encoder)
+
+        deadlines.check('search.summaries.unpickle')
+        with span('search.summaries.unpickle'):
+            vectors = [np.asarray(pickle.loads(blob), dtype=np.float32).ravel() for _, blob in rows]
 
-        embeddings['score'] = embeddings.embedding.apply(
-            lambda x: np.dot(query_embedding, np.transpose(pickle.loads(x)))
-        )
+        deadlines.check('search.summaries.score')
+        with span('search.summaries.score'):
+            query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1, 1)
+            passage_scores = np.stack(vectors) @ query_vector if vectors else np.zeros((0, 1), dtype=np.float32)
+            scores = self.__mean_scores_by_bill([d.id for d in documents], rows, passage_scores)[:, 0]
 
-        scores = embeddings.groupby('id') \
-            .score \
-            .mean() \
-            .sort_values(ascending=False) \
-            .reset_index()
-                                
-        sorted_ids = scores['id'].tolist()
-        return list(sorted(documents, key=lambda x: sorted_ids.index(x['id'])))
+        for document, score in zip(documents, scores):
+            document.score = None if np.isnan(score) else float(score)
+        # Bills without embeddings go last
+        return list(sorted(documents, key=lambda x: (x.score is None, -(x.score or 0))))
     
 
-    def __get_full_summary_data(self, documents: List[Dict]) -> List[Dict]:
+    def __rerank_with_compressed_embeddings(self, documents: List[Bill], params: Dict[str, Any]) -> List[Bill]:
+        """
+        Reorder documents by BERT score like __rerank_with_bert, scoring the in-memory compressed embeddings.
+        """
+        with span('search.summaries.query_embedding'):
+            query_embedding = self.__get_bert_embedding(params['query'], self.__bert_encoder)
+
+        deadlines.check('search.summaries.score')
+        with span('search.summaries.score'):
+            scores = self.__embeddings.score_bills(query_embedding, [d.id for d in documents])
+
+        for document, score in zip(documents, scores):
+            document.score = None if np.isnan(score) else float(score)
+        # Bills without embeddings go last
+        return list(sorted(documents, key=lambda x: (x.score is None, -(x.score or 0))))
+
+
+    def __get_full_summary_data(self, documents: List[Bill]) -> List[Bill]:
         """
         Get the full set of data and metadata for a list of bills. Use this method at the end of the search process
         once the final, narrowed down set of top results have been determined.
         """
-        conn = self.get_conn()
+        sorted_ids = [d.id for d in documents]
+        if self.__metadata is not None:
+            return self.__metadata.hydrate(sorted_ids)
 
-        sorted_ids = [d['id'] for d in documents]
+        conn = self.__connect()
 
         query = """
             select 
@@ -439,10 +774,12 @@ class SearchEngine:
         query = query + ' '.join(['?,' for _ in range(len(documents))])
         query = query[:-1] + ')'
 
-        df = pd.read_sql_query(query, conn, params=sorted_ids)
-        results = df.to_dict(orient='records')
+        with self.__slot('sqlite'):
+            rows = conn.execute(query, sorted_ids).fetchall()
+        # The columns are selected in the order of Bill's fields
+        bills = {row[0]: Bill(*row) for row in rows}
 
-        return list(sorted(results, key=lambda x: sorted_ids.index(x['id'])))
+        return [bills[id] for id in sorted_ids if id in bills]
     
 
 
@@ -474,17 +811,61 @@ class SearchEngine:
         return np.dot(vector1, np.transpose(vector2))
     
 
-    def retrieve_full_text_chunks(self, params: Dict[str, Any], full_text_id: int) -> List[Dict]:
+    def retrieve_full_text_chunks(self, params: Dict[str, Any], full_text_id: int, return_chunk_index: bool = False) -> List[Tuple]:
         """
-        Public method for getting matching passages within a bill.
+        Public method for getting matching passages within a bill, as (passage, score) tuples.
+        If return_chunk_index is True, passages are returned as Passage records, which also carry the index of the
+        passage within the bill.
         """
+        if self.__searches is None:
+            return self.__retrieve_full_text_chunks(params, full_text_id, return_chunk_index)
+        key = ('full_text', int(full_text_id), self.__normalize_query(params['query']), params['number_to_return'], return_chunk_index)
+        return self.__searches.do(key, self.__retrieve_full_text_chunks, params, full_text_id, return_chunk_index)
+
+
+    def __retrieve_full_text_chunks(self, params: Dict[str, Any], full_text_id: int, return_chunk_index: bool) -> List[Tuple]:
         result = self.__get_full_text_chunks(params['query'], full_text_id)
-        return result[:params['number_to_return']]
+        result = result[:params['number_to_return']]
+        if return_chunk_index:
+            return result
+        return [(chunk, score) for chunk, score, _ in result]
 
 
-    def retrieve_summary(self, params: Dict[str, Any]) -> List[Dict]:
+    def get_summaries(self, ids: List[int]) -> List[Bill]:
         """
-        Public method for searching for matching bills and their summaries. 
+        Public method for looking up bill summaries and metadata by id, in the given order.
+        """
+        if len(ids) == 0:
+            return []
+        return self.__get_full_summary_data([Bill(id) for id in ids])
+
+
+    def get_full_text_chunks(self, full_text_id: int, chunk_indices: List[int]) -> List[str]:
+        """
+        Public method for looking up passages of a bill by their index, in the given order.
+        """
+        chunks = self.__get_bill_chunks(full_text_id)
+        return [chunks[i] for i in chunk_indices if i < len(chunks)]
+
+
+    @staticmethod
+    def __normalize_query(query: str) -> str:
+        """
+        A query with the whitespace differences that cannot change its results removed.
+        """
+        return ' '.join(str(query).split())
+
+
+    def __params_key(self, params: Dict[str, Any]) -> str:
+        """
+        Key of a summary search, for coalescing identical searches. Params must already have their defaults.
+        """
+        return json.dumps(dict(params, query=self.__normalize_query(params['query'])), sort_keys=True, default=str)
+
+
+    def __fill_default_params(self, params: Dict[str, Any]) -> None:
+        """
+        Add the default value of every summary search param that is missing.
         """
         default_params = {
             'query': '',
@@ -499,30 +880,188 @@ class SearchEngine:
                 'end_day': 31
             },
             'get_sponsors': False,
+            'sponsor_aggregates': False,
             'chamber': 'any',
             'require_bipartisan': False
         }
 
-        conn = SearchEngine.get_conn()
-
         for key, value in default_params.items():
             if key not in params:
                 params[key] = value
 
-        documents: List[Dict] = self.__search_summaries(params, conn)
 
+    def __bm25_candidates(self, params: Dict[str, Any], conn) -> List[Bill]:
+        """
+        The bills that BM25 ranks highest for params['query'], within the filters in params.
+        """
+        with self.__slot('sqlite'):
+            if self.__filters is not None:
+                return self.__search_summaries_filtered(params, conn)
+            return self.__search_summaries(params, conn)
+
+
+    def __finish_summaries(self, documents: List[Bill], params: Dict[str, Any], conn) -> List[Bill]:
+        """
+        Hydrate the final, ranked results, keeping their scores, and look up their sponsors if requested.
+        """
+        scores = {d.id: d.score for d in documents}
+
+        with span('search.summaries.hydrate'):
+            documents = self.__get_full_summary_data(documents)
+
+        for document in documents:
+            document.score = scores[document.id]
+
+        if params['get_sponsors'] is True:
+            with span('search.summaries.sponsors'):
+                sponsors = self.__retrieve_sponsors([document.id for document in documents], conn)
+                for document in documents:
+                    document.sponsors = sponsors[document.id]
+                    if params['sponsor_aggregates'] is True:
+                        document.sponsor_aggregates = self.__aggregate_sponsors(document.sponsors)
+
+        return documents
+
+
+    def retrieve_summary(self, params: Dict[str, Any]) -> List[Bill]:
+        """
+        Public method for searching for matching bills and their summaries. 
+        """
+        self.__fill_default_params(params)
+        if self.__searches is None:
+            return self.__retrieve_summary(params)
+        return self.__searches.do(('summary', self.__params_key(params)), self.__retrieve_summary, params)
+
+
+    def __retrieve_summary(self, params: Dict[str, Any]) -> List[Bill]:
+        deadlines.check('search.summaries.bm25')
+        conn = self.__connect()
+
+        with span('search.summaries.bm25'):
+            documents: List[Bill] = self.__bm25_candidates(params, conn)
+
+        if len(documents) == 0:
+            return []
+
+        deadlines.check('search.summaries.rerank')
         top_n = documents[:self.__reranking_depth]
-        top_n = self.__rerank_with_bert(top_n, params, conn)
+        if not self.__degrade():
+            with span('search.summaries.rerank'):
+                try:
+                    with self.__rerank_stage():
+                        top_n = self.__rerank_with_bert(top_n, params, conn)
+                except OverloadedError as e:
+                    # Without the encoders, BM25's order is still a usable ranking
+                    if e.resource != 'encoder':
+                        raise
+                except DeadlineExceeded:
+                    # Out of reranking budget, unless the search itself is out of time
+                    deadlines.check('search.summaries.rerank')
 
         documents = top_n + documents[self.__reranking_depth:]
 
         documents = documents[:params['number_to_return']]
 
-        documents = self.__get_full_summary_data(documents)
+        deadlines.check('search.summaries.hydrate')
+        return self.__finish_summaries(documents, params, conn)
 
-        if params['get_sponsors'] is True:
-            for i, document in enumerate(documents):
-                sponsors = self.__retrieve_sponsors(document['ft_id'], conn)
-                documents[i]['sponsors'] = sponsors
 
-        return documents
+    def __bm25_candidates_for_query(self, params: Dict[str, Any], query: str) -> List[Bill]:
+        """
+        BM25 candidates for one variant of a query, on a connection of its own, so that variants can be searched
+        on separate threads.
+        """
+        conn = self.__connect()
+        try:
+            return self.__bm25_candidates(dict(params, query=query), conn)
+        finally:
+            conn.close()
+
+
+    def __score_candidates_multi(self, queries: List[str], ids: List[int], conn) -> np.ndarray:
+        """
+        BERT score of each bill against each query, as a (queries, bills) array with NaN for bills without
+        embeddings. The queries are embedded in one batch, and the bills' embeddings are fetched once for all
+        of them.
+        """
+        with span('search.multi.query_embedding'):
+            query_embeddings = np.asarray(self.__encode(self.__bert_encoder, queries), dtype=np.float32).reshape(len(queries), -1)
+
+        deadlines.check('search.multi.score')
+        if self.__embeddings is not None:
+            with span('search.multi.score'):
+                return self.__embeddings.score_bills_multi(query_embeddings, ids)
+
+        with span('search.multi.fetch_embeddings'):
+            rows = self.__get_precomputed_embeddings(tuple([str(id) for id in ids]), conn)
+
+        deadlines.check('search.multi.unpickle')
+        with span('search.multi.unpickle'):
+            vectors = [np.asarray(pickle.loads(blob), dtype=np.float32).ravel() for _, blob in rows]
+
+        with span('search.multi.score'):
+            if len(vectors) == 0:
+                return np.full((len(queries), len(ids)), np.nan, dtype=np.float32)
+            passage_scores = np.stack(vectors) @ query_embeddings.T
+            return self.__mean_scores_by_bill(ids, rows, passage_scores).astype(np.float32).T
+
+
+    def retrieve_summary_multi(self, params: Dict[str, Any], queries: List[str]) -> List[Bill]:
+        """
+        Public method for searching with several variants of a query at once, such as rewordings written by GPT.
+        BM25 runs for every variant in parallel, each variant's candidates are reranked by BERT as in
+        retrieve_summary, and the rankings are fused with reciprocal rank fusion: a bill's score is the sum of
+        1 / (k + rank) over the rankings it appears in. Other params are as for retrieve_summary.
+        """
+        assert len(queries) > 0, 'At least one query is required.'
+        self.__fill_default_params(params)
+        if self.__searches is None:
+            return self.__retrieve_summary_multi(params, queries)
+        key = ('summary_multi', self.__params_key(params), tuple(self.__normalize_query(q) for q in queries))
+        return self.__searches.do(key, self.__retrieve_summary_multi, params, queries)
+
+
+    def __retrieve_summary_multi(self, params: Dict[str, Any], queries: List[str]) -> List[Bill]:
+        deadlines.check('search.multi.bm25')
+        conn = self.__connect()
+
+        with span('search.multi.bm25'):
+            futures = [
+                self.__variant_executor.submit(contextvars.copy_context().run, self.__bm25_candidates_for_query, params, query)
+                for query in queries
+            ]
+            candidates = [future.result()[:self.__reranking_depth] for future in futures]
+
+        ids = list(dict.fromkeys(d.id for documents in candidates for d in documents))
+        if len(ids) == 0:
+            return []
+
+        deadlines.check('search.multi.query_embedding')
+        # Without BERT scores, each variant is ranked in BM25's order
+        scores = np.full((len(queries), len(ids)), np.nan, dtype=np.float32)
+        if not self.__degrade():
+            try:
+                with self.__rerank_stage():
+                    scores = self.__score_candidates_multi(queries, ids, conn)
+            except OverloadedError as e:
+                if e.resource != 'encoder':
+                    raise
+            except DeadlineExceeded:
+                deadlines.check('search.multi.score')
+        column = {id: i for i, id in enumerate(ids)}
+
+        with span('search.multi.fuse'):
+            fused = {}
+            for i, documents in enumerate(candidates):
+                variant_scores = [scores[i, column[d.id]] for d in documents]
+                # Ranked by BERT score, with bills without embeddings after the rest in BM25 order
+                order = sorted(range(len(documents)), key=lambda j: (np.isnan(variant_scores[j]), -np.nan_to_num(variant_scores[j])))
+                for rank, j in enumerate(order):
+                    id = documents[j].id
+                    fused[id] = fused.get(id, 0.0) + 1.0 / (self.__rrf_k + rank + 1)
+
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:params['number_to_return']]
+            documents = [Bill(id, score=score) for id, score in ranked]
+
+        deadlines.check('search.multi.hydrate')
+        return self.__finish_summaries(documents, params, conn)
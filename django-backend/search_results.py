@@ -0,0 +1,212 @@
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+import json
+import logging
+import re
+import threading
+from records import Bill
+
+
+logger = logging.getLogger(__name__)
+
+# Marks message content that holds a compact search result record instead of text.
+COMPACT_RESULTS_FORMAT = 'search_results_v1'
+
+# Default number of tokens that one set of search results may take up in GPT's context.
+DEFAULT_RESULTS_TOKEN_BUDGET = 1500
+
+# Fields of a bill shown to GPT, in order, with the label used for each.
+LLM_SUMMARY_FIELDS = [
+    ('title', 'Title'),
+    ('congress', 'Congress'),
+    ('bill_type', 'Type'),
+    ('bill_number', 'Number'),
+    ('date', 'Date'),
+    ('publisher', 'Publisher')
+]
+
+HTML_TAG = re.compile(r'<[^>]*>')
+WHITESPACE = re.compile(r'\s+')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for English text, at about four characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+def compact_summary_results(results: List[Bill], database_version: str) -> str:
+    """
+    Encode the results of a summary search as bill ids with their rank and score.
+    """
+    return json.dumps({
+        'format': COMPACT_RESULTS_FORMAT,
+        'function': 'search_summaries',
+        'db': database_version,
+        'hits': [[int(r.id), rank, _round_score(r.score)] for rank, r in enumerate(results)]
+    }, separators=(',', ':'))
+
+
+def compact_full_text_results(results: List[tuple], full_text_id: int, database_version: str) -> str:
+    """
+    Encode the results of a full text search as passage indices with their rank and score.
+    Expects (passage, score, passage index) tuples.
+    """
+    return json.dumps({
+        'format': COMPACT_RESULTS_FORMAT,
+        'function': 'search_full_texts',
+        'db': database_version,
+        'full_text_id': int(full_text_id),
+        'hits': [[int(index), rank, _round_score(score)] for rank, (_, score, index) in enumerate(results)]
+    }, separators=(',', ':'))
+
+
+def parse_compact_results(content: str) -> Optional[Dict[str, Any]]:
+    """
+    Decode a compact search result record. Returns None if the content is anything else, such as a
+    message written before search results were stored compactly.
+    """
+    if not isinstance(content, str) or not content.startswith('{'):
+        return None
+    try:
+        record = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(record, dict) or record.get('format') != COMPACT_RESULTS_FORMAT:
+        return None
+    return record
+
+
+def hydrate_results(record: Dict[str, Any], search_engine) -> List:
+    """
+    Rebuild full search results from a compact record. Summary results are returned as Bill records and
+    full text results as (passage, score) tuples, matching what the search engine returns.
+    """
+    if record['db'] != search_engine.DATABASE_VERSION:
+        logger.warning(
+            'Hydrating search results stored against database %s with database %s.',
+            record['db'], search_engine.DATABASE_VERSION
+        )
+
+    hits = sorted(record['hits'], key=lambda hit: hit[1])
+
+    if record['function'] == 'search_summaries':
+        documents = search_engine.get_summaries([hit[0] for hit in hits])
+        scores = {hit[0]: hit[2] for hit in hits}
+        for document in documents:
+            document.score = scores.get(document.id)
+        return documents
+    elif record['function'] == 'search_full_texts':
+        chunks = search_engine.get_full_text_chunks(record['full_text_id'], [hit[0] for hit in hits])
+        return list(zip(chunks, [hit[2] for hit in hits]))
+    else:
+        raise ValueError('Unrecognized search function in stored search results.')
+
+
+class HydratedResultsCache:
+    """
+    Search results hydrated from stored records, keyed by the stored content. A chat's earlier results are sent
+    to GPT again every turn, and would otherwise be looked up again every turn. Stored records never change, so
+    entries are only evicted, least recently used first. Cached results are shared, so they must not be modified.
+    """
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+
+    def get(self, content: str) -> Optional[List]:
+        with self.__lock:
+            results = self.__entries.get(content)
+            if results is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(content)
+            self.__hits += 1
+            return results
+
+
+    def put(self, content: str, results: List) -> None:
+        with self.__lock:
+            self.__entries[content] = results
+            self.__entries.move_to_end(content)
+            if len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {'entries': len(self.__entries), 'hits': self.__hits, 'misses': self.__misses}
+
+
+def format_results_for_display(results: List) -> str:
+    """
+    Render search results the way the frontend expects to display them, with bills as dicts. Scores are left out;
+    they only order the results, and the frontend would show them as another field.
+    """
+    return str([result.to_dict() if isinstance(result, Bill) else result for result in results])
+
+
+def serialize_results_for_llm(results: List, function: str, max_tokens: int = DEFAULT_RESULTS_TOKEN_BUDGET) -> str:
+    """
+    Render search results as compact text for GPT, keeping the total within a token budget.
+    Every result keeps its identifying line, and the remaining budget is shared out between result texts.
+    """
+    if len(results) == 0:
+        return 'The search returned no results.'
+
+    if function == 'search_summaries':
+        headers = []
+        bodies = []
+        for rank, document in enumerate(results):
+            fields = [f"{label}: {getattr(document, key)}" for key, label in LLM_SUMMARY_FIELDS if getattr(document, key) is not None]
+            headers.append(f"{rank + 1}. [full_text_id={document.id}] " + '; '.join(fields))
+            bodies.append(_clean_text(document.summary_text or ''))
+    elif function == 'search_full_texts':
+        headers = [f"Passage {rank + 1}:" for rank in range(len(results))]
+        bodies = [_clean_text(result[0]) for result in results]
+    else:
+        raise ValueError('Unrecognized search function.')
+
+    header_tokens = sum(estimate_tokens(header) for header in headers)
+    body_budget = max(0, max_tokens - header_tokens) // len(results)
+
+    lines = []
+    for header, body in zip(headers, bodies):
+        lines.append(header)
+        body = _truncate_to_tokens(body, body_budget)
+        if body:
+            lines.append(body)
+
+    return '\n'.join(lines)
+
+
+def _round_score(score) -> Optional[float]:
+    """
+    Round a score for storage. Scores are only used for ordering and display.
+    """
+    if score is None:
+        return None
+    return round(float(score), 4)
+
+
+def _clean_text(text: str) -> str:
+    """
+    Remove HTML tags and collapse whitespace.
+    """
+    return WHITESPACE.sub(' ', HTML_TAG.sub(' ', text)).strip()
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut text down to roughly max_tokens tokens, on a word boundary.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max_tokens * 4]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut + ' ...' if cut else ''
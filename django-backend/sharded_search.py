@@ -0,0 +1,221 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import numpy as np
+from search_engine import SearchEngine
+from records import Bill
+from tracing import span
+import deadlines
+
+
+def _merge_results(results: List[List[Bill]], number_to_return: int) -> List[Bill]:
+    """
+    Merge the shards' ranked results into a global top k. Reranked results are ordered by score. Results that
+    were not reranked have no score to compare across shards, so they follow taking turns between the shards,
+    each in its shard's own order.
+    """
+    reranked = [[document for document in shard if document.score is not None] for shard in results]
+    unranked = [[document for document in shard if document.score is None] for shard in results]
+    merged = heapq.merge(*reranked, key=lambda document: document.score, reverse=True)
+    interleaved = (document for turn in itertools.zip_longest(*unranked) for document in turn if document is not None)
+    return list(itertools.islice(itertools.chain(merged, interleaved), number_to_return))
+
+
+def _date_string(year, month, day) -> str:
+    return f'{int(year):04d}-{int(month):02d}-{int(day):02d}'
+
+
+class ShardedSearchEngine:
+    """
+    Searches a database split into shards by Congress, as written by build_shards.py. Each shard is a complete
+    database with its own BM25 index and embeddings, searched by its own SearchEngine; all shards share one copy
+    of the models. Summary searches fan out to the shards in parallel, skip shards outside the requested date
+    range, and merge the shards' ranked results into a global top k. Lookups by bill id go to the shard that
+    holds the bill. Exposes the same methods as SearchEngine.
+    """
+    def __init__(self, manifest_path: str, max_workers: int = None, **engine_options) -> None:
+        """
+        engine_options are passed to each shard's SearchEngine. A metadata_dir or embeddings_dir is taken as a
+        parent directory, holding one subdirectory per shard.
+        """
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+        self.DATABASE_VERSION = manifest['database_version']
+        if self.DATABASE_VERSION != SearchEngine.DATABASE_VERSION:
+            raise ValueError(f"""
+                The shards in {manifest_path} were built from database {self.DATABASE_VERSION},
+                not {SearchEngine.DATABASE_VERSION}. Rebuild them with build_shards.py.
+            """)
+
+        self.__shards = manifest['shards']
+        self.__engines = []
+        # Sorted bill ids of each shard, for routing lookups by id
+        self.__shard_ids = []
+        encoders = None
+        for shard in self.__shards:
+            options = dict(engine_options)
+            for key in ['metadata_dir', 'embeddings_dir']:
+                if options.get(key) is not None:
+                    options[key] = os.path.join(options[key], shard['name'])
+            db_path = os.path.join(base_dir, shard['path'])
+            engine = SearchEngine(db_path=db_path, encoders=encoders, **options)
+            encoders = engine.encoders()
+            self.__engines.append(engine)
+
+            conn = SearchEngine.get_conn(db_path)
+            ids = conn.execute('select id from full_texts order by id').fetchall()
+            conn.close()
+            self.__shard_ids.append(np.array([row[0] for row in ids], dtype=np.int64).reshape(-1))
+
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers or len(self.__engines), thread_name_prefix='shard')
+
+
+    def __shards_for_dates(self, params: Dict[str, Any]) -> List[int]:
+        """
+        Shards holding bills dated within the requested range.
+        """
+        if 'date_range' not in params:
+            return list(range(len(self.__shards)))
+        date_range = params['date_range']
+        start = _date_string(date_range['start_year'], date_range['start_month'], date_range['start_day'])
+        end = _date_string(date_range['end_year'], date_range['end_month'], date_range['end_day'])
+        return [
+            i for i, shard in enumerate(self.__shards)
+            if shard.get('start_date') is None or not (shard['end_date'] < start or shard['start_date'] > end)
+        ]
+
+
+    def __shard_index(self, full_text_id: int) -> int:
+        """
+        Position of the shard holding a bill, or -1 if no shard holds it.
+        """
+        for i, ids in enumerate(self.__shard_ids):
+            position = np.searchsorted(ids, full_text_id)
+            if position < len(ids) and ids[position] == full_text_id:
+                return i
+        return -1
+
+
+    def __shard_of(self, full_text_id: int) -> SearchEngine:
+        """
+        The engine of the shard holding a bill.
+        """
+        i = self.__shard_index(full_text_id)
+        if i < 0:
+            raise KeyError(f'No shard holds bill {full_text_id}.')
+        return self.__engines[i]
+
+
+    def __fan_out(self, function, shard_indices: List[int]) -> List:
+        """
+        Call function(engine) on the given shards in parallel, carrying over the caller's context so that stage
+        timings and the deadline are shared. Raises DeadlineExceeded if the shards do not finish before the
+        caller's deadline.
+        """
+        futures = [
+            self.__executor.submit(contextvars.copy_context().run, function, self.__engines[i])
+            for i in shard_indices
+        ]
+        try:
+            return [future.result(timeout=self.__wait_timeout()) for future in futures]
+        except TimeoutError:
+            # Shards that have started stop at their next cancellation check, since the deadline has passed
+            for future in futures:
+                future.cancel()
+            raise deadlines.DeadlineExceeded('search.shards')
+
+
+    @staticmethod
+    def __wait_timeout() -> Optional[float]:
+        """
+        How long to wait for a shard: until the caller's deadline, or without limit outside a request.
+        """
+        left = deadlines.remaining()
+        return None if left is None else max(0.0, left)
+
+
+    def retrieve_summary(self, params: Dict[str, Any]) -> List[Bill]:
+        """
+        Search every relevant shard and merge their results. Scores from different shards are comparable
+        because reranking scores each bill against the query on its own.
+        """
+        shard_indices = self.__shards_for_dates(params)
+        number_to_return = params.get('number_to_return', 5)
+
+        with span('search.shards.fan_out'):
+            results = self.__fan_out(lambda engine: engine.retrieve_summary(dict(params)), shard_indices)
+
+        with span('search.shards.merge'):
+            return _merge_results(results, number_to_return)
+
+
+    def retrieve_summary_multi(self, params: Dict[str, Any], queries: List[str]) -> List[Bill]:
+        """
+        Multi-query search on every relevant shard, merged by fused score. Each shard fuses the rankings of its
+        own candidates, so the merge approximates fusing the rankings of the whole database.
+        """
+        shard_indices = self.__shards_for_dates(params)
+        number_to_return = params.get('number_to_return', 5)
+
+        with span('search.shards.fan_out'):
+            results = self.__fan_out(lambda engine: engine.retrieve_summary_multi(dict(params), queries), shard_indices)
+
+        with span('search.shards.merge'):
+            return _merge_results(results, number_to_return)
+
+
+    def retrieve_full_text_chunks(self, params: Dict[str, Any], full_text_id: int, return_chunk_index: bool = False) -> List[Tuple]:
+        return self.__shard_of(full_text_id).retrieve_full_text_chunks(params, full_text_id, return_chunk_index)
+
+
+    def get_summaries(self, ids: List[int]) -> List[Bill]:
+        """
+        Look up bills by id across shards, in the given order.
+        """
+        by_shard = {}
+        for id in ids:
+            i = self.__shard_index(id)
+            if i >= 0:
+                by_shard.setdefault(i, []).append(id)
+
+        found = {}
+        for shard_index, shard_ids in by_shard.items():
+            for document in self.__engines[shard_index].get_summaries(shard_ids):
+                found[document.id] = document
+        return [found[id] for id in ids if id in found]
+
+
+    def get_full_text_chunks(self, full_text_id: int, chunk_indices: List[int]) -> List[str]:
+        return self.__shard_of(full_text_id).get_full_text_chunks(full_text_id, chunk_indices)
+
+
+    def encoders(self) -> Tuple:
+        # The shards share their encoders
+        return self.__engines[0].encoders()
+
+
+    def encoder_stats(self) -> Dict[str, Dict]:
+        # The shards share their encoders
+        return self.__engines[0].encoder_stats()
+
+
+    def singleflight_stats(self) -> Dict[str, Any]:
+        return {shard['name']: engine.singleflight_stats() for shard, engine in zip(self.__shards, self.__engines)}
+
+
+    def metadata_stats(self) -> Dict[str, Any]:
+        return {shard['name']: engine.metadata_stats() for shard, engine in zip(self.__shards, self.__engines)}
+
+
+    def filter_stats(self) -> Dict[str, Any]:
+        return {shard['name']: engine.filter_stats() for shard, engine in zip(self.__shards, self.__engines)}
+
+
+    def embedding_stats(self) -> Dict[str, Any]:
+        return {shard['name']: engine.embedding_stats() for shard, engine in zip(self.__shards, self.__engines)}
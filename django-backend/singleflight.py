@@ -0,0 +1,78 @@
+from typing import Any, Callable, Dict, Hashable, Tuple
+from concurrent.futures import Future
+import copy
+import threading
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls. The first call for a key runs the function; calls for the same key that
+    arrive while it is running wait for it and get its result instead of running the function again. Nothing is
+    kept once the call finishes, so this only removes duplicate work that overlaps in time, and never serves
+    stale results.
+    """
+    def __init__(self, copy_results: bool = False, retry_errors: Tuple[type, ...] = ()) -> None:
+        """
+        If copy_results is True, callers that waited get a deep copy of the result, so that callers which
+        modify their results do not affect each other.
+        Callers that waited on a call which failed with one of retry_errors make the call again instead of
+        raising, for errors that belong to the caller that ran it rather than to the call, such as its deadline.
+        """
+        self.__copy_results = copy_results
+        self.__retry_errors = retry_errors
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+        self.__calls = 0
+        self.__coalesced = 0
+        self.__errors = 0
+
+
+    def do(self, key: Hashable, function: Callable, *args) -> Any:
+        """
+        Return function(*args), sharing the call with any concurrent caller with the same key.
+        """
+        with self.__lock:
+            self.__calls += 1
+            future = self.__in_flight.get(key)
+            if future is not None:
+                self.__coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self.__in_flight[key] = future
+                leader = True
+
+        if not leader:
+            try:
+                result = future.result()
+            except self.__retry_errors:
+                return self.do(key, function, *args)
+            return copy.deepcopy(result) if self.__copy_results else result
+
+        try:
+            result = function(*args)
+        except BaseException as e:
+            with self.__lock:
+                self.__errors += 1
+                del self.__in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self.__lock:
+            del self.__in_flight[key]
+        future.set_result(result)
+        return result
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Calls made, calls that shared another call's result instead of running, and calls running now.
+        """
+        with self.__lock:
+            return {
+                'calls': self.__calls,
+                'executed': self.__calls - self.__coalesced,
+                'coalesced': self.__coalesced,
+                'errors': self.__errors,
+                'in_flight': len(self.__in_flight)
+            }
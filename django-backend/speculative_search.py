@@ -0,0 +1,144 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+import threading
+import time
+from admission import Admission, OverloadedError
+import deadlines
+
+
+class SpeculativeSearch:
+    """
+    A search started ahead of the request for it: its future, and the deadline that stops it if it is abandoned
+    while it runs.
+    """
+    __slots__ = ['future', 'deadline']
+
+    def __init__(self, future: Future, deadline: deadlines.Deadline) -> None:
+        self.future = future
+        self.deadline = deadline
+
+
+    def cancel(self) -> None:
+        """
+        Drop the search if it has not started, and stop it at its next cancellation check if it has.
+        """
+        self.future.cancel()
+        self.deadline.cancel()
+
+
+class SpeculativeSearches:
+    """
+    Searches started as soon as GPT asks for one, before the frontend follows up with its search request.
+    Each search runs on the search executor and is parked under the chat and position of the search request,
+    for a limited time. The follow-up request takes the search if it asks for the same one, so that the search
+    overlaps with the round trip to the client instead of starting after it.
+    With admission control, speculative searches wait in the search queue like any other, are not started while
+    searches are queueing up, and are the first to be dropped when the queue is long.
+    """
+    def __init__(
+        self, executor: Executor, ttl: float = 30.0, max_entries: int = 1000, admission: Admission = None,
+        budget: float = deadlines.SEARCH_BUDGET
+    ) -> None:
+        self.__executor = executor
+        self.__ttl = ttl
+        self.__max_entries = max_entries
+        self.__admission = admission
+        self.__budget = budget
+        # key -> (expiry time, request, search), oldest first
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__started = 0
+        self.__skipped = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__mismatches = 0
+        self.__expired = 0
+
+
+    def start(self, key: Hashable, request: Dict[str, Any], function: Callable, *args) -> None:
+        """
+        Run function(*args) in the background and park it under key. request describes the search, and has to
+        match the one the search is later taken for. Nothing is started if the search queue is long or full.
+        """
+        # The search is not part of the request that started it, so it runs with a deadline of its own
+        context, deadline = deadlines.detached_context(self.__budget)
+        function, args = context.run, (deadlines.call, 'search.queue', function, *args)
+        if self.__admission is None:
+            future = self.__executor.submit(function, *args)
+        elif self.__admission.overloaded():
+            future = None
+        else:
+            try:
+                future = self.__admission.submit(self.__executor, function, *args, optional=True)
+            except OverloadedError:
+                future = None
+        if future is None:
+            with self.__lock:
+                self.__skipped += 1
+            return
+
+        with self.__lock:
+            self.__evict(time.monotonic())
+            previous = self.__entries.pop(key, None)
+            if previous is not None:
+                previous[2].cancel()
+            self.__entries[key] = (time.monotonic() + self.__ttl, request, SpeculativeSearch(future, deadline))
+            while len(self.__entries) > self.__max_entries:
+                _, (_, _, oldest) = self.__entries.popitem(last=False)
+                oldest.cancel()
+            self.__started += 1
+
+
+    def take(self, key: Hashable, request: Dict[str, Any]) -> Optional[SpeculativeSearch]:
+        """
+        Remove and return the search parked under key, or None if there is none, it has expired, or it was
+        started for a different search. The caller should cancel the search if it gives up waiting for it.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.__misses += 1
+                return None
+
+            expires, parked_request, search = entry
+            if expires < time.monotonic():
+                self.__expired += 1
+                search.cancel()
+                return None
+            if parked_request != request:
+                self.__mismatches += 1
+                search.cancel()
+                return None
+
+            self.__hits += 1
+            return search
+
+
+    def __evict(self, now: float) -> None:
+        """
+        Drop expired entries. Entries are in order of expiry, since they all live for the same time.
+        """
+        while self.__entries:
+            key, (expires, _, search) = next(iter(self.__entries.items()))
+            if expires >= now:
+                break
+            self.__entries.popitem(last=False)
+            search.cancel()
+            self.__expired += 1
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counts of searches started or skipped, and of follow-up requests that found, missed or could not use one.
+        """
+        with self.__lock:
+            return {
+                'started': self.__started,
+                'skipped': self.__skipped,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'mismatches': self.__mismatches,
+                'expired': self.__expired,
+                'parked': len(self.__entries)
+            }
@@ -0,0 +1,166 @@
+from typing import Callable, Dict, List, Optional
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# Stage timings of the current request, when they are being collected.
+_request_timings: contextvars.ContextVar[Optional[List]] = contextvars.ContextVar('request_timings', default=None)
+
+_lock = threading.Lock()
+_histograms = {}
+_stats_providers = {}
+_tracer = None
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+    """
+    def __init__(self) -> None:
+        self.__counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.__count = 0
+        self.__total_ms = 0.0
+        self.__lock = threading.Lock()
+
+
+    def observe(self, ms: float) -> None:
+        """
+        Record one duration.
+        """
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+        with self.__lock:
+            self.__counts[bucket] += 1
+            self.__count += 1
+            self.__total_ms += ms
+
+
+    def snapshot(self) -> Dict:
+        """
+        Counts per bucket, with the mean and bucket-resolution percentiles.
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+            count = self.__count
+            total_ms = self.__total_ms
+
+        labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+        return {
+            'count': count,
+            'mean_ms': total_ms / count if count else 0,
+            'p50_ms': self.__percentile(counts, count, 0.5),
+            'p95_ms': self.__percentile(counts, count, 0.95),
+            'p99_ms': self.__percentile(counts, count, 0.99),
+            'buckets': dict(zip(labels, counts))
+        }
+
+
+    @staticmethod
+    def __percentile(counts: List[int], count: int, quantile: float) -> Optional[float]:
+        """
+        Upper bound of the bucket containing the quantile, or None if it is above the largest bucket.
+        """
+        if count == 0:
+            return None
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= quantile * count:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time a stage of a request. The duration goes into the stage's histogram, the current request's timings if
+    they are being collected, and OpenTelemetry if it is enabled.
+    """
+    otel_span = _tracer.start_as_current_span(name) if _tracer is not None else None
+    if otel_span is not None:
+        otel_span.__enter__()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        if otel_span is not None:
+            otel_span.__exit__(None, None, None)
+
+        histogram = _histograms.get(name)
+        if histogram is None:
+            with _lock:
+                histogram = _histograms.setdefault(name, Histogram())
+        histogram.observe(ms)
+
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append({'stage': name, 'ms': round(ms, 2)})
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collect the stage timings of everything run in this context, including work handed to other threads with
+    the context copied. Yields the list that the timings are appended to.
+    """
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def register_stats(name: str, provider: Callable[[], Dict]) -> None:
+    """
+    Include the statistics returned by provider in the metrics snapshot, such as cache hit rates or pool sizes.
+    """
+    with _lock:
+        _stats_providers[name] = provider
+
+
+def metrics_snapshot() -> Dict:
+    """
+    All stage histograms and registered statistics.
+    """
+    with _lock:
+        histograms = dict(_histograms)
+        providers = dict(_stats_providers)
+
+    stats = {}
+    for name, provider in providers.items():
+        try:
+            stats[name] = provider()
+        except Exception as e:
+            stats[name] = {'error': repr(e)}
+
+    return {
+        'stages': {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+        'stats': stats
+    }
+
+
+def enable_opentelemetry(service_name: str = 'congressgpt') -> bool:
+    """
+    Also export spans through OpenTelemetry, if it is installed. The exporter itself is configured with the
+    standard OTEL_* environment variables. Returns whether OpenTelemetry was enabled.
+    """
+    global _tracer
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        return False
+
+    provider = TracerProvider(resource=Resource.create({'service.name': service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    return True